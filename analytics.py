@@ -0,0 +1,557 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from mapping import VALUE_RANGES
+from session_store import READING_COLUMNS, SESSION_DB_PATH
+
+# =============================================================================
+# Session Analytics
+# =============================================================================
+# Longitudinal statistics over the whole session history - a device's
+# respiratory_sessions.db or the fleet service's fleet_sessions.db (which adds
+# a ward per session): per-patient trends, adherence against the prescribed
+# sessions per day, rolling bests and cohort statistics.
+# Sessions are read column-wise in chunks and folded into two rollup tables,
+# one row per patient and one per patient-day, with vectorized scatter
+# reductions (np.add.at / np.fmax.at / np.fmin.at). Everything a query needs
+# is kept as running sums, maxima and minima - including the least-squares
+# sums behind each trend - so adding sessions only touches their own rows:
+# one new session costs the same with a hundred sessions on file or ten
+# million. Queries are pandas group-bys over the rollups, never over the
+# sessions. The rollups can be saved next to the database so the next start
+# only reads sessions added since.
+#
+#   python analytics.py patients /home/pi/respiratory_sessions.db
+#   python analytics.py cohorts fleet_sessions.db --by ward
+#   python analytics.py bench --patients 2000 --years 3
+
+PRESCRIBED_SESSIONS_PER_DAY = int(os.environ.get("RT_PRESCRIBED_SESSIONS", "3"))
+ROLLING_BEST_DAYS = 7        # window of rolling_best()
+TREND_MIN_DAYS = 3           # days with sessions a patient needs before a trend is reported
+ANALYTICS_CHUNK_ROWS = 200000
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = pd.Timestamp("2020-01-01")   # day numbers count from here
+EPOCH_DATETIME = EPOCH.to_pydatetime()
+
+
+class Rollup:
+    """
+    Keyed table of float64 aggregates that grows in place. Each column is
+    combined with "sum", "max" or "min"; merge() scatters per-session values
+    into their keys' rows, so only the rows of the merged keys are touched.
+    """
+    IDENTITY = {"sum": 0.0, "max": np.nan, "min": np.nan}
+
+    def __init__(self, columns, capacity=1024):
+        self.columns = tuple(name for name, _ in columns)
+        ops = np.array([op for _, op in columns])
+        self.sum_cols = np.flatnonzero(ops == "sum")
+        self.max_cols = np.flatnonzero(ops == "max")
+        self.min_cols = np.flatnonzero(ops == "min")
+        self.identity = np.array([self.IDENTITY[op] for _, op in columns])
+        self.keys = []
+        self.index = {}
+        self.data = np.empty((capacity, len(columns)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def rows_for(self, keys):
+        """Row numbers of `keys` (unique), adding rows for new ones. Returns (rows, new mask)."""
+        index = self.index
+        rows = np.array([index.get(key, -1) for key in keys], np.int64)
+        new = rows < 0
+        if new.any():
+            added = [keys[i] for i in np.flatnonzero(new)]
+            start, end = len(self.keys), len(self.keys) + len(added)
+            if end > len(self.data):
+                grown = np.empty((max(end, 2 * len(self.data)), len(self.columns)))
+                grown[:start] = self.data[:start]
+                self.data = grown
+            self.data[start:end] = self.identity
+            index.update(zip(added, range(start, end)))
+            self.keys.extend(added)
+            rows[new] = np.arange(start, end)
+        return rows, new
+
+    def merge(self, rows, values):
+        """Fold per-session `values` (n x columns, NaN = nothing) into `rows` (may repeat)."""
+        reduced = {}
+        if len(rows) > 1:
+            # Reduce to one row per key first; the scatter below then has no repeats
+            grouped = pd.DataFrame(values).groupby(rows, sort=False)
+            for cols, reduction in ((self.sum_cols, "sum"), (self.max_cols, "max"), (self.min_cols, "min")):
+                if len(cols):
+                    result = grouped[list(cols)].agg(reduction)
+                    reduced[reduction] = result.to_numpy(np.float64)
+            rows = result.index.to_numpy(np.int64)
+        for cols, reduction, ufunc in ((self.sum_cols, "sum", np.add), (self.max_cols, "max", np.fmax),
+                                       (self.min_cols, "min", np.fmin)):
+            if len(cols):
+                block = (rows[:, None], cols[None, :])
+                self.data[block] = ufunc(self.data[block], reduced.get(reduction, values[:, cols]))
+
+    def frame(self, index_names):
+        data = self.data[:len(self.keys)]
+        if len(index_names) > 1:
+            index = pd.MultiIndex.from_tuples(self.keys, names=index_names)
+        else:
+            index = pd.Index(self.keys, name=index_names[0])
+        return pd.DataFrame(data, index=index, columns=self.columns)
+
+
+# Per patient. Per reading: how many sessions had it (n), their sum and best,
+# and the sums of a least-squares fit of the reading against the day (t_*).
+PATIENT_COLUMNS = [("sessions", "sum"), ("first_day", "min"), ("last_day", "max"),
+                   ("active_days", "sum"), ("prescribed_done", "sum")]
+for _reading in READING_COLUMNS:
+    PATIENT_COLUMNS += [(f"n_{_reading}", "sum"), (f"sum_{_reading}", "sum"), (f"best_{_reading}", "max"),
+                        (f"tn_{_reading}", "sum"), (f"tx_{_reading}", "sum"), (f"ty_{_reading}", "sum"),
+                        (f"txx_{_reading}", "sum"), (f"txy_{_reading}", "sum")]
+DAY_COLUMNS = [("sessions", "sum")] + [(f"best_{reading}", "max") for reading in READING_COLUMNS]
+
+
+def day_numbers(timestamps):
+    """Fractional days since EPOCH for timestamp strings (NaN if missing or unparseable)."""
+    times = pd.to_datetime(pd.Series(timestamps, dtype=object), format=TIMESTAMP_FORMAT, errors="coerce")
+    return ((times - EPOCH) / pd.Timedelta(days=1)).to_numpy(np.float64)
+
+
+def factorize(values):
+    """(codes, uniques) like pd.factorize, short-cutting the single value of one added session."""
+    if len(values) == 1:
+        return np.zeros(1, np.int64), values
+    return pd.factorize(values)
+
+
+def day_number(timestamp):
+    """day_numbers() of one timestamp, without the per-call cost of pandas."""
+    try:
+        delta = datetime.strptime(timestamp, TIMESTAMP_FORMAT) - EPOCH_DATETIME
+    except (TypeError, ValueError):
+        return np.array([np.nan])
+    return np.array([delta / timedelta(days=1)])
+
+
+def read_sessions(path, after_id=0, chunk_rows=ANALYTICS_CHUNK_ROWS):
+    """
+    DataFrames of sessions with id > after_id from a session database, in id
+    order, `chunk_rows` at a time. Includes a "ward" column when the
+    database has one (the fleet service's).
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        has_ward = any(row[1] == "ward" for row in conn.execute("PRAGMA table_info(sessions)"))
+        columns = "id, card_id, timestamp, " + ", ".join(READING_COLUMNS) + (", ward" if has_ward else "")
+        yield from pd.read_sql_query(f"SELECT {columns} FROM sessions WHERE id > ? ORDER BY id", conn,
+                                     params=(after_id,), chunksize=chunk_rows)
+    finally:
+        conn.close()
+
+
+class SessionAnalytics:
+    """Incrementally maintained session rollups and the queries over them. Safe to share between threads."""
+    def __init__(self, path=SESSION_DB_PATH, prescribed=PRESCRIBED_SESSIONS_PER_DAY):
+        self.path = path
+        self.prescribed = prescribed
+        self.last_id = 0
+        self.patients_rollup = Rollup(PATIENT_COLUMNS)
+        self.days_rollup = Rollup(DAY_COLUMNS, capacity=8192)
+        self.wards = {}          # card_id -> ward of its latest session (fleet data only)
+        self.version = 0         # bumped by every merge; invalidates the cached patient table
+        self._patients = None
+        self._lock = threading.Lock()
+
+    # -------------------------------
+    # Updates
+    # -------------------------------
+    def refresh(self):
+        """Fold in every session added to the database since the last refresh. Returns how many."""
+        added = 0
+        for chunk in read_sessions(self.path, self.last_id):
+            added += self._merge_frame(chunk)
+        return added
+
+    def add(self, row_id, data, ward=None):
+        """A session [card_id, timestamp, blue, orange, green] was saved as `row_id`."""
+        data = list(data) + [None] * (2 + len(READING_COLUMNS) - len(data))
+        readings = np.array([np.nan if v is None else v for v in data[2:2 + len(READING_COLUMNS)]], np.float64)
+        with self._lock:
+            if row_id <= self.last_id:
+                return
+            self._merge(np.array([str(data[0])], object), day_number(data[1]), readings[None, :],
+                        None if ward is None else [ward])
+            self.last_id = row_id
+
+    def _merge_frame(self, frame):
+        readings = np.column_stack([pd.to_numeric(frame[reading], errors="coerce").to_numpy(np.float64)
+                                    for reading in READING_COLUMNS])
+        wards = frame["ward"].to_numpy(object) if "ward" in frame else None
+        with self._lock:
+            keep = frame["id"].to_numpy() > self.last_id
+            if not keep.any():
+                return 0
+            self._merge(frame["card_id"].astype(str).to_numpy(object)[keep],
+                        day_numbers(frame["timestamp"].to_numpy(object)[keep]), readings[keep],
+                        None if wards is None else wards[keep])
+            self.last_id = int(frame["id"].iloc[-1])
+        return int(keep.sum())
+
+    def _merge(self, cards, x, readings, wards):
+        # cards: (n,) card IDs, x: (n,) day numbers (NaN = undated), readings: (n, len(READING_COLUMNS))
+        n = len(cards)
+        codes, uniques = factorize(cards)
+        card_rows, _ = self.patients_rollup.rows_for(uniques)
+        rows = card_rows[codes]
+        day = np.floor(x)
+        dated = ~np.isnan(day)
+
+        # Patient-day rollup: sessions and best readings per day
+        if dated.any():
+            days = day[dated].astype(np.int64)
+            first = days.min()
+            span = days.max() - first + 1
+            pair_codes, pair_uniques = factorize(codes[dated] * span + (days - first))
+            pair_card, pair_day = np.divmod(pair_uniques, span)
+            day_rows, new_days = self.days_rollup.rows_for(
+                list(zip(uniques[pair_card], (pair_day + first).tolist())))
+            day_values = np.column_stack([np.ones(dated.sum()), readings[dated]])
+            sessions = self.days_rollup.column("sessions")
+            self.days_rollup.merge(day_rows[pair_codes], day_values)
+            # Sessions towards the prescription: at most `prescribed` per day count
+            after = self.days_rollup.data[day_rows, sessions]
+            before = after - np.bincount(pair_codes, minlength=len(pair_uniques))
+            done = np.minimum(after, self.prescribed) - np.minimum(before, self.prescribed)
+        else:
+            pair_card = new_days = done = np.zeros(0)
+
+        values = np.empty((n, len(PATIENT_COLUMNS)))
+        values[:, 0] = 1
+        values[:, 1] = values[:, 2] = day
+        values[:, 3] = values[:, 4] = 0
+        for i in range(len(READING_COLUMNS)):
+            y = readings[:, i]
+            has = ~np.isnan(y)
+            fit = has & dated
+            tx, ty = np.where(fit, x, 0.0), np.where(fit, y, 0.0)
+            values[:, 5 + 8 * i:13 + 8 * i] = np.column_stack(
+                [has, np.where(has, y, 0.0), y, fit, tx, ty, tx * tx, tx * ty])
+        self.patients_rollup.merge(rows, values)
+        if len(pair_card):
+            day_totals = np.tile(self.patients_rollup.identity, (len(pair_card), 1))
+            day_totals[:, 3] = new_days
+            day_totals[:, 4] = done
+            self.patients_rollup.merge(card_rows[pair_card], day_totals)
+
+        if wards is not None and n == 1:
+            self.wards[cards[0]] = wards[0]
+        elif wards is not None:
+            latest = pd.Series(wards, index=cards)
+            self.wards.update(latest[~latest.index.duplicated(keep="last")].to_dict())
+        self.version += 1
+
+    # -------------------------------
+    # Queries
+    # -------------------------------
+    def patients(self, until=None):
+        """
+        One row per patient: sessions, active_days, first/last session date,
+        per reading mean_*, best_* and trend_* (change per day, NaN until the
+        patient has TREND_MIN_DAYS days of sessions), adherence (share of the
+        prescribed sessions done from the first session to `until` - a date,
+        default each patient's last session) and ward when known.
+        """
+        with self._lock:
+            if until is None and self._patients is not None and self._patients[0] == self.version:
+                return self._patients[1]
+            version = self.version
+            rollup = self.patients_rollup.frame(["card_id"])
+            wards = dict(self.wards)
+        table = pd.DataFrame(index=rollup.index)
+        table["sessions"] = rollup["sessions"].astype(np.int64)
+        table["active_days"] = rollup["active_days"].astype(np.int64)
+        table["first_session"] = EPOCH + pd.to_timedelta(rollup["first_day"], unit="D")
+        table["last_session"] = EPOCH + pd.to_timedelta(rollup["last_day"], unit="D")
+        for reading in READING_COLUMNS:
+            n, tn = rollup[f"n_{reading}"], rollup[f"tn_{reading}"]
+            table[f"mean_{reading}"] = rollup[f"sum_{reading}"] / n.where(n > 0)
+            table[f"best_{reading}"] = rollup[f"best_{reading}"]
+            tx, ty = rollup[f"tx_{reading}"], rollup[f"ty_{reading}"]
+            spread = tn * rollup[f"txx_{reading}"] - tx * tx
+            trend = (tn * rollup[f"txy_{reading}"] - tx * ty) / spread.where(spread > 1e-9)
+            table[f"trend_{reading}"] = trend.where(rollup["active_days"] >= TREND_MIN_DAYS)
+        last_day = rollup["last_day"] if until is None else (pd.Timestamp(until) - EPOCH).days
+        span = (last_day - rollup["first_day"] + 1).clip(lower=1)
+        table["adherence"] = (rollup["prescribed_done"] / (span * self.prescribed)).clip(upper=1.0)
+        if wards:
+            table["ward"] = pd.Series(wards, dtype=object).reindex(table.index)
+        if until is None:
+            with self._lock:
+                self._patients = (version, table)
+        return table
+
+    def patient(self, card_id):
+        """The patients() row of one card as a dict, or None if it has no sessions."""
+        table = self.patients()
+        card_id = str(card_id)
+        return table.loc[card_id].to_dict() if card_id in table.index else None
+
+    def rolling_best(self, card_id=None, days=ROLLING_BEST_DAYS):
+        """Best reading of the last `days` days, per patient and day with sessions (one card or all)."""
+        with self._lock:
+            daily = self.days_rollup.frame(["card_id", "day"])
+        if card_id is not None:
+            daily = daily[daily.index.get_level_values("card_id") == str(card_id)]
+        daily = daily.reset_index()
+        daily["date"] = EPOCH + pd.to_timedelta(daily["day"], unit="D")
+        best = [f"best_{reading}" for reading in READING_COLUMNS]
+        rolling = (daily.sort_values(["card_id", "date"]).set_index("date")
+                   .groupby("card_id")[best].rolling(f"{days}D").max())
+        return rolling
+
+    def cohorts(self, by="month"):
+        """
+        Statistics per cohort of patients: by "month" of their first session or
+        by "ward" (fleet data). Patients, sessions, median adherence, mean best
+        and median trend per reading, and the share of patients improving.
+        """
+        table = self.patients()
+        if by == "ward":
+            if "ward" not in table:
+                raise ValueError("These sessions have no wards (only the fleet database does)")
+            key = table["ward"].fillna("")
+        elif by == "month":
+            key = table["first_session"].dt.strftime("%Y-%m").fillna("undated")
+        else:
+            raise ValueError(f"Unknown cohort: {by}")
+        for reading in READING_COLUMNS:
+            trend = table[f"trend_{reading}"]
+            table = table.assign(**{f"improving_{reading}": (trend > 0).astype(np.float64).where(trend.notna())})
+        aggregations = {"patients": ("sessions", "size"), "sessions": ("sessions", "sum"),
+                        "adherence": ("adherence", "median")}
+        for reading in READING_COLUMNS:
+            aggregations[f"best_{reading}"] = (f"best_{reading}", "mean")
+            aggregations[f"trend_{reading}"] = (f"trend_{reading}", "median")
+            aggregations[f"improving_{reading}"] = (f"improving_{reading}", "mean")
+        return table.groupby(key.rename(by)).agg(**aggregations)
+
+    def status(self):
+        with self._lock:
+            return {"last_id": self.last_id, "patients": len(self.patients_rollup),
+                    "patient_days": len(self.days_rollup)}
+
+    # -------------------------------
+    # Cache
+    # -------------------------------
+    def save(self, path):
+        """Write the rollups to `path` (.npz), so open() only reads newer sessions."""
+        with self._lock:
+            days = self.days_rollup.keys
+            arrays = {
+                "meta": np.array([self.last_id, self.prescribed], np.int64),
+                "patient_keys": np.array(self.patients_rollup.keys, dtype=str),
+                "patient_data": self.patients_rollup.data[:len(self.patients_rollup)],
+                "day_cards": np.array([card for card, _ in days], dtype=str),
+                "day_numbers": np.array([day for _, day in days], np.int64),
+                "day_data": self.days_rollup.data[:len(days)],
+                "ward_cards": np.array(list(self.wards), dtype=str),
+                "ward_names": np.array([str(w) for w in self.wards.values()], dtype=str),
+            }
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def open(cls, path=SESSION_DB_PATH, cache_path=None, prescribed=PRESCRIBED_SESSIONS_PER_DAY):
+        """
+        Analytics for the database at `path`, starting from the rollups in
+        `cache_path` when they are usable, then refreshed.
+        """
+        analytics = cls(path, prescribed)
+        if cache_path and os.path.exists(cache_path):
+            try:
+                analytics._load(cache_path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring analytics cache {cache_path}: {e}")
+                analytics = cls(path, prescribed)
+        analytics.refresh()
+        return analytics
+
+    def _load(self, cache_path):
+        with np.load(cache_path) as data:
+            last_id, prescribed = (int(v) for v in data["meta"])
+            if prescribed != self.prescribed:
+                raise ValueError(f"built for {prescribed} sessions per day")
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            try:
+                newest = conn.execute("SELECT COALESCE(MAX(id), 0) FROM sessions").fetchone()[0]
+            finally:
+                conn.close()
+            if last_id > newest:
+                raise ValueError("newer than the database")
+            for rollup, keys, values in (
+                    (self.patients_rollup, data["patient_keys"].tolist(), data["patient_data"]),
+                    (self.days_rollup, list(zip(data["day_cards"].tolist(), data["day_numbers"].tolist())),
+                     data["day_data"])):
+                rows, _ = rollup.rows_for(keys)
+                rollup.data[rows] = values
+            self.wards = dict(zip(data["ward_cards"].tolist(), data["ward_names"].tolist()))
+            self.last_id = last_id
+            self.version += 1
+
+
+# =============================================================================
+# Command line and benchmark
+# =============================================================================
+def generate_history(path, patients, years, sessions_per_day=PRESCRIBED_SESSIONS_PER_DAY, wards=8, seed=0):
+    """
+    Fill a fleet-style session database with `years` of synthetic therapy:
+    each patient has a course of 5-60 days with up to sessions_per_day
+    sessions a day and slowly improving readings, each within its column's
+    VALUE_RANGES (what the device can show). Returns the session count.
+    """
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, card_id TEXT NOT NULL, timestamp TEXT,
+            blue INTEGER, orange INTEGER, green INTEGER, ward TEXT)""")
+    total_days = int(years * 365)
+    start = rng.integers(0, total_days, patients)
+    length = rng.integers(5, 61, patients)
+    rows = []
+    for p in range(patients):
+        days = np.arange(length[p])
+        counts = rng.integers(0, sessions_per_day + 2, len(days))
+        day = np.repeat(days, counts)
+        seconds = rng.integers(7 * 3600, 21 * 3600, len(day))
+        times = EPOCH + pd.to_timedelta(start[p] + day, unit="D") + pd.to_timedelta(seconds, unit="s")
+        base = rng.uniform(0.2, 0.6)
+        level = np.clip(base + day * rng.uniform(0, 0.01) + rng.normal(0, 0.05, len(day)), 0, 1)
+        ward = f"ward-{p % wards}"
+        readings = [np.clip(low + (level * (high - low)).astype(np.int64) // 10 * 10, low, high)
+                    for low, high in VALUE_RANGES.values()]
+        for t, blue, orange, green in zip(times.strftime(TIMESTAMP_FORMAT), *readings):
+            rows.append((f"{100000 + p}", t, int(blue), int(orange), int(green), ward))
+    rows.sort(key=lambda row: row[1])
+    conn.executemany("INSERT INTO sessions (card_id, timestamp, blue, orange, green, ward) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def full_recompute(path, prescribed=PRESCRIBED_SESSIONS_PER_DAY):
+    """The per-patient numbers recomputed from scratch with plain group-bys (for checking)."""
+    frame = pd.concat(read_sessions(path))
+    frame["day"] = np.floor(day_numbers(frame["timestamp"].to_numpy(object)))
+    per_day = frame.groupby(["card_id", "day"]).size()
+    done = per_day.clip(upper=prescribed).groupby(level="card_id").sum()
+    grouped = frame.groupby("card_id")
+    span = grouped["day"].max() - grouped["day"].min() + 1
+    result = pd.DataFrame({"sessions": grouped.size(),
+                           "adherence": (done / (span * prescribed)).clip(upper=1.0)})
+    for reading in READING_COLUMNS:
+        result[f"best_{reading}"] = grouped[reading].max()
+        result[f"mean_{reading}"] = grouped[reading].mean()
+    return result
+
+
+def benchmark(args):
+    path = args.db or "/tmp/analytics_bench.db"
+    if os.path.exists(path):
+        os.remove(path)
+    start = time.perf_counter()
+    count = generate_history(path, args.patients, args.years)
+    print(f"Generated {count} sessions for {args.patients} patients over {args.years} years "
+          f"in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    analytics = SessionAnalytics(path)
+    analytics.refresh()
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    table = analytics.patients()
+    cohorts = analytics.cohorts("ward")
+    analytics.rolling_best()
+    query_seconds = time.perf_counter() - start
+    print(f"Full load: {load_seconds:.2f} s ({count / load_seconds:,.0f} sessions/s); "
+          f"patients + cohorts + rolling bests: {query_seconds:.2f} s")
+
+    reference = full_recompute(path).reindex(table.index)
+    worst = max(float((table[column] - reference[column]).abs().max()) for column in reference)
+    print(f"Largest difference from a full recompute: {worst:.2g}")
+
+    conn = sqlite3.connect(path)
+    timings = []
+    for i in range(args.adds):
+        data = [str(100000 + i % args.patients), time.strftime(TIMESTAMP_FORMAT), 700, 2000, 2500]
+        row_id = conn.execute("INSERT INTO sessions (card_id, timestamp, blue, orange, green, ward) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", data + ["ward-0"]).lastrowid
+        start = time.perf_counter()
+        analytics.add(row_id, data, "ward-0")
+        timings.append(time.perf_counter() - start)
+    conn.commit()
+    conn.close()
+    timings = np.array(timings) * 1e6
+    print(f"Adding one session: p50 {np.percentile(timings, 50):.0f} us, p99 {np.percentile(timings, 99):.0f} us")
+
+    cache_path = path + ".analytics.npz"
+    analytics.save(cache_path)
+    start = time.perf_counter()
+    reopened = SessionAnalytics.open(path, cache_path)
+    print(f"Reopened from cache in {time.perf_counter() - start:.2f} s, "
+          f"same result: {reopened.patients().equals(analytics.patients())}")
+    print(cohorts.round(3).to_string())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Longitudinal statistics over the session history.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("patients", "cohorts", "rolling"):
+        command = commands.add_parser(name)
+        command.add_argument("db", nargs="?", default=SESSION_DB_PATH)
+        command.add_argument("--cache", help="rollup cache (.npz) to start from and update")
+        if name == "cohorts":
+            command.add_argument("--by", choices=("month", "ward"), default="month")
+        else:
+            command.add_argument("--card", help="only this card ID")
+    bench = commands.add_parser("bench", help="time loading, querying and adding on synthetic fleet data")
+    bench.add_argument("--patients", type=int, default=2000)
+    bench.add_argument("--years", type=float, default=3)
+    bench.add_argument("--adds", type=int, default=1000, help="single sessions added after the load")
+    bench.add_argument("--db", help="database to (re)create, default /tmp/analytics_bench.db")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        benchmark(args)
+        return
+    analytics = SessionAnalytics.open(args.db, args.cache)
+    if args.cache:
+        analytics.save(args.cache)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        if args.command == "patients":
+            table = analytics.patients()
+            print(table.loc[[args.card]] if args.card else table)
+        elif args.command == "cohorts":
+            try:
+                print(analytics.cohorts(args.by))
+            except ValueError as e:
+                parser.error(str(e))
+        else:
+            print(analytics.rolling_best(args.card))
+
+
+if __name__ == "__main__":
+    main()
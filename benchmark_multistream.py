@@ -0,0 +1,129 @@
+import argparse
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from camera import SyntheticSource
+from detection import DEFAULT_HSV_RANGES, DEFAULT_ROI_STRIPS
+from engine import DETECTION_MODES, DetectionEngine
+from multistream import DetectorProcess
+
+# =============================================================================
+# Multi-stream benchmark: worker processes vs threads in one process
+# =============================================================================
+# Runs 1..N streams of synthetic frames as fast as detection allows, once
+# with one DetectorProcess per stream (shared-memory frames, as
+# multistream.py) and once with one thread per stream in this process, and
+# reports aggregate frames/sec. Threads share one interpreter, so they stop
+# scaling early; processes should scale until the cores run out.
+#
+#   python benchmark_multistream.py --streams 4 --seconds 3
+
+
+def engine_kwargs(mode):
+    return {"hsv_ranges": DEFAULT_HSV_RANGES, "roi_strips": DEFAULT_ROI_STRIPS, "mode": mode, "tracking": True}
+
+
+def drive_process(detector, frames, deadline, counts, index):
+    """Keep every slot of `detector` busy until `deadline`; count results."""
+    frame_id = 0
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        while detector.free:
+            slot = detector.free[0]
+            np.copyto(detector.frames[slot], frames[frame_id % len(frames)])
+            detector.submit(slot, frame_id, time.perf_counter())
+            frame_id += 1
+        if detector.receive(1.0) is not None:
+            counts[index] += 1
+    # Drain what is still in flight so the next run starts clean
+    while len(detector.free) < len(detector.frames):
+        detector.receive(1.0)
+
+
+def run_processes(streams, frames, seconds, mode):
+    detectors = [DetectorProcess(engine_kwargs(mode), frames[0].shape, name=f"bench-{i}")
+                 for i in range(streams)]
+    try:
+        # Warm up: wait until every worker has started and answered once
+        for detector in detectors:
+            np.copyto(detector.frames[0], frames[0])
+            detector.submit(0, -1, time.perf_counter())
+            detector.receive()
+        counts = [0] * streams
+        deadline = time.perf_counter() + seconds
+        threads = [threading.Thread(target=drive_process, args=(d, frames, deadline, counts, i))
+                   for i, d in enumerate(detectors)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / seconds
+    finally:
+        for detector in detectors:
+            detector.close()
+
+
+def run_threads(streams, frames, seconds, mode):
+    engines = [DetectionEngine(**engine_kwargs(mode)) for _ in range(streams)]
+    counts = [0] * streams
+    deadline = time.perf_counter() + seconds
+
+    def drive(index):
+        engine = engines[index]
+        i = 0
+        while time.perf_counter() < deadline:
+            engine.process(frames[i % len(frames)], i / 30.0)
+            i += 1
+        counts[index] = i
+
+    threads = [threading.Thread(target=drive, args=(i,)) for i in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure multi-stream detection scaling.")
+    parser.add_argument("--streams", type=int, default=max(2, min(os.cpu_count() or 1, 4)),
+                        help="largest number of streams to try")
+    parser.add_argument("--seconds", type=float, default=3.0, help="measurement time per run")
+    parser.add_argument("--mode", choices=DETECTION_MODES, default="roi")
+    parser.add_argument("--frames", type=int, default=60, help="distinct synthetic frames")
+    args = parser.parse_args()
+
+    source = SyntheticSource()
+    frames = [source.read() for _ in range(args.frames)]
+
+    # What sending a frame costs: shared-memory copy vs pickling it
+    count = 200
+    buffer = np.empty_like(frames[0])
+    start = time.perf_counter()
+    for i in range(count):
+        np.copyto(buffer, frames[i % len(frames)])
+    copy_us = (time.perf_counter() - start) * 1e6 / count
+    start = time.perf_counter()
+    for i in range(count):
+        pickle.loads(pickle.dumps(frames[i % len(frames)], protocol=pickle.HIGHEST_PROTOCOL))
+    pickle_us = (time.perf_counter() - start) * 1e6 / count
+    print(f"{os.cpu_count()} CPU(s), mode {args.mode}, frame {frames[0].shape}: "
+          f"shared-memory copy {copy_us:.0f} us, pickle round trip {pickle_us:.0f} us")
+
+    print(f"{'streams':>7} {'processes fps':>14} {'per stream':>11} {'scaling':>8} {'threads fps':>12}")
+    base = None
+    for streams in range(1, args.streams + 1):
+        processes = run_processes(streams, frames, args.seconds, args.mode)
+        threads = run_threads(streams, frames, args.seconds, args.mode)
+        base = base or processes
+        print(f"{streams:7d} {processes:14.0f} {processes / streams:11.0f} {processes / base:7.2f}x {threads:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import time
+
+from camera import SYNTHETIC_TUBE_HALF_WIDTH, SYNTHETIC_TUBES, SyntheticSource, VideoFileSource, mirror_strip
+from detection import (DEFAULT_HSV_RANGES, LabelLUT, detect_balls_fused, detect_balls_per_color,
+                       detect_balls_pyramid, detect_balls_roi, load_roi_strips, preprocess)
+
+# =============================================================================
+# Segmentation benchmark: per-color reference path vs the faster paths
+# =============================================================================
+# Runs each detector over the same frames - synthetic by default (no camera
+# needed), or a recorded video - and reports frames/sec and how often each
+# agrees with per_color.
+
+# Default HSV ranges (the synthetic balls are colored to match them)
+HSV_RANGES = DEFAULT_HSV_RANGES
+
+# Deliberately overlapping ranges: Orange also takes the green ball, Green takes
+# all three balls and scattered background noise. fused must still match per_color.
+OVERLAPPING_HSV_RANGES = {
+    "Blue": {"lower": (94, 80, 2), "upper": (126, 255, 255)},
+    "Orange": {"lower": (4, 100, 20), "upper": (70, 255, 255)},
+    "Green": {"lower": (10, 40, 0), "upper": (115, 255, 255)},
+}
+
+# Tube strips matching the synthetic source's tubes
+ROI_STRIPS = {label: (x - SYNTHETIC_TUBE_HALF_WIDTH - 3, x + SYNTHETIC_TUBE_HALF_WIDTH + 3)
+              for label, (x, _) in SYNTHETIC_TUBES.items()}
+
+
+def read_frames(source, count):
+    frames = []
+    while len(frames) < count:
+        frame = source.read()
+        if frame is None:
+            break
+        frames.append(frame)
+    source.close()
+    return frames
+
+
+def run(detector, frames):
+    """Time a detector over BGR frames, including its own preprocessing."""
+    start = time.perf_counter()
+    results = [detector(frame)[0] for frame in frames]
+    return results, time.perf_counter() - start
+
+
+def report_agreement(name, reference, candidate):
+    agree = 0
+    same_y = 0
+    worst_dy = 0
+    for ref, other in zip(reference, candidate):
+        if ref == other:
+            agree += 1
+        if all((ref[label] and ref[label][1]) == (other[label] and other[label][1]) for label in ref):
+            same_y += 1
+        for label in ref:
+            if ref[label] and other[label]:
+                worst_dy = max(worst_dy, abs(ref[label][1] - other[label][1]))
+            elif ref[label] != other[label]:
+                worst_dy = float("inf")
+    print(f"{name:>10}: identical ball_positions in {agree}/{len(reference)} frames, "
+          f"identical Y in {same_y}, worst |dy| = {worst_dy:.3g} px")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-color, fused, ROI and pyramid ball segmentation.")
+    parser.add_argument("--frames", type=int, default=300, help="number of synthetic frames")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per detector (best is reported)")
+    parser.add_argument("--video", help="recorded video to use instead of synthetic frames "
+                                        "(tube strips are read from ROI.data)")
+    parser.add_argument("--mirrored", action="store_true",
+                        help="the video is in camera orientation (not flipped)")
+    args = parser.parse_args()
+
+    if args.video:
+        source = VideoFileSource(args.video, mirrored=args.mirrored)
+        roi_strips = load_roi_strips()
+        if source.mirrored:
+            roi_strips = {label: mirror_strip(strip) for label, strip in roi_strips.items()}
+    else:
+        source = SyntheticSource(count=args.frames)
+        roi_strips = ROI_STRIPS
+    frames = read_frames(source, args.frames)
+    lut = LabelLUT(HSV_RANGES)
+    detectors = {
+        "per_color": lambda frame: detect_balls_per_color(preprocess(frame), HSV_RANGES),
+        "fused": lambda frame: detect_balls_fused(preprocess(frame), lut),
+        "roi": lambda frame: detect_balls_roi(frame, HSV_RANGES, roi_strips),
+        "pyramid": lambda frame: detect_balls_pyramid(frame, HSV_RANGES, roi_strips),
+    }
+
+    results = {}
+    for name, detector in detectors.items():
+        best = None
+        for _ in range(args.repeat):
+            results[name], elapsed = run(detector, frames)
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:>10}: {len(frames) / best:8.1f} frames/sec ({best / len(frames) * 1000:.2f} ms/frame)")
+
+    for name in detectors:
+        if name != "per_color":
+            report_agreement(name, results["per_color"], results[name])
+
+    print("Overlapping HSV ranges:")
+    overlap_lut = LabelLUT(OVERLAPPING_HSV_RANGES)
+    overlapping = {
+        "per_color": lambda frame: detect_balls_per_color(preprocess(frame), OVERLAPPING_HSV_RANGES),
+        "fused": lambda frame: detect_balls_fused(preprocess(frame), overlap_lut),
+    }
+    for name, detector in overlapping.items():
+        results[name], elapsed = run(detector, frames)
+        print(f"{name:>10}: {len(frames) / elapsed:8.1f} frames/sec ({elapsed / len(frames) * 1000:.2f} ms/frame)")
+    report_agreement("fused", results["per_color"], results["fused"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import argparse
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from camera import mirror_strip
+from detection import (DEFAULT_HSV_RANGES, DEFAULT_ROI_STRIPS, HSV_FILE, ROI_FILE, LabelLUT,
+                       load_hsv_ranges, load_roi_strips, preprocess)
+
+# =============================================================================
+# Calibration Profiles
+# =============================================================================
+# HSV ranges are kept as named, versioned profiles per device and lighting
+# condition instead of a single HSV.data in the working directory:
+#
+#   CALIBRATION_DIR/<device>/<lighting>/v0001.npy, v0002.npy, ...
+#   CALIBRATION_DIR/<device>/active      name of the lighting profile in use
+#
+# Each version is one small .npy holding a structured array (label, lower,
+# upper, draw_color per color) that np.load can memory-map. Saving never
+# overwrites: it adds the next version and switches to it atomically.
+# A loaded profile is compiled once - HSV arrays plus the fused LabelLUT - and
+# cached by file and mtime, so switching between known profiles is a dict
+# lookup and a reference swap in the engine. ProfileWatcher polls the active
+# file and the profile directory and hands new profiles to the running engine
+# from its own thread; the detection thread never waits for it.
+#
+#   python calibration.py list
+#   python calibration.py activate dim-ward
+#   python calibration.py auto camera --lighting dim-ward
+
+CALIBRATION_DIR = os.environ.get("RT_CALIBRATION_DIR", "/home/pi/calibration")
+CALIBRATION_DEVICE = os.environ.get("RT_DEVICE_ID") or socket.gethostname()
+DEFAULT_LIGHTING = "default"
+PROFILE_POLL_INTERVAL = 1.0      # seconds between file-change checks
+
+PROFILE_DTYPE = np.dtype([("label", "U16"), ("lower", "u1", (3,)), ("upper", "u1", (3,)),
+                          ("draw_color", "u1", (3,))])
+VERSION_PATTERN = re.compile(r"^v(\d+)\.npy$")
+
+
+def draw_color(label, settings):
+    default = DEFAULT_HSV_RANGES.get(label, {}).get("draw_color", (255, 255, 255))
+    return tuple(int(c) for c in settings.get("draw_color", default))
+
+
+def profile_array(hsv_ranges):
+    """hsv_ranges {label: {"lower", "upper", "draw_color"}} as a PROFILE_DTYPE array."""
+    array = np.zeros(len(hsv_ranges), PROFILE_DTYPE)
+    for row, (label, settings) in zip(array, hsv_ranges.items()):
+        row["label"] = label
+        row["lower"] = np.clip(settings["lower"], 0, 255)
+        row["upper"] = np.clip(settings["upper"], 0, 255)
+        row["draw_color"] = draw_color(label, settings)
+    return array
+
+
+class CalibrationProfile:
+    """HSV ranges compiled for detection: the arrays inRange wants plus the fused LabelLUT."""
+    __slots__ = ("name", "version", "path", "hsv_ranges", "labels", "label_lut")
+
+    def __init__(self, hsv_ranges, name=None, version=None, path=None):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.hsv_ranges = {
+            label: {"lower": np.array(settings["lower"], np.int32),
+                    "upper": np.array(settings["upper"], np.int32),
+                    "draw_color": draw_color(label, settings)}
+            for label, settings in hsv_ranges.items()
+        }
+        self.labels = list(self.hsv_ranges)
+        self.label_lut = LabelLUT(self.hsv_ranges)
+
+    @classmethod
+    def from_array(cls, array, name=None, version=None, path=None):
+        return cls({str(row["label"]): {"lower": row["lower"], "upper": row["upper"],
+                                        "draw_color": row["draw_color"]} for row in array},
+                   name, version, path)
+
+    def __str__(self):
+        return f"{self.name or 'unnamed'} v{self.version}" if self.version else (self.name or "unnamed")
+
+
+class ProfileStore:
+    """Versioned calibration profiles of one device. Safe to share between threads."""
+    def __init__(self, root=CALIBRATION_DIR, device=CALIBRATION_DEVICE):
+        self.root = root
+        self.device = device
+        self.dir = os.path.join(root, device)
+        self._cache = {}       # (path, mtime_ns) -> CalibrationProfile
+        self._lock = threading.Lock()
+
+    def lightings(self):
+        if not os.path.isdir(self.dir):
+            return []
+        return sorted(name for name in os.listdir(self.dir) if os.path.isdir(os.path.join(self.dir, name)))
+
+    def versions(self, lighting):
+        directory = os.path.join(self.dir, lighting)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(m.group(1)) for m in map(VERSION_PATTERN.match, os.listdir(directory)) if m)
+
+    def path(self, lighting, version):
+        return os.path.join(self.dir, lighting, f"v{version:04d}.npy")
+
+    def active(self):
+        """Name of the lighting profile in use."""
+        try:
+            with open(os.path.join(self.dir, "active")) as f:
+                return f.read().strip() or DEFAULT_LIGHTING
+        except OSError:
+            return DEFAULT_LIGHTING
+
+    def set_active(self, lighting):
+        if not self.versions(lighting):
+            raise ValueError(f"No calibration profile named {lighting!r} for {self.device}")
+        self._write_atomic(os.path.join(self.dir, "active"), lambda f: f.write(lighting.encode() + b"\n"))
+
+    def save(self, hsv_ranges, lighting=DEFAULT_LIGHTING, activate=True):
+        """Store `hsv_ranges` as the next version of `lighting`. Returns the version number."""
+        if not re.match(r"^[A-Za-z0-9_.-]+$", lighting):
+            raise ValueError(f"Invalid profile name: {lighting!r}")
+        os.makedirs(os.path.join(self.dir, lighting), exist_ok=True)
+        array = profile_array(hsv_ranges)
+        with self._lock:
+            version = (self.versions(lighting) or [0])[-1] + 1
+            self._write_atomic(self.path(lighting, version), lambda f: np.save(f, array))
+        if activate:
+            self.set_active(lighting)
+        return version
+
+    def _write_atomic(self, path, write):
+        # Readers (the watcher) only ever see a complete file.
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def load(self, lighting=None, version=None):
+        """
+        Compiled profile (the latest version of the active lighting by default),
+        or None if there is none. Cached until the file changes.
+        """
+        lighting = lighting or self.active()
+        if version is None:
+            versions = self.versions(lighting)
+            if not versions:
+                return None
+            version = versions[-1]
+        path = self.path(lighting, version)
+        key = (path, os.stat(path).st_mtime_ns)
+        profile = self._cache.get(key)
+        if profile is None:
+            array = np.load(path, mmap_mode="r")
+            profile = CalibrationProfile.from_array(array, f"{self.device}/{lighting}", version, path)
+            with self._lock:
+                self._cache[key] = profile
+        return profile
+
+    def signature(self):
+        """Changes whenever the active profile or its latest version changes."""
+        lighting = self.active()
+        versions = self.versions(lighting)
+        if not versions:
+            return (lighting, None)
+        path = self.path(lighting, versions[-1])
+        try:
+            return (lighting, path, os.stat(path).st_mtime_ns)
+        except OSError:
+            return (lighting, None)
+
+    def import_legacy(self, path=HSV_FILE, lighting=DEFAULT_LIGHTING):
+        """Turn an HSV.data from color_calibration.py into the first profile, once."""
+        if self.lightings() or not (os.path.exists(path) or os.path.exists(path + ".npz")):
+            return None
+        version = self.save(load_hsv_ranges(path), lighting)
+        print(f"Imported {path} as calibration profile {self.device}/{lighting} v{version}")
+        return version
+
+
+class ProfileWatcher:
+    """
+    Polls `store` for a new or switched profile and passes it to `apply`
+    (e.g. DetectionEngine.set_profile). check() runs one poll synchronously.
+    """
+    def __init__(self, store, apply, interval=PROFILE_POLL_INTERVAL):
+        self.store = store
+        self.apply = apply
+        self.interval = interval
+        self.profile = None
+        self.reloads = 0
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="calibration", daemon=True)
+
+    def check(self):
+        """Apply the active profile if it changed. Returns True when one was applied."""
+        signature = self.store.signature()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        profile = self.store.load()
+        if profile is None:
+            return False
+        self.apply(profile)
+        self.profile = profile
+        self.reloads += 1
+        print(f"Calibration profile {profile} in use")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # Keep detecting with the current profile
+                print("Could not load calibration profile:", e)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        return {"profile": str(self.profile) if self.profile else None, "reloads": self.reloads}
+
+
+# =============================================================================
+# Automatic Fitting
+# =============================================================================
+# Instead of tuning 18 trackbars, grab a short burst of frames with the balls
+# in view and fit each color's range from the pixels themselves. The ball
+# pixels of a color come either from a point clicked on the ball (a disk of
+# SEED_RADIUS around it, in every frame of the burst) or, automatically, from
+# its tube strip: the ball covers a small part of the strip, so the strip's
+# median color is the background; among saturated pixels that differ from it,
+# the strongest hue is the ball, and pixels within AUTO_HUE_WINDOW of it are
+# taken. Bounds are the
+# FIT_PERCENTILES of those pixels per channel, widened by FIT_MARGIN. All of
+# it is histogram/percentile work on whole arrays - a burst fits in a few ms.
+# A range is one box in HSV, so hues straddling 0/179 (red) cannot be fitted:
+# such a color keeps its previous range and is reported as "wraps".
+
+AUTO_BURST_FRAMES = 15
+SEED_RADIUS = 8                   # pixels around a clicked point taken as the ball
+AUTO_MIN_SATURATION = 60          # strip pixels below this are tube or background
+AUTO_MIN_VALUE = 30
+AUTO_HUE_WINDOW = 12              # hue distance from the peak counted as the ball
+AUTO_MAX_FRACTION = 0.4           # a "ball" covering more of its strip than this is background
+FIT_PERCENTILES = (1, 99)
+FIT_MARGIN = (3, 20, 20)          # widening of the fitted H, S, V bounds
+FIT_MIN_PIXELS = 50               # fewer ball pixels than this: keep the old range
+HUE_MAX = 179                     # OpenCV 8-bit hue range is 0..179
+
+
+def hue_distance(hue, center):
+    """Circular distance on OpenCV's 0..179 hue wheel (`center` may be an array)."""
+    d = np.abs(hue.astype(np.int16) - np.asarray(center, np.int16))
+    return np.minimum(d, HUE_MAX + 1 - d)
+
+
+def strip_ball_pixels(hsv_strips):
+    """(pixels, hue peak) of the dominant non-background hue in (N, H, W, 3) HSV strips."""
+    count = len(hsv_strips)
+    pixels = hsv_strips.reshape(count, -1, 3)
+    # Per-frame background color, compared per pixel
+    background = np.median(pixels, axis=1).astype(np.int16)[:, None, :]
+    differs = ((hue_distance(pixels[..., 0], background[..., 0]) > AUTO_HUE_WINDOW)
+               | (np.abs(pixels[..., 1].astype(np.int16) - background[..., 1]) >= AUTO_MIN_SATURATION))
+    pixels = pixels[differs]
+    saturated = pixels[(pixels[:, 1] >= AUTO_MIN_SATURATION) & (pixels[:, 2] >= AUTO_MIN_VALUE)]
+    if len(saturated) < FIT_MIN_PIXELS:
+        return saturated[:0], None
+    histogram = np.bincount(saturated[:, 0], minlength=HUE_MAX + 1)[:HUE_MAX + 1]
+    # Smooth over +-2 hue steps (wrapping around), so a spread-out peak still wins
+    smoothed = sum(np.roll(histogram, shift) for shift in range(-2, 3))
+    peak = int(np.argmax(smoothed))
+    ball = saturated[hue_distance(saturated[:, 0], peak) <= AUTO_HUE_WINDOW]
+    if len(ball) > AUTO_MAX_FRACTION * hsv_strips[..., 0].size:
+        return ball[:0], peak
+    return ball, peak
+
+
+def seed_ball_pixels(hsv_frames, seed, radius=SEED_RADIUS):
+    """HSV pixels within `radius` of the clicked (x, y) in every frame."""
+    height, width = hsv_frames.shape[1:3]
+    x, y = seed
+    yy, xx = np.ogrid[:height, :width]
+    disk = (xx - x) ** 2 + (yy - y) ** 2 <= radius ** 2
+    return hsv_frames[:, disk].reshape(-1, 3)
+
+
+def fit_range(pixels):
+    """
+    (lower, upper) percentile bounds of (n, 3) HSV pixels, widened by FIT_MARGIN.
+    Raises ValueError if the hues wrap around 0/179: fitted again with hue
+    rotated by half the wheel, their spread is narrower than fitted as is.
+    """
+    low, high = np.percentile(pixels, FIT_PERCENTILES, axis=0)
+    rotated = (pixels[:, 0].astype(np.int16) + (HUE_MAX + 1) // 2) % (HUE_MAX + 1)
+    rotated_low, rotated_high = np.percentile(rotated, FIT_PERCENTILES)
+    if rotated_high - rotated_low < high[0] - low[0]:
+        raise ValueError(f"hues wrap around 0/{HUE_MAX}")
+    margin = np.array(FIT_MARGIN)
+    lower = np.clip(np.floor(low) - margin, 0, None).astype(np.int32)
+    upper = np.minimum(np.ceil(high) + margin, [HUE_MAX, 255, 255]).astype(np.int32)
+    return lower, upper
+
+
+def fit_hsv_ranges(frames, roi_strips=None, seeds=None, base=DEFAULT_HSV_RANGES):
+    """
+    Fit HSV ranges to a burst of BGR frames (all in the orientation `roi_strips`
+    and `seeds` are given in). seeds {label: (x, y)} override the automatic
+    search for those colors. Colors without enough ball pixels keep their
+    range from `base`. Returns (hsv_ranges, report {label: {...}}).
+    """
+    roi_strips = roi_strips or DEFAULT_ROI_STRIPS
+    seeds = seeds or {}
+    hsv_frames = np.stack([preprocess(frame) for frame in frames])
+    hsv_ranges, report = {}, {}
+    for label, settings in base.items():
+        if label in seeds:
+            pixels, peak, source = seed_ball_pixels(hsv_frames, seeds[label]), None, "seed"
+        else:
+            x0, x1 = roi_strips[label]
+            pixels, peak = strip_ball_pixels(hsv_frames[:, :, x0:x1])
+            source = "auto"
+        fitted = dict(settings)
+        if len(pixels) >= FIT_MIN_PIXELS:
+            try:
+                fitted["lower"], fitted["upper"] = fit_range(pixels)
+            except ValueError:
+                source = "wraps"
+        else:
+            source = "unchanged"
+        hsv_ranges[label] = fitted
+        report[label] = {"source": source, "pixels": int(len(pixels)), "hue_peak": peak,
+                         "lower": fitted["lower"].tolist(), "upper": fitted["upper"].tolist()}
+    return hsv_ranges, report
+
+
+def detection_rate(frames, hsv_ranges, roi_strips, mode="roi"):
+    """Fraction of `frames` in which each color is found with `hsv_ranges`."""
+    from engine import DetectionEngine
+    engine = DetectionEngine(hsv_ranges, roi_strips, mode, tracking=False)
+    found = dict.fromkeys(engine.labels, 0)
+    for frame in frames:
+        for label, pos in engine.process(frame, 0.0)["positions"].items():
+            found[label] += pos is not None
+    return {label: count / max(len(frames), 1) for label, count in found.items()}
+
+
+def capture_burst(source, count=AUTO_BURST_FRAMES):
+    frames = []
+    while len(frames) < count:
+        frame = source.read()
+        if frame is None:
+            break
+        frames.append(frame)
+    return frames
+
+
+def print_fit_report(report, rates=None):
+    for label, fit in report.items():
+        rate = f"  detected in {rates[label]:.0%} of frames" if rates else ""
+        print(f"  {label:7s} {fit['source']:9s} {fit['pixels']:7d} px  "
+              f"lower {fit['lower']}  upper {fit['upper']}{rate}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage HSV calibration profiles.")
+    parser.add_argument("command", choices=("list", "activate", "import", "auto", "bench"))
+    parser.add_argument("name", nargs="?",
+                        help="lighting profile (activate), HSV file (import) or frame source (auto)")
+    parser.add_argument("--dir", default=CALIBRATION_DIR)
+    parser.add_argument("--device", default=CALIBRATION_DEVICE)
+    parser.add_argument("--lighting", default=DEFAULT_LIGHTING, help="profile name for import and auto")
+    parser.add_argument("--frames", type=int, default=AUTO_BURST_FRAMES, help="burst length for auto")
+    parser.add_argument("--dry-run", action="store_true", help="auto: fit and report, but do not save")
+    args = parser.parse_args()
+    store = ProfileStore(args.dir, args.device)
+
+    if args.command == "list":
+        active = store.active()
+        for lighting in store.lightings():
+            versions = store.versions(lighting)
+            print(f"{'*' if lighting == active else ' '} {lighting:20s} v{versions[-1]} ({len(versions)} versions)")
+    elif args.command == "activate":
+        store.set_active(args.name)
+        print(f"Active calibration profile: {args.device}/{args.name}")
+    elif args.command == "import":
+        version = store.save(load_hsv_ranges(args.name or HSV_FILE), args.lighting)
+        print(f"Saved {args.device}/{args.lighting} v{version}")
+    elif args.command == "auto":
+        from camera import open_frame_source
+        source = open_frame_source(args.name or "camera")
+        try:
+            start = time.perf_counter()
+            frames = capture_burst(source, args.frames)
+            captured = time.perf_counter() - start
+            # Fit in camera orientation: mirror the (display) strips instead of every frame
+            strips = load_roi_strips(ROI_FILE)
+            if source.mirrored:
+                strips = {label: mirror_strip(strip) for label, strip in strips.items()}
+            current = store.load(args.lighting)
+            start = time.perf_counter()
+            hsv_ranges, report = fit_hsv_ranges(frames, strips, base=current.hsv_ranges if current else
+                                                DEFAULT_HSV_RANGES)
+            fitted = time.perf_counter() - start
+        finally:
+            source.close()
+        print(f"Captured {len(frames)} frames in {captured:.2f} s, fitted in {fitted * 1000:.0f} ms")
+        print_fit_report(report, detection_rate(frames, hsv_ranges, strips))
+        if not args.dry_run:
+            version = store.save(hsv_ranges, args.lighting)
+            print(f"Saved {args.device}/{args.lighting} v{version}")
+    else:
+        # Compile cost vs. switching between already loaded profiles
+        from engine import DetectionEngine
+        from detection import DEFAULT_ROI_STRIPS
+        start = time.perf_counter()
+        profiles = [CalibrationProfile(DEFAULT_HSV_RANGES, f"bench-{i}") for i in range(20)]
+        compile_ms = (time.perf_counter() - start) * 1000 / len(profiles)
+        engine = DetectionEngine(DEFAULT_HSV_RANGES, DEFAULT_ROI_STRIPS)
+        count = 100000
+        start = time.perf_counter()
+        for i in range(count):
+            engine.set_profile(profiles[i % len(profiles)])
+        switch_us = (time.perf_counter() - start) * 1e6 / count
+        print(f"compile {compile_ms:.2f} ms per profile, switch {switch_us:.2f} us")
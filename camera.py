@@ -0,0 +1,249 @@
+import time
+
+import cv2
+import numpy as np
+
+# =============================================================================
+# Frame Sources
+# =============================================================================
+# Every source returns BGR frames already cut to the detection window
+# (CROP_HEIGHT x CROP_WIDTH). The historical pipeline captured 640x480, flipped
+# the whole frame for a mirror effect and sliced frame[0:352, 116:430]. Sources
+# now skip the flip: a source whose frames are in camera orientation sets
+# `mirrored = True`, and callers mirror x coordinates (see mirror_x) instead
+# of copying the image. Only x changes; ball Y is unaffected.
+
+PREVIEW_SIZE = (640, 480)
+CROP_TOP, CROP_BOTTOM = 0, 352
+CROP_LEFT, CROP_RIGHT = 116, 430           # in the mirrored 640x480 preview
+CROP_WIDTH = CROP_RIGHT - CROP_LEFT         # 314
+CROP_HEIGHT = CROP_BOTTOM - CROP_TOP        # 352
+
+# The same window in camera (unmirrored) orientation: columns 210..523
+RAW_CROP_LEFT = PREVIEW_SIZE[0] - CROP_RIGHT
+RAW_CROP_RIGHT = PREVIEW_SIZE[0] - CROP_LEFT
+
+# The ISP output width must be aligned, so the sensor crop is widened to this
+# width and the extra columns are sliced off (as a view) after capture.
+ISP_CROP_WIDTH = 320
+
+
+def mirror_x(x, width=CROP_WIDTH):
+    return width - 1 - x
+
+
+def mirror_strip(strip, width=CROP_WIDTH):
+    x0, x1 = strip
+    return (width - x1, width - x0)
+
+
+class FrameSource:
+    """Base class: read() returns one detection-sized BGR frame, or None."""
+    mirrored = False
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PicameraSource(FrameSource):
+    """
+    Picamera2 capture.
+      mode="isp_crop" - ScalerCrop asks the ISP for just the detection window,
+                        delivered 1:1 at detection size (default)
+      mode="full"     - legacy 640x480 preview, cropped by slicing (no copy)
+    fmt is the Picamera2 pixel format: "RGB888" (BGR in memory) or a 32-bit
+    "XBGR8888"/"XRGB8888" format, whose padding byte is dropped on read.
+    """
+    mirrored = True
+
+    def __init__(self, mode="isp_crop", fmt="RGB888", camera_num=0):
+        from picamera2 import Picamera2
+
+        self.mode = mode
+        self.fmt = fmt
+        self.picam2 = Picamera2(camera_num)
+        try:
+            if mode == "isp_crop":
+                size = (ISP_CROP_WIDTH, CROP_HEIGHT)
+            else:
+                size = PREVIEW_SIZE
+            config = self.picam2.create_preview_configuration(main={"size": size, "format": fmt})
+            self.picam2.configure(config)
+            if mode == "isp_crop":
+                self.picam2.set_controls({"ScalerCrop": self._sensor_crop()})
+                pad = (ISP_CROP_WIDTH - CROP_WIDTH) // 2
+                self._window = (slice(0, CROP_HEIGHT), slice(pad, pad + CROP_WIDTH))
+            else:
+                self._window = (slice(CROP_TOP, CROP_BOTTOM), slice(RAW_CROP_LEFT, RAW_CROP_RIGHT))
+            self.picam2.start()
+        except Exception:
+            self.picam2.close()
+            raise
+
+    def _sensor_crop(self):
+        """
+        Sensor rectangle that the detection window covers in the 640x480 preview.
+        The preview uses the default ScalerCrop, so preview pixels scale linearly
+        onto it.
+        """
+        _, _, (fx, fy, fw, fh) = self.picam2.camera_controls["ScalerCrop"]
+        scale_x = fw / PREVIEW_SIZE[0]
+        scale_y = fh / PREVIEW_SIZE[1]
+        pad = (ISP_CROP_WIDTH - CROP_WIDTH) // 2
+        left = RAW_CROP_LEFT - pad
+        return (int(fx + left * scale_x), int(fy + CROP_TOP * scale_y),
+                int(ISP_CROP_WIDTH * scale_x), int(CROP_HEIGHT * scale_y))
+
+    def read(self):
+        frame = self.picam2.capture_array()
+        if frame is None:
+            return None
+        frame = frame[self._window]
+        if frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        return frame
+
+    def close(self):
+        self.picam2.stop()
+        self.picam2.close()
+
+
+class VideoFileSource(FrameSource):
+    """
+    Frames from a recorded video. Frames larger than the detection window are
+    cropped like the legacy preview (set mirrored=True for raw camera recordings).
+    """
+    def __init__(self, path, loop=False, mirrored=False, fps=None):
+        self.path = path
+        self.loop = loop
+        self.mirrored = mirrored
+        self.interval = 1.0 / fps if fps else 0
+        self._next = 0
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError(f"Could not open video {path}")
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        if not ok:
+            return None
+        _pace(self)
+        if frame.shape[:2] != (CROP_HEIGHT, CROP_WIDTH):
+            left = RAW_CROP_LEFT if self.mirrored else CROP_LEFT
+            frame = frame[CROP_TOP:CROP_BOTTOM, left:left + CROP_WIDTH]
+        return frame
+
+    def close(self):
+        self.capture.release()
+
+
+class RecordingSource(FrameSource):
+    """Frames from a recording.py .npy recording, read through its memory map."""
+    def __init__(self, path, loop=False, fps=None):
+        from recording import Recording
+
+        self.recording = Recording(path)
+        self.loop = loop
+        self.mirrored = self.recording.mirrored
+        fps = fps or self.recording.fps
+        self.interval = 1.0 / fps if fps else 0
+        self._next = 0
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.recording):
+            if not self.loop or not len(self.recording):
+                return None
+            self.index = 0
+        _pace(self)
+        frame = np.array(self.recording.frames[self.index])
+        self.index += 1
+        return frame
+
+
+# Synthetic spirometer: (ball center x in the cropped frame, BGR color) per tube
+SYNTHETIC_TUBES = {
+    "Blue":   (70, (200, 90, 20)),
+    "Orange": (157, (20, 120, 250)),
+    "Green":  (244, (40, 170, 30)),
+}
+SYNTHETIC_BALL_RADIUS = 16
+SYNTHETIC_TUBE_HALF_WIDTH = 25
+
+
+def synthetic_ball_y(index, phase):
+    """Ground-truth ball Y of the synthetic generator for frame `index`."""
+    travel = CROP_HEIGHT - 2 * SYNTHETIC_BALL_RADIUS - 2
+    return int(CROP_HEIGHT - SYNTHETIC_BALL_RADIUS - 1 - travel * (0.5 + 0.5 * np.sin(index / 15.0 + phase)))
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generated frames with three balls bobbing in their tubes over a noisy gray
+    background, in display orientation. For benchmarks on machines without a camera.
+    """
+    def __init__(self, count=None, fps=None, seed=0):
+        self.count = count
+        self.interval = 1.0 / fps if fps else 0
+        self._next = 0
+        self.index = 0
+        self.rng = np.random.default_rng(seed)
+        self.background = np.full((CROP_HEIGHT, CROP_WIDTH, 3), 90, np.uint8)
+        for x, _ in SYNTHETIC_TUBES.values():
+            cv2.rectangle(self.background, (x - SYNTHETIC_TUBE_HALF_WIDTH, 0),
+                          (x + SYNTHETIC_TUBE_HALF_WIDTH, CROP_HEIGHT - 1), (170, 170, 170), 2)
+
+    def ball_positions(self, index):
+        return {label: (x, synthetic_ball_y(index, phase))
+                for phase, (label, (x, _)) in enumerate(SYNTHETIC_TUBES.items())}
+
+    def read(self):
+        if self.count is not None and self.index >= self.count:
+            return None
+        _pace(self)
+        frame = self.background.copy()
+        for label, (x, y) in self.ball_positions(self.index).items():
+            cv2.circle(frame, (x, y), SYNTHETIC_BALL_RADIUS, SYNTHETIC_TUBES[label][1], -1)
+        noise = self.rng.integers(-12, 13, frame.shape, dtype=np.int16)
+        self.index += 1
+        return np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def _pace(source):
+    """Block until the source's next frame is due (no-op when fps is unset)."""
+    if not source.interval:
+        return
+    now = time.monotonic()
+    if source._next > now:
+        time.sleep(source._next - now)
+    source._next = max(now, source._next) + source.interval
+
+
+def open_frame_source(spec="camera"):
+    """
+    Build a frame source from a short description:
+      "camera" / "camera:full" / "camera:isp_crop"  - Picamera2
+      "video:<path>"                                - recorded video (looped)
+      "recording:<path>"                            - recording.py .npy file (looped)
+      "synthetic"                                   - generated frames at 30 fps
+    A camera number can be appended for devices with several, e.g. "camera@1";
+    for "synthetic" it selects a different noise seed.
+    """
+    spec, _, number = spec.partition("@")
+    number = int(number or 0)
+    kind, _, arg = spec.partition(":")
+    if kind == "camera":
+        return PicameraSource(mode=arg or "isp_crop", camera_num=number)
+    if kind == "video":
+        return VideoFileSource(arg, loop=True, fps=30)
+    if kind == "recording":
+        return RecordingSource(arg, loop=True, fps=30)
+    if kind == "synthetic":
+        return SyntheticSource(fps=30, seed=number)
+    raise ValueError(f"Unknown frame source: {spec}")
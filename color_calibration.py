@@ -1,17 +1,21 @@
+import sys
 import cv2
 import numpy as np
-from picamera2 import Picamera2
+from camera import open_frame_source
+from calibration import (AUTO_BURST_FRAMES, ProfileStore, capture_burst, detection_rate, fit_hsv_ranges,
+                         print_fit_report)
+from detection import load_roi_strips, save_hsv_ranges, save_roi_strips
 
 def nothing(x):
     pass
 
-# Initialize camera
-picam2 = Picamera2()
-preview_config = picam2.create_preview_configuration(
-    main={"size": (640, 480), "format": "RGB888"}
-)
-picam2.configure(preview_config)
-picam2.start()
+# Initialize camera (or another frame source, e.g. "video:session.mp4")
+camera = open_frame_source(sys.argv[1] if len(sys.argv) > 1 else "camera")
+
+# Saved values become a new version of this device's calibration profile for
+# the given lighting condition (the active one by default), see calibration.py
+profiles = ProfileStore()
+lighting = sys.argv[2] if len(sys.argv) > 2 else profiles.active()
 
 # Create windows for each color
 cv2.namedWindow('Original')
@@ -43,9 +47,57 @@ cv2.createTrackbar('S max', 'Green Ball', 255, 255, nothing)
 cv2.createTrackbar('V min', 'Green Ball', 0, 255, nothing)
 cv2.createTrackbar('V max', 'Green Ball', 255, 255, nothing)
 
+# Create trackbars for each ball's tube (column strip of the cropped frame)
+roi_strips = load_roi_strips()
+for label in ('Blue', 'Orange', 'Green'):
+    cv2.createTrackbar('ROI x0', f'{label} Ball', roi_strips[label][0], 314, nothing)
+    cv2.createTrackbar('ROI x1', f'{label} Ball', roi_strips[label][1], 314, nothing)
+
+def set_trackbars(hsv_ranges):
+    for label, settings in hsv_ranges.items():
+        for channel, name in enumerate('HSV'):
+            cv2.setTrackbarPos(f'{name} min', f'{label} Ball', int(settings['lower'][channel]))
+            cv2.setTrackbarPos(f'{name} max', f'{label} Ball', int(settings['upper'][channel]))
+
+
+def save_calibration(hsv_ranges):
+    # Save to HSV.data (as before) and as a new profile version; a
+    # running application picks the profile up without restarting.
+    save_hsv_ranges(hsv_ranges)
+    print("\nHSV values saved to HSV.data!")
+    try:
+        version = profiles.save(hsv_ranges, lighting)
+        print(f"Saved as calibration profile {profiles.device}/{lighting} v{version}")
+    except (OSError, ValueError) as e:
+        print("Could not save calibration profile:", e)
+
+    print("\nTube strips (x0, x1):", roi_strips)
+    save_roi_strips(roi_strips)
+    print("Tube strips saved to ROI.data!")
+
+
+# Automatic calibration: optionally click each ball in 'Original' (right-click
+# forgets the clicks), then press 'a'. Colors not clicked are found in their tube.
+seeds = {}
+
+def on_click(event, x, y, flags, param):
+    if event == cv2.EVENT_LBUTTONDOWN:
+        for label, (x0, x1) in roi_strips.items():
+            if x0 <= x < x1:
+                seeds[label] = (x, y)
+                print(f"{label} ball at ({x}, {y})")
+    elif event == cv2.EVENT_RBUTTONDOWN:
+        seeds.clear()
+        print("Ball clicks cleared")
+
+cv2.setMouseCallback('Original', on_click)
+
 print("Instructions:")
 print("1. Adjust the trackbars to get the best detection for each ball")
 print("2. Show one ball at a time and adjust its values")
+print("   Set 'ROI x0'/'ROI x1' so each ball's tube lies between the two lines")
+print("   Or press 'a' to fit all three from a short burst of frames (clicking")
+print("   a ball first tells the fit where it is)")
 print("3. Press 's' to save the values")
 print("4. Press 'q' to quit")
 print("\nCurrent values will be displayed in the terminal")
@@ -53,11 +105,11 @@ print("\nCurrent values will be displayed in the terminal")
 try:
     while True:
         # Capture frame
-        frame = picam2.capture_array()
-        frame = cv2.flip(frame, 1)  # Mirror effect
-        
-        # Crop frame to match the main application
-        cropped_frame = frame[0:352, 116:430]
+        # Frames arrive cropped to match the main application
+        frame = camera.read()
+        if frame is None:
+            break
+        cropped_frame = cv2.flip(frame, 1) if camera.mirrored else frame  # Mirror effect
         
         # Convert to HSV
         blurred = cv2.GaussianBlur(cropped_frame, (11, 11), 0)
@@ -105,15 +157,46 @@ try:
         green_mask = cv2.morphologyEx(green_mask, cv2.MORPH_OPEN, kernel, iterations=2)
         green_mask = cv2.morphologyEx(green_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
         
-        # Show the original and masked images
-        cv2.imshow('Original', cropped_frame)
+        # Restrict each mask to its tube, as the main application does
+        for label, mask in (('Blue', blue_mask), ('Orange', orange_mask), ('Green', green_mask)):
+            x0 = cv2.getTrackbarPos('ROI x0', f'{label} Ball')
+            x1 = cv2.getTrackbarPos('ROI x1', f'{label} Ball')
+            roi_strips[label] = (x0, x1)
+            mask[:, :x0] = 0
+            mask[:, x1:] = 0
+
+        # Show the original (with tube strips) and masked images
+        original = cropped_frame.copy()
+        for label, color in (('Blue', (255, 0, 0)), ('Orange', (0, 165, 255)), ('Green', (0, 255, 0))):
+            x0, x1 = roi_strips[label]
+            cv2.line(original, (x0, 0), (x0, original.shape[0] - 1), color, 1)
+            cv2.line(original, (x1, 0), (x1, original.shape[0] - 1), color, 1)
+        cv2.imshow('Original', original)
         cv2.imshow('Blue Ball', blue_mask)
         cv2.imshow('Orange Ball', orange_mask)
         cv2.imshow('Green Ball', green_mask)
         
+        hsv_ranges = {
+            'Blue': {'lower': np.array([blue_hmin, blue_smin, blue_vmin]),
+                     'upper': np.array([blue_hmax, blue_smax, blue_vmax])},
+            'Orange': {'lower': np.array([orange_hmin, orange_smin, orange_vmin]),
+                       'upper': np.array([orange_hmax, orange_smax, orange_vmax])},
+            'Green': {'lower': np.array([green_hmin, green_smin, green_vmin]),
+                      'upper': np.array([green_hmax, green_smax, green_vmax])},
+        }
+
         key = cv2.waitKey(1) & 0xFF
         if key == ord('q'):
             break
+        elif key == ord('a'):
+            # Fit from this frame plus a burst of the next ones, starting from the current values
+            burst = [cropped_frame] + [cv2.flip(f, 1) if camera.mirrored else f
+                                       for f in capture_burst(camera, AUTO_BURST_FRAMES - 1)]
+            hsv_ranges, report = fit_hsv_ranges(burst, roi_strips, seeds, base=hsv_ranges)
+            print(f"\nFitted HSV ranges from {len(burst)} frames:")
+            print_fit_report(report, detection_rate(burst, hsv_ranges, roi_strips))
+            set_trackbars(hsv_ranges)
+            save_calibration(hsv_ranges)
         elif key == ord('s'):
             # Save the values
             print("\nCurrent HSV Values:")
@@ -127,18 +210,9 @@ try:
             print(f"    'lower': np.array([{green_hmin}, {green_smin}, {green_vmin}]),")
             print(f"    'upper': np.array([{green_hmax}, {green_smax}, {green_vmax}])")
 
-            # Save to HSV.data using numpy savez
-            np.savez('HSV.data',
-                blue_lower=np.array([blue_hmin, blue_smin, blue_vmin]),
-                blue_upper=np.array([blue_hmax, blue_smax, blue_vmax]),
-                orange_lower=np.array([orange_hmin, orange_smin, orange_vmin]),
-                orange_upper=np.array([orange_hmax, orange_smax, orange_vmax]),
-                green_lower=np.array([green_hmin, green_smin, green_vmin]),
-                green_upper=np.array([green_hmax, green_smax, green_vmax])
-            )
-            print("\nHSV values saved to HSV.data!")
+            save_calibration(hsv_ranges)
             
 finally:
     # Cleanup
-    picam2.stop()
+    camera.close()
     cv2.destroyAllWindows() 
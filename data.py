@@ -1,18 +1,29 @@
 import cv2
-import numpy as np
 import tkinter as tk
 from tkinter import messagebox, ttk
-from PIL import Image, ImageTk
-from picamera2 import Picamera2
 from datetime import datetime
-import pandas as pd
 import os
 import sys
 import fcntl
 import atexit
-from openpyxl import load_workbook, Workbook
-from openpyxl.chart import BarChart, Reference
+import socket
 import time
+from pipeline import DetectionPipeline
+from scheduler import AdaptiveScheduler
+from telemetry import MetricsLogger, MetricsServer, Telemetry
+from camera import CROP_HEIGHT, CROP_WIDTH, open_frame_source
+from engine import DetectionEngine
+from calibration import CALIBRATION_DIR, ProfileStore, ProfileWatcher
+from session_store import EXCEL_PATH, SESSION_DB_PATH, SessionStore
+from sync_queue import SyncWorker
+from fleet_client import FleetClient, FleetTarget
+from live_stream import LivePublisher
+from patients import PatientIndex
+from detection import HSV_FILE, preprocess
+from mapping import DETECTION_Y_MAX, VALUE_RANGES, canvas_y
+from recording import FrameRecorder
+from timeseries import SessionSeries
+from render import CanvasRenderer, REFRESH_RATE
 
 # =============================================================================
 # Lock file handling
@@ -77,238 +88,346 @@ COLUMN_BOUNDS = {
     "Green":  (350, 400)
 }
 
-# Mapping ranges for displayed values:
+# Mapping ranges for displayed values (see mapping.py):
 # Blue:    top → 600, bottom → 0  
 # Orange:  top → 900, bottom → 600  
 # Green:   top → 1200, bottom → 900
-BLUE_MIN, BLUE_MAX = 0, 600
-ORANGE_MIN, ORANGE_MAX = 600, 900
-GREEN_MIN, GREEN_MAX = 900, 1200
-
-# HSV Ranges for Color Detection (adjust as needed)
-def load_hsv_ranges():
-    if os.path.exists('HSV.data'):
-        data = np.load('HSV.data')
-        return {
-            "Blue": {
-                "lower": data['blue_lower'],
-                "upper": data['blue_upper'],
-                "draw_color": (255, 0, 0)
-            },
-            "Orange": {
-                "lower": data['orange_lower'],
-                "upper": data['orange_upper'],
-                "draw_color": (0, 165, 255)
-            },
-            "Green": {
-                "lower": data['green_lower'],
-                "upper": data['green_upper'],
-                "draw_color": (0, 255, 0)
-            },
-        }
-    else:
-        return {
-            "Blue": {
-                "lower": np.array([94, 80, 2]),
-                "upper": np.array([126, 255, 255]),
-                "draw_color": (255, 0, 0)
-            },
-            "Orange": {
-                "lower": np.array([4, 100, 20]),
-                "upper": np.array([25, 255, 255]),
-                "draw_color": (0, 165, 255)
-            },
-            "Green": {
-                "lower": np.array([23, 42, 0]),
-                "upper": np.array([100, 255, 255]),
-                "draw_color": (0, 255, 0)
-            },
-        }
-
-HSV_RANGES = load_hsv_ranges()
-
-# Morphological operation kernel
-KERNEL = np.ones((5, 5), np.uint8)
-
-# Calibration for the cropped image:
-# The cropped camera view is 352 pixels tall.
-# In our setup, raw ball Y values never go below about 256,
-# so we force any raw ball Y below 256 to 256 so that our mapping uses the full column.
-DETECTION_Y_MIN = 256
-DETECTION_Y_MAX = 352
+BLUE_MIN, BLUE_MAX = VALUE_RANGES["Blue"]
+ORANGE_MIN, ORANGE_MAX = VALUE_RANGES["Orange"]
+GREEN_MIN, GREEN_MAX = VALUE_RANGES["Green"]
+
+# Ball detection method (see detection.py and engine.py):
+#   "roi"       - each color searched only in its own tube strip (ROI.data)
+#   "pyramid"   - like "roi", but balls are found on a 1/4 scale frame first and
+#                 only a small full-resolution patch around each is segmented
+#   "fused"     - one lookup-table classification + one morphology pass for all colors
+#   "per_color" - separate inRange + morphology + contour search per color
+# The HSV ranges come from this device's active calibration profile (see
+# calibration.py; an existing HSV.data is imported as the first one) and are
+# reloaded while running when the profile changes. The tube strips (ROI.data)
+# written by color_calibration.py are loaded when the therapy view is created.
+DETECTION_MODE = "roi"
+
+# Where frames come from (see camera.open_frame_source): "camera" captures only the
+# detection window via the ISP, "camera:full" is the old 640x480 capture + slice,
+# "video:<path>" / "synthetic" run without a camera.
+FRAME_SOURCE = os.environ.get("RT_FRAME_SOURCE", "camera")
+
+# Smooth ball positions over time and, in "roi"/"pyramid" mode, only search the rows
+# around each ball's predicted position (see tracking.py).
+TRACKING_ENABLED = True
+
+# Drop to a low frame rate with a cheap motion check while no ball is moving,
+# and back to full-rate detection as soon as one moves (see scheduler.py).
+ADAPTIVE_FRAME_RATE = True
+
+# Frames from sessions are recorded to this directory (see recording.py) when
+# RT_RECORD_DIR is set, one <card>_<time>.npy file per session.
+RECORD_DIR = os.environ.get("RT_RECORD_DIR")
+
+# Every displayed detection result of a session is written here as
+# <card>_<time>.npz when the session ends (see timeseries.py).
+SERIES_DIR = os.environ.get("RT_SERIES_DIR", "/home/pi/sessions")
+
+# Fleet service (see fleet_server.py): when RT_FLEET_URL is set, saved sessions
+# are also uploaded there, tagged with this device's id and ward.
+FLEET_URL = os.environ.get("RT_FLEET_URL")
+DEVICE_ID = os.environ.get("RT_DEVICE_ID") or socket.gethostname()
+WARD = os.environ.get("RT_WARD")
+
+# Live dashboard (see live_stream.py / live_server.py): when RT_LIVE_URL is set
+# (e.g. ws://dashboard.local:8700), the readings of a running session are
+# streamed there as they are displayed.
+LIVE_URL = os.environ.get("RT_LIVE_URL")
+
+# How often the confirmation window checks whether the session has been saved
+SAVE_POLL_INTERVAL_MS = 20
+
+# Detection runs on a background pipeline; the Tk thread polls for the newest
+# result at this interval and prints pipeline statistics every STATS_LOG_INTERVAL seconds.
+# The indicators are redrawn at most DISPLAY_REFRESH_RATE times per second,
+# and only the items that changed (see render.py).
+POLL_INTERVAL_MS = 10
+DISPLAY_REFRESH_RATE = int(os.environ.get("RT_REFRESH_RATE", REFRESH_RATE))
+STATS_LOG_INTERVAL = 10
+
+# Debug: show the HSV image and green mask in OpenCV windows (RT_DEBUG_WINDOWS=1).
+# Off by default: drawing them costs an extra HSV conversion and imshow per frame.
+SHOW_DEBUG_WINDOWS = os.environ.get("RT_DEBUG_WINDOWS") == "1"
+
+# Telemetry (see telemetry.py). Frame counts and pipeline latencies are always
+# kept; RT_TELEMETRY=1 adds per-stage detection timers and publishes snapshots
+# at http://127.0.0.1:METRICS_PORT/metrics and, if RT_METRICS_LOG is set, as
+# JSON lines appended to that file.
+TELEMETRY_ENABLED = os.environ.get("RT_TELEMETRY") == "1"
+METRICS_PORT = int(os.environ.get("RT_METRICS_PORT", "9100"))
+METRICS_LOG = os.environ.get("RT_METRICS_LOG")
+TELEMETRY = Telemetry(detailed=TELEMETRY_ENABLED)
 
 # =============================================================================
-# RFID Reader Window Class
+# Session saving
 # =============================================================================
-def write_to_excel(data, is_header=False):
-    gdrive_path = "/home/pi/googledrive/data.xlsx"
-    temp_path = "/home/pi/temp_data.xlsx"
-    
-    try:
-        # First, copy existing file from Google Drive to local storage if it exists
-        if os.path.exists(gdrive_path):
-            import shutil
-            shutil.copy2(gdrive_path, temp_path)
-            
-            # Open the temporary file and append data
-            book = load_workbook(temp_path)
-            sheet1 = book['Sheet1']
-            
-            # Create new row as a list
-            if len(data) == 1:  # Card ID only
-                new_row = [data[0]]
-            else:  # Full data row
-                new_row = [data[0], data[1], data[2], data[3], data[4]]
-            
-            # Append to Sheet1
-            sheet1.append(new_row)
-            
-            # Save temporary file
-            book.save(temp_path)
-        else:
-            # Create new workbook with two sheets
-            book = Workbook()
-            
-            # Set up Sheet1 for data
-            sheet1 = book.active
-            sheet1.title = 'Sheet1'
-            
-            # Add headers to Sheet1
-            if len(data) == 1:
-                headers = ['Card ID']
-                new_row = [data[0]]
-            else:
-                headers = ['Card ID', 'Timestamp', 'Blue Value', 'Orange Value', 'Green Value']
-                new_row = [data[0], data[1], data[2], data[3], data[4]]
-            
-            sheet1.append(headers)
-            sheet1.append(new_row)
-            
-            # Create Sheet2 for manual modifications
-            sheet2 = book.create_sheet('Sheet2')
-            
-            # Add column chart to Sheet1
-            chart = BarChart()
-            chart.type = "col"
-            chart.style = 10  # Use a nice style
-            chart.title = "Values Over Time"
-            chart.x_axis.title = "Timestamp"
-            chart.y_axis.title = "Values"
-            
-            # Create data references for the chart
-            # Categories (X-axis) - Timestamp column (B1:B25)
-            cats = Reference(sheet1, min_col=2, min_row=1, max_row=25)
-            
-            # Values (Series) - Blue, Orange, and Green values (C1:E25)
-            values = Reference(sheet1, min_col=3, max_col=5, min_row=1, max_row=25)
-            
-            # Add the data to the chart
-            chart.add_data(values, titles_from_data=True)  # Use first row as series names
-            chart.set_categories(cats)
-            
-            # Add the chart to the worksheet
-            sheet1.add_chart(chart, "G2")  # Position the chart at cell G2
-            
-            # Save as temporary file first
-            book.save(temp_path)
-        
-        # Now copy the temporary file back to Google Drive
-        import shutil
-        if os.path.exists(temp_path):
-            shutil.copy2(temp_path, gdrive_path)
-            os.remove(temp_path)  # Clean up temp file
-            
-        return True
-        
-    except Exception as e:
-        # Clean up on error
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
-        messagebox.showerror("File Error", f"Could not save data:\n{e}")
-        return False
+def get_session_store():
+    """The local session store, opened on first use (see session_store.py)."""
+    global session_store
+    if 'session_store' not in globals():
+        session_store = SessionStore(SESSION_DB_PATH)
+        # Carry over the history of an existing spreadsheet the first time.
+        try:
+            imported = session_store.import_excel(EXCEL_PATH)
+            if imported:
+                print(f"Imported {imported} sessions from {EXCEL_PATH}")
+        except Exception as e:
+            print("Could not import existing Excel data:", e)
+    return session_store
+
+def get_patient_index():
+    """Cached per-patient history, looked up when a card is scanned (see patients.py)."""
+    global patient_index
+    if 'patient_index' not in globals():
+        patient_index = PatientIndex(get_session_store())
+    return patient_index
+
+def get_sync_worker():
+    """Background worker that copies saved sessions to the Drive mount (see sync_queue.py)."""
+    global sync_worker
+    if 'sync_worker' not in globals():
+        sync_worker = SyncWorker(get_session_store())
+        sync_worker.start()
+    return sync_worker
+
+def get_fleet_worker():
+    """Background worker uploading saved sessions to the fleet service, or None if not configured."""
+    global fleet_worker
+    if 'fleet_worker' not in globals():
+        fleet_worker = None
+        if FLEET_URL:
+            client = FleetClient(FLEET_URL, DEVICE_ID, WARD)
+            fleet_worker = SyncWorker(get_session_store(), target=FleetTarget(client), name="fleet-sync")
+            fleet_worker.start()
+    return fleet_worker
+
+def get_live_publisher():
+    """Background publisher of live readings to the dashboard hub, or None if not configured."""
+    global live_publisher
+    if 'live_publisher' not in globals():
+        live_publisher = None
+        if LIVE_URL:
+            live_publisher = LivePublisher(LIVE_URL, DEVICE_ID, labels=tuple(VALUE_RANGES))
+            live_publisher.start()
+    return live_publisher
+
+def save_session(data):
+    """
+    Commit a completed session locally and queue it for the Drive sync (and
+    the fleet service, if configured). Returns a Future that resolves once the
+    row is stored on the device; sync failures are retried in the background
+    and never surface here.
+    """
+    future = get_sync_worker().submit(data)
+    fleet = get_fleet_worker()
+    if fleet:
+        future.add_done_callback(lambda f: fleet.notify())
+    return future
 
+# =============================================================================
+# RFID Reader Window Class
+# =============================================================================
 class RFIDReaderWindow:
-    def __init__(self, root):
+    """Card scan view, shown in the shared root between therapy sessions."""
+    def __init__(self, root, on_scan):
         self.root = root
-        self.root.title("RFID Card Reader")
-        self.root.configure(bg=BACKGROUND_COLOR)
-        self.root.geometry("400x150")
-        self.label = tk.Label(root, text="Please scan your RFID card:", font=(FONT_NAME, 16),
+        self.on_scan = on_scan  # called with the card number
+        self.view = tk.Frame(root, bg=BACKGROUND_COLOR)
+        self.label = tk.Label(self.view, text="Please scan your RFID card:", font=(FONT_NAME, 16),
                               bg=BACKGROUND_COLOR, fg=TEXT_COLOR)
         self.label.pack(pady=20)
-        self.entry = tk.Entry(root, font=(FONT_NAME, 16))
+        self.entry = tk.Entry(self.view, font=(FONT_NAME, 16))
         self.entry.pack(pady=10)
-        self.entry.focus_set()
         self.entry.bind("<Return>", self.process_rfid)
+
+    def show(self):
+        self.root.title("RFID Card Reader")
+        self.root.attributes("-fullscreen", False)
+        self.root.geometry("400x150")
+        self.entry.delete(0, tk.END)
+        self.view.pack(fill="both", expand=True)
+        self.entry.focus_set()
+
+    def hide(self):
+        self.view.pack_forget()
         
     def process_rfid(self, event):
         card_number = self.entry.get().strip()
         if card_number:
-            self.root.destroy()
-            main_root = tk.Tk()
-            app = RespiratoryTherapyApp(main_root, card_number)
-            main_root.mainloop()
+            self.on_scan(card_number)
 
 # =============================================================================
 # Main Application Class: Real-Time Ball Detection Indicators
 # =============================================================================
 class RespiratoryTherapyApp:
-    def __init__(self, root, card_id):
+    """
+    Therapy view. Built once and reused for every patient: the camera and the
+    capture/detection pipeline stay open between sessions and the pipeline is
+    only paused while the card reader is shown.
+    """
+    def __init__(self, root, on_finished):
         self.root = root
-        self.card_id = card_id  # RFID card number passed from RFIDReaderWindow
-        self.root.title("Respiratory Therapy Device")
-        self.root.configure(bg=BACKGROUND_COLOR)
-        # Set the main window to full screen
-        self.root.attributes("-fullscreen", True)
-
-        # Add running flag for safe shutdown
-        self.running = True
+        self.on_finished = on_finished  # called when a session has been saved
+        self.card_id = None  # RFID card number of the current session
+        self.running = False
 
+        # Headless detector: HSV ranges, tube strips, tracker and value mapping
+        self.engine = DetectionEngine.from_files(mode=DETECTION_MODE, tracking=TRACKING_ENABLED,
+                                                 debug_label="Green" if SHOW_DEBUG_WINDOWS else None)
+        # Calibration profile in use, hot-reloaded when it is switched or recalibrated
+        self.profiles = ProfileStore(CALIBRATION_DIR, DEVICE_ID)
+        try:
+            self.profiles.import_legacy(HSV_FILE)
+        except OSError as e:
+            print("Could not import HSV calibration:", e)
+        self.profile_watcher = ProfileWatcher(self.profiles, self.engine.set_profile)
+        try:
+            self.profile_watcher.check()
+        except Exception as e:
+            print("Could not load calibration profile, using HSV.data:", e)
+        self.profile_watcher.start()
+        TELEMETRY.add_source("calibration", self.profile_watcher.status)
         # Dictionary to store detected ball positions (per color)
-        self.ball_positions = {key: None for key in HSV_RANGES.keys()}
+        self.ball_positions = {key: None for key in self.engine.labels}
+        # Vertical ball speed per color in cropped-frame pixels/second (when tracking)
+        self.ball_velocities = {key: None for key in self.engine.labels}
+        # Colors whose position is held over missed detections (not a measured reading)
+        self.ball_bridged = {key: False for key in self.engine.labels}
+        # Time series of the current session; the buffers are reused for every session
+        self.series = SessionSeries(self.engine.labels)
         self.last_frame_height = DETECTION_Y_MAX
 
         # Flag to prevent multiple confirmation windows per event.
         self.confirmation_shown = False
-        
-        # Initialize camera
-        self.init_camera()
-        
-        if not self.picam2:
-            messagebox.showerror("Error", "Could not initialize camera. Please restart the application.")
-            self.on_closing()
-            return
 
+        # Card scan -> first live frame timing for the current session
+        self.session_started_at = None
+        self.scan_to_frame = None
+        self.poll_job = None
+        self.recorder = None
+
+        self.view = tk.Frame(self.root, bg=BACKGROUND_COLOR)
         self.setup_header()
         self.setup_main_panel()
 
-        self.root.after(0, self.update_frame)
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        # Initialize camera; retried at the next card scan if it fails now.
+        self.camera = None
+        self.pipeline = None
+        self.init_camera()
+        self.last_stats_log = time.monotonic()
 
     def init_camera(self):
-        try:
-            self.picam2 = Picamera2()
-            preview_config = self.picam2.create_preview_configuration(
-                main={"size": (640, 480), "format": "RGB888"}
-            )
-            self.picam2.configure(preview_config)
-            self.picam2.start()
+        if self.camera is not None:
             return True
+        try:
+            self.camera = open_frame_source(FRAME_SOURCE)
         except Exception as e:
             print("Error initializing camera:", e)
-            self.picam2 = None
+            self.camera = None
+            return False
+        self.engine.set_mirrored(self.camera.mirrored)
+        self.scheduler = AdaptiveScheduler(self.engine.roi_strips) if ADAPTIVE_FRAME_RATE else None
+        if self.scheduler is not None:
+            TELEMETRY.add_source("scheduler", self.scheduler.status)
+        # Capture and detection run off the Tk thread; we only poll results.
+        # Paused until a session starts.
+        self.pipeline = DetectionPipeline(self.camera.read, self.detect_positions, telemetry=TELEMETRY,
+                                          scheduler=self.scheduler)
+        self.pipeline.pause()
+        self.pipeline.start()
+        return True
+
+    def start_session(self, card_id, scanned_at):
+        """
+        Show the therapy view for a new patient. `scanned_at` is the
+        time.perf_counter() of the card scan, used to time the first live frame.
+        """
+        if not self.init_camera():
+            messagebox.showerror("Error", "Could not initialize camera. Please restart the application.")
             return False
+        self.card_id = card_id
+        self.ball_positions = {key: None for key in self.engine.labels}
+        self.ball_velocities = {key: None for key in self.engine.labels}
+        self.ball_bridged = {key: False for key in self.engine.labels}
+        self.engine.reset()
+        self.series.clear()
+        self.confirmation_shown = False
+        self.session_started_at = scanned_at
+        self.session_name = f"{card_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.show_patient_history(card_id)
+        self.scan_to_frame = None
+        if get_live_publisher():
+            get_live_publisher().start_session(card_id)
+        if RECORD_DIR:
+            self.start_recording()
+
+        self.root.title("Respiratory Therapy Device")
+        # Set the main window to full screen
+        self.root.attributes("-fullscreen", True)
+        self.view.pack(fill="both", expand=True)
+        self.update_ball_indicators()
+
+        self.running = True
+        self.pipeline.resume()
+        self.poll_job = self.root.after(0, self.poll_results)
+        return True
+
+    def end_session(self):
+        self.running = False
+        if self.poll_job is not None:
+            self.root.after_cancel(self.poll_job)
+            self.poll_job = None
+        if self.pipeline is not None:
+            self.pipeline.pause()
+        self.stop_recording()
+        self.save_series()
+        if get_live_publisher():
+            get_live_publisher().end_session()
+        self.view.pack_forget()
+
+    def save_series(self):
+        """Write the session's time series in one go and log its summary."""
+        if not len(self.series):
+            return
+        try:
+            os.makedirs(SERIES_DIR, exist_ok=True)
+            self.series.flush(os.path.join(SERIES_DIR, self.session_name + ".npz"), card_id=str(self.card_id))
+        except Exception as e:
+            print("Could not save session time series:", e)
+        for label, stats in self.series.summary().items():
+            print(f"{label}: peak {stats['peak']} at {stats['peak_time'] or 0:.1f} s, "
+                  f"effort {stats['effort_duration']:.1f} s, peak flow {stats['peak_flow']:.0f}/s")
+        self.series.clear()
+
+    def start_recording(self):
+        try:
+            os.makedirs(RECORD_DIR, exist_ok=True)
+            self.recorder = FrameRecorder(os.path.join(RECORD_DIR, self.session_name + ".npy"),
+                                          (CROP_HEIGHT, CROP_WIDTH, 3),
+                                          mirrored=self.camera.mirrored)
+        except Exception as e:
+            print("Could not start session recording:", e)
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
 
     # -------------------------------
     # GUI Setup for Main Application
     # -------------------------------
     def setup_header(self):
-        self.header_frame = tk.Frame(self.root, bg=BACKGROUND_COLOR, height=HEADER_HEIGHT)
+        self.header_frame = tk.Frame(self.view, bg=BACKGROUND_COLOR, height=HEADER_HEIGHT)
         self.header_frame.pack(side="top", fill="x", pady=(0, 5))
         self.header_frame.pack_propagate(False)
+        from PIL import Image, ImageTk
+
         try:
             logo_left = Image.open("qstss.png")
             logo_right = Image.open("moe.png")
@@ -324,9 +443,29 @@ class RespiratoryTherapyApp:
         tk.Label(self.header_frame, text="Respiratory Therapy Device", font=(FONT_NAME, 18, "bold"),
                  bg=BACKGROUND_COLOR, fg=TEXT_COLOR).pack(side="left", padx=10)
         tk.Label(self.header_frame, image=self.logo_right_img, bg=BACKGROUND_COLOR).pack(side="right", padx=5)
+        # Previous best and goal of the current patient
+        self.patient_label = tk.Label(self.header_frame, text="", font=(FONT_NAME, 10), justify="right",
+                                      bg=BACKGROUND_COLOR, fg=TEXT_COLOR)
+        self.patient_label.pack(side="right", padx=10)
+
+    def show_patient_history(self, card_id):
+        try:
+            history = get_patient_index().lookup(card_id)
+        except Exception as e:
+            print("Could not look up patient history:", e)
+            self.patient_label.config(text="")
+            return
+        if not history.sessions:
+            self.patient_label.config(text="First session")
+            return
+
+        def readings(values):
+            return " / ".join("-" if v is None else str(v) for v in values.values())
+
+        self.patient_label.config(text=f"Best: {readings(history.best)}\nGoal: {readings(history.goal)}")
 
     def setup_main_panel(self):
-        self.main_frame = tk.Frame(self.root, bg=BACKGROUND_COLOR, width=CANVAS_WIDTH, height=CANVAS_HEIGHT)
+        self.main_frame = tk.Frame(self.view, bg=BACKGROUND_COLOR, width=CANVAS_WIDTH, height=CANVAS_HEIGHT)
         self.main_frame.pack(side="top", fill="both", expand=True)
         self.main_frame.pack_propagate(False)
         self.canvas = tk.Canvas(self.main_frame, width=CANVAS_WIDTH, height=CANVAS_HEIGHT,
@@ -366,6 +505,17 @@ class RespiratoryTherapyApp:
         self.orange_percent_text = self.canvas.create_text(self.orange_center_x, 30, text="Orange: 0", font=(FONT_NAME, 12), fill="white")
         self.green_percent_text = self.canvas.create_text(self.green_center_x, 30, text="Green: 0", font=(FONT_NAME, 12), fill="white")
 
+        # Indicator updates go through the renderer: only changes reach Tk.
+        self.renderer = CanvasRenderer(self.canvas, DISPLAY_REFRESH_RATE)
+        for circle, center_x in ((self.blue_circle, self.blue_center_x), (self.orange_circle, self.orange_center_x),
+                                 (self.green_circle, self.green_center_x)):
+            self.renderer.known(circle, (center_x - radius, RULER_BOTTOM - radius,
+                                         center_x + radius, RULER_BOTTOM + radius), fill="white")
+        for text, label in ((self.blue_percent_text, "Blue"), (self.orange_percent_text, "Orange"),
+                            (self.green_percent_text, "Green")):
+            self.renderer.known(text, text=f"{label}: 0")
+        TELEMETRY.add_source("render", self.renderer.status)
+
     def draw_column_rulers(self):
         total_height = CANVAS_HEIGHT - RULER_TOP_MARGIN
         tick_interval = 50
@@ -385,31 +535,30 @@ class RespiratoryTherapyApp:
                 self.canvas.create_line(x0, y, x0 + 20, y, width=2, fill="white")
                 self.canvas.create_text(x0 - 10, y, text=str(value), font=(FONT_NAME, 10), fill="white")
 
-    @staticmethod
-    def process_mask(mask):
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, KERNEL, iterations=2)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, KERNEL, iterations=2)
-        return mask
-
-    def detect_ball(self, mask, label, draw_color, frame):
-        mask = self.process_mask(mask)
-        contours, _ = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        pos = None
-        if contours:
-            c = max(contours, key=cv2.contourArea)
-            ((x, y), radius) = cv2.minEnclosingCircle(c)
-            if radius > 10:
-                cv2.circle(frame, (int(x), int(y)), int(radius), draw_color, 2)
-                cv2.putText(frame, label, (int(x - radius), int(y - radius)),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, draw_color, 2)
-                pos = (int(x), int(y))
-                
-                # Debug: Show the mask for green ball
-                if label == "Green":
-                    cv2.imshow("Green Mask", mask)
-                    
-        self.ball_positions[label] = pos
-        return frame
+    def detect_positions(self, frame):
+        """
+        Runs on the detection worker thread: locate every ball in a captured frame.
+        Returns the per-color positions and velocities (smoothed when tracking)
+        and, when enabled, the debug images.
+        """
+        # Frames arrive already cropped to the detection window.
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(frame)
+        result = self.engine.process(frame, time.perf_counter(), TELEMETRY)
+        positions = result["positions"]
+
+        debug_images = {}
+        if SHOW_DEBUG_WINDOWS:
+            # Debug: Show HSV image and the mask for green ball
+            hsv = result["hsv"]
+            debug_images["HSV Image"] = hsv if hsv is not None else preprocess(frame)
+            if positions.get("Green") and result["debug_mask"] is not None:
+                debug_images["Green Mask"] = result["debug_mask"]
+            if self.camera.mirrored:
+                debug_images = {name: cv2.flip(image, 1) for name, image in debug_images.items()}
+        return {"positions": positions, "velocities": result["velocities"], "bridged": result["bridged"],
+                "values": result["values"], "debug_images": debug_images}
 
     def get_canvas_y(self, ball_y):
         """
@@ -418,10 +567,7 @@ class RespiratoryTherapyApp:
           ball_y <= DETECTION_Y_MIN maps to RULER_TOP_MARGIN (top of column)
           ball_y = DETECTION_Y_MAX maps to CANVAS_HEIGHT (bottom of column)
         """
-        clamped_y = max(ball_y, DETECTION_Y_MIN)
-        normalized = (clamped_y - DETECTION_Y_MIN) / (DETECTION_Y_MAX - DETECTION_Y_MIN)
-        normalized = max(0, min(normalized, 1))
-        return RULER_TOP_MARGIN + normalized * (CANVAS_HEIGHT - RULER_TOP_MARGIN)
+        return canvas_y(ball_y, RULER_TOP_MARGIN, CANVAS_HEIGHT)
 
     def update_ball_indicators(self):
         """
@@ -432,55 +578,57 @@ class RespiratoryTherapyApp:
           Green:   y = RULER_TOP_MARGIN maps to 1200, y = CANVAS_HEIGHT maps to 900.
         If no ball is detected in a column, the displayed value is forced to 0.
         """
-        def get_new_center(label):
-            if self.ball_positions[label]:
-                return self.get_canvas_y(self.ball_positions[label][1])
-            else:
+        mapper = self.engine.mapper
+
+        def get_value(label):
+            position = self.ball_positions[label]
+            return mapper.value(label, position[1]) if position else 0
+
+        blue_value = get_value("Blue")
+        orange_value = get_value("Orange")
+        green_value = get_value("Green")
+
+        # Only queued here; the publisher's own thread does the sending
+        live = get_live_publisher()
+        if live:
+            live.publish({"Blue": blue_value, "Orange": orange_value, "Green": green_value})
+
+        def get_new_center(label, value):
+            if not self.ball_positions[label]:
                 return CANVAS_HEIGHT
+            if label in mapper.curves:
+                # Calibrated column: draw the ball where its reading is on the ruler
+                return mapper.reading_canvas_y(label, value)
+            return self.get_canvas_y(self.ball_positions[label][1])
 
         radius = 20
-        blue_y = get_new_center("Blue")
-        orange_y = get_new_center("Orange")
-        green_y = get_new_center("Green")
-
-        self.canvas.coords(self.blue_circle,
-                           (COLUMN_BOUNDS["Blue"][0] + COLUMN_BOUNDS["Blue"][1]) // 2 - radius,
-                           blue_y - radius,
-                           (COLUMN_BOUNDS["Blue"][0] + COLUMN_BOUNDS["Blue"][1]) // 2 + radius,
-                           blue_y + radius)
-        self.canvas.itemconfig(self.blue_circle, fill="blue" if self.ball_positions["Blue"] else "white")
-
-        self.canvas.coords(self.orange_circle,
-                           (COLUMN_BOUNDS["Orange"][0] + COLUMN_BOUNDS["Orange"][1]) // 2 - radius,
-                           orange_y - radius,
-                           (COLUMN_BOUNDS["Orange"][0] + COLUMN_BOUNDS["Orange"][1]) // 2 + radius,
-                           orange_y + radius)
-        self.canvas.itemconfig(self.orange_circle, fill="orange" if self.ball_positions["Orange"] else "white")
-
-        self.canvas.coords(self.green_circle,
-                           (COLUMN_BOUNDS["Green"][0] + COLUMN_BOUNDS["Green"][1]) // 2 - radius,
-                           green_y - radius,
-                           (COLUMN_BOUNDS["Green"][0] + COLUMN_BOUNDS["Green"][1]) // 2 + radius,
-                           green_y + radius)
-        self.canvas.itemconfig(self.green_circle, fill="green" if self.ball_positions["Green"] else "white")
-
-        total_height = CANVAS_HEIGHT - RULER_TOP_MARGIN
-        blue_raw = (CANVAS_HEIGHT - blue_y) / total_height * (BLUE_MAX - BLUE_MIN) + BLUE_MIN
-        orange_raw = (CANVAS_HEIGHT - orange_y) / total_height * (ORANGE_MAX - ORANGE_MIN) + ORANGE_MIN
-        green_raw = (CANVAS_HEIGHT - green_y) / total_height * (GREEN_MAX - GREEN_MIN) + GREEN_MIN
-
-        blue_value = int(round(blue_raw)) if self.ball_positions["Blue"] else 0
-        orange_value = int(round(orange_raw)) if self.ball_positions["Orange"] else 0
-        green_value = int(round(green_raw)) if self.ball_positions["Green"] else 0
-
-        self.canvas.itemconfig(self.blue_percent_text, text=f"Blue: {blue_value:d}")
-        self.canvas.itemconfig(self.orange_percent_text, text=f"Orange: {orange_value:d}")
-        self.canvas.itemconfig(self.green_percent_text, text=f"Green: {green_value:d}")
-
-        # Check if any indicator has reached its maximum value.
-        if (self.ball_positions["Blue"] and blue_value == BLUE_MAX) or \
-           (self.ball_positions["Orange"] and orange_value == ORANGE_MAX) or \
-           (self.ball_positions["Green"] and green_value == GREEN_MAX):
+        blue_y = get_new_center("Blue", blue_value)
+        orange_y = get_new_center("Orange", orange_value)
+        green_y = get_new_center("Green", green_value)
+
+        # Recorded only; poll_results() flushes the changes at the display refresh rate.
+        render = self.renderer.set
+        render(self.blue_circle, (self.blue_center_x - radius, blue_y - radius,
+                                  self.blue_center_x + radius, blue_y + radius),
+               fill="blue" if self.ball_positions["Blue"] else "white")
+        render(self.orange_circle, (self.orange_center_x - radius, orange_y - radius,
+                                    self.orange_center_x + radius, orange_y + radius),
+               fill="orange" if self.ball_positions["Orange"] else "white")
+        render(self.green_circle, (self.green_center_x - radius, green_y - radius,
+                                   self.green_center_x + radius, green_y + radius),
+               fill="green" if self.ball_positions["Green"] else "white")
+
+        render(self.blue_percent_text, text=f"Blue: {blue_value:d}")
+        render(self.orange_percent_text, text=f"Orange: {orange_value:d}")
+        render(self.green_percent_text, text=f"Green: {green_value:d}")
+
+        # Check if any indicator has reached its maximum value (measured, not held over a miss).
+        def measured(label):
+            return self.ball_positions[label] and not self.ball_bridged[label]
+
+        if (measured("Blue") and blue_value >= BLUE_MAX) or \
+           (measured("Orange") and orange_value >= ORANGE_MAX) or \
+           (measured("Green") and green_value >= GREEN_MAX):
             if not self.confirmation_shown:
                 self.confirmation_shown = True
                 self.show_confirmation_window(blue_value, orange_value, green_value)
@@ -498,82 +646,180 @@ class RespiratoryTherapyApp:
         progress_frame.pack(pady=10)
         progress_label = tk.Label(progress_frame, text="Saving data...", font=(FONT_NAME, 10), 
                                 bg=BACKGROUND_COLOR, fg=TEXT_COLOR)
-        progress_bar = ttk.Progressbar(progress_frame, length=200, mode='determinate')
-        
-        def show_progress():
-            progress_label.pack()
-            progress_bar.pack(pady=5)
-            # Update progress bar
-            for i in range(101):
-                progress_bar['value'] = i
-                top.update_idletasks()
-                time.sleep(0.02)
+        progress_bar = ttk.Progressbar(progress_frame, length=200, mode='indeterminate')
         
         def repeat():
             top.destroy()
             self.confirmation_shown = False
         
         def finish():
-            # Show progress bar
-            show_progress()
+            # Show progress until the background writer confirms the save
+            repeat_button.config(state="disabled")
+            finish_button.config(state="disabled")
+            progress_label.config(text="Saving data...")
+            progress_label.pack()
+            progress_bar.config(mode='indeterminate', value=0)
+            progress_bar.pack(pady=5)
+            progress_bar.start(10)
             
             # Save data
             now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             data = [self.card_id, now, blue_value, orange_value, green_value]
-            if write_to_excel(data):
-                # Properly cleanup camera
-                if hasattr(self, 'picam2') and self.picam2 is not None:
-                    self.picam2.stop()
-                    self.picam2.close()
-                top.destroy()
-                self.running = False
-                self.root.destroy()
-                new_rfid_root = tk.Tk()
-                new_rfid_app = RFIDReaderWindow(new_rfid_root)
-                new_rfid_root.mainloop()
+            top.after(SAVE_POLL_INTERVAL_MS, wait_for_save, save_session(data), data)
+        
+        def wait_for_save(future, data):
+            if not future.done():
+                top.after(SAVE_POLL_INTERVAL_MS, wait_for_save, future, data)
+                return
+            progress_bar.stop()
+            try:
+                row_id = future.result()
+            except Exception as e:
+                progress_label.pack_forget()
+                progress_bar.pack_forget()
+                repeat_button.config(state="normal")
+                finish_button.config(state="normal")
+                messagebox.showerror("File Error", f"Could not save data:\n{e}")
+                return
+            get_patient_index().record(row_id, data)
+            progress_bar.config(mode='determinate', value=100)
+            progress_label.config(text="Saved")
+            top.update_idletasks()
+            
+            # Back to the card reader (on_finished ends the session); the camera
+            # stays open for the next patient
+            top.destroy()
+            self.on_finished()
         
-        tk.Button(btn_frame, text="Repeat", font=(FONT_NAME, 12), command=repeat).pack(side="left", padx=10)
-        tk.Button(btn_frame, text="Finished", font=(FONT_NAME, 12), command=finish).pack(side="right", padx=10)
+        repeat_button = tk.Button(btn_frame, text="Repeat", font=(FONT_NAME, 12), command=repeat)
+        repeat_button.pack(side="left", padx=10)
+        finish_button = tk.Button(btn_frame, text="Finished", font=(FONT_NAME, 12), command=finish)
+        finish_button.pack(side="right", padx=10)
 
-    def update_frame(self):
+    def poll_results(self):
+        """
+        Tk-side consumer: apply the newest detection result, if any, and reschedule.
+        Never waits for the camera or the detector.
+        """
         if not self.running:
             return
-        if self.picam2 is None:
-            print("Camera not initialized.")
-            self.root.after(10, self.update_frame)
-            return
 
-        frame = self.picam2.capture_array()
-        if frame is None:
-            print("Error: Could not capture frame from camera.")
-            self.root.after(10, self.update_frame)
-            return
+        result = self.pipeline.poll()
+        if result is not None and result.captured_at < self.session_started_at:
+            # Captured before the card was scanned (still in flight when paused)
+            result = None
+        if result is not None:
+            if self.scan_to_frame is None:
+                self.scan_to_frame = time.perf_counter() - self.session_started_at
+                self.pipeline.stats.record_latency("scan_to_frame", self.scan_to_frame)
+                print(f"Card scan to first live frame: {self.scan_to_frame * 1000:.0f} ms")
+            self.series.append(result.captured_at, result.data["positions"], result.data["values"])
+            self.ball_positions.update(result.data["positions"])
+            self.ball_velocities.update(result.data["velocities"])
+            self.ball_bridged.update(result.data["bridged"])
+            self.last_frame_height = DETECTION_Y_MAX
+            # HighGUI windows must be driven from this thread, not the worker.
+            for name, image in result.data["debug_images"].items():
+                cv2.imshow(name, image)
+            start = time.perf_counter()
+            self.update_ball_indicators()
+            if TELEMETRY.detailed:
+                TELEMETRY.record_latency("update_ball_indicators", time.perf_counter() - start)
+        # Also draws a result held back by the refresh-rate cap on an earlier poll
+        start = time.perf_counter()
+        if self.renderer.flush(start) and TELEMETRY.detailed:
+            TELEMETRY.record_latency("render", time.perf_counter() - start)
+
+        now = time.monotonic()
+        if now - self.last_stats_log >= STATS_LOG_INTERVAL:
+            self.last_stats_log = now
+            self.log_pipeline_stats()
 
-        frame = cv2.flip(frame, 1)  # Mirror effect
+        if self.running:
+            self.poll_job = self.root.after(POLL_INTERVAL_MS, self.poll_results)
+
+    def metrics_snapshot(self):
+        """Telemetry snapshot for the metrics exporters (safe from any thread)."""
+        pipeline = self.pipeline
+        return pipeline.snapshot() if pipeline is not None else TELEMETRY.snapshot()
+
+    def scheduler_note(self, stats):
+        scheduler = stats.get("scheduler")
+        return f" ({scheduler['state']}, {scheduler['effective_fps']:.1f} detected/s)" if scheduler else ""
+
+    def log_pipeline_stats(self):
+        stats = self.pipeline.snapshot()
+        latency = ", ".join(f"{stage} {v['p50']:.1f}/{v['p90']:.1f}/{v['max']:.1f} ms"
+                            for stage, v in stats["latency_ms"].items())
+        hit_rate = ", ".join(f"{label} {rate:.0%}" for label, rate in stats["hit_rate"].items())
+        print(f"Pipeline: captured {stats.get('frames_captured', 0)}, detected {stats.get('frames_detected', 0)}, "
+              f"displayed {stats.get('frames_displayed', 0)}, dropped {stats['dropped_frames']}, "
+              f"{stats['fps'].get('display', 0.0):.1f} fps{self.scheduler_note(stats)} | hit rate: {hit_rate} | "
+              f"p50/p90/max latency: {latency} | redraws {self.renderer.redraws}, "
+              f"{self.renderer.saved_per_second:.0f} Tk calls/s saved")
+
+    def stop_camera(self):
+        # Stop the pipeline threads before releasing the camera they read from.
+        if getattr(self, 'pipeline', None) is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        if getattr(self, 'camera', None) is not None:
+            self.camera.close()
+            self.camera = None
 
-        cropped_frame = frame[0:352, 116:430]
-        self.last_frame_height = DETECTION_Y_MAX
+    def on_closing(self):
+        self.running = False
+        self.profile_watcher.stop()
+        self.stop_camera()
+        self.stop_recording()
+        self.save_series()
 
-        blurred = cv2.GaussianBlur(cropped_frame, (11, 11), 0)
-        hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
-        
-        # Debug: Show HSV image
-        cv2.imshow("HSV Image", hsv)
-        
-        processed_frame = np.zeros_like(cropped_frame)
-        for label, settings in HSV_RANGES.items():
-            mask = cv2.inRange(hsv, settings["lower"], settings["upper"])
-            processed_frame = self.detect_ball(mask, label, settings["draw_color"], processed_frame)
 
-        self.update_ball_indicators()
-        if self.running:
-            self.root.after(10, self.update_frame)
+# =============================================================================
+# Device: one long-lived root, camera and pipeline; switchable views
+# =============================================================================
+class TherapyDevice:
+    def __init__(self, root):
+        self.root = root
+        self.root.configure(bg=BACKGROUND_COLOR)
+        self.therapy = RespiratoryTherapyApp(root, on_finished=self.show_rfid_reader)
+        self.rfid = RFIDReaderWindow(root, on_scan=self.start_session)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.exporters = []
+        if TELEMETRY_ENABLED:
+            self.start_metrics_export()
+        self.show_rfid_reader()
+
+    def start_metrics_export(self):
+        TELEMETRY.add_source("sync", lambda: get_sync_worker().status())
+        if get_fleet_worker():
+            TELEMETRY.add_source("fleet", lambda: get_fleet_worker().status())
+        if get_live_publisher():
+            TELEMETRY.add_source("live", lambda: get_live_publisher().status())
+        try:
+            self.exporters.append(MetricsServer(self.therapy.metrics_snapshot, METRICS_PORT))
+            print(f"Serving metrics at http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print("Could not start metrics endpoint:", e)
+        if METRICS_LOG:
+            self.exporters.append(MetricsLogger(self.therapy.metrics_snapshot, METRICS_LOG))
+        for exporter in self.exporters:
+            exporter.start()
+
+    def show_rfid_reader(self):
+        self.therapy.end_session()
+        self.rfid.show()
+
+    def start_session(self, card_id):
+        scanned_at = time.perf_counter()
+        self.rfid.hide()
+        if not self.therapy.start_session(card_id, scanned_at):
+            self.rfid.show()
 
     def on_closing(self):
-        self.running = False
-        if hasattr(self, 'picam2') and self.picam2 is not None:
-            self.picam2.stop()
-            self.picam2.close()
+        for exporter in self.exporters:
+            exporter.stop()
+        self.therapy.on_closing()
         self.root.destroy()
 
 
@@ -582,12 +828,22 @@ if __name__ == "__main__":
     if not check_and_create_lock():
         sys.exit(1)
         
-    # Launch RFID reader window first.
+    # Deliver any sessions still pending from a previous run.
+    get_sync_worker().notify()
+    if get_fleet_worker():
+        get_fleet_worker().notify()
+
+    # Launch the device; it starts on the RFID reader view.
     try:
-        rfid_root = tk.Tk()
-        rfid_app = RFIDReaderWindow(rfid_root)
-        rfid_root.mainloop()
+        root = tk.Tk()
+        device = TherapyDevice(root)
+        root.mainloop()
     except Exception as e:
         messagebox.showerror("Error", f"An error occurred: {str(e)}")
     finally:
+        get_sync_worker().stop()
+        if get_fleet_worker():
+            get_fleet_worker().stop()
+        if get_live_publisher():
+            get_live_publisher().stop()
         cleanup_lock()
@@ -0,0 +1,467 @@
+import os
+
+import cv2
+import numpy as np
+
+# =============================================================================
+# Ball Detection
+# =============================================================================
+# Interchangeable ways of finding the balls in the cropped frame:
+#   per_color - one inRange + morphology + findContours pass per color
+#   fused     - one lookup-table pass classifies every pixel for all colors,
+#               then each color is cleaned and searched only around its pixels
+#   roi       - each color is only searched in its own tube (a column strip),
+#               and the ball's Y comes from a 1-D projection of the strip mask
+#   pyramid   - the balls are found on a downscaled frame, then refined like
+#               roi in a small full-resolution patch around each of them
+# All return {label: (x, y) or None} in cropped-frame coordinates.
+# Each also takes an optional telemetry.Stopwatch; when given, the time spent
+# in each stage (blur, cvtColor, inRange, process_mask, find_ball, ...) is lapped
+# into it. Passing None (the default) costs one truth test per stage.
+
+# Morphological operation kernel
+KERNEL = np.ones((5, 5), np.uint8)
+BLUR_KERNEL = (11, 11)
+MIN_BALL_RADIUS = 10
+
+
+# HSV ranges per color, as saved by color_calibration.py
+HSV_FILE = "HSV.data"
+DEFAULT_HSV_RANGES = {
+    "Blue": {
+        "lower": np.array([94, 80, 2]),
+        "upper": np.array([126, 255, 255]),
+        "draw_color": (255, 0, 0)
+    },
+    "Orange": {
+        "lower": np.array([4, 100, 20]),
+        "upper": np.array([25, 255, 255]),
+        "draw_color": (0, 165, 255)
+    },
+    "Green": {
+        "lower": np.array([23, 42, 0]),
+        "upper": np.array([100, 255, 255]),
+        "draw_color": (0, 255, 0)
+    },
+}
+
+
+def load_hsv_ranges(path=HSV_FILE):
+    # Older color_calibration.py versions passed the name to np.savez, which
+    # appended ".npz", so HSV.data itself never existed and the defaults were used.
+    if not os.path.exists(path) and os.path.exists(path + ".npz"):
+        path += ".npz"
+    if not os.path.exists(path):
+        return {label: dict(settings) for label, settings in DEFAULT_HSV_RANGES.items()}
+    with np.load(path) as data:
+        return {
+            label: {
+                "lower": data[f"{label.lower()}_lower"],
+                "upper": data[f"{label.lower()}_upper"],
+                "draw_color": settings["draw_color"],
+            }
+            for label, settings in DEFAULT_HSV_RANGES.items()
+        }
+
+
+def save_hsv_ranges(hsv_ranges, path=HSV_FILE):
+    # Write through a file object so numpy keeps the exact file name (no .npz suffix).
+    arrays = {}
+    for label, settings in hsv_ranges.items():
+        arrays[f"{label.lower()}_lower"] = np.asarray(settings["lower"])
+        arrays[f"{label.lower()}_upper"] = np.asarray(settings["upper"])
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def preprocess(cropped_frame, stopwatch=None):
+    blurred = cv2.GaussianBlur(cropped_frame, BLUR_KERNEL, 0)
+    if stopwatch:
+        stopwatch.lap("blur")
+    hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+    if stopwatch:
+        stopwatch.lap("cvtColor")
+    return hsv
+
+
+def process_mask(mask):
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, KERNEL, iterations=2)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, KERNEL, iterations=2)
+    return mask
+
+
+def find_ball(mask, offset=(0, 0)):
+    """Position of the largest blob in a cleaned mask (at `offset` in the frame), or None if it is too small."""
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if contours:
+        c = max(contours, key=cv2.contourArea)
+        ((x, y), radius) = cv2.minEnclosingCircle(c)
+        if radius > MIN_BALL_RADIUS:
+            return (int(x), int(y))
+    return None
+
+
+def detect_balls_per_color(hsv, hsv_ranges, debug_label=None, stopwatch=None):
+    """
+    Reference path: a separate inRange, morphology and contour search per color.
+    Returns the positions and the cleaned mask for `debug_label` (if requested).
+    """
+    positions = {}
+    debug_mask = None
+    for label, settings in hsv_ranges.items():
+        mask = cv2.inRange(hsv, settings["lower"], settings["upper"])
+        if stopwatch:
+            stopwatch.lap("inRange")
+        mask = process_mask(mask)
+        if stopwatch:
+            stopwatch.lap("process_mask")
+        positions[label] = find_ball(mask)
+        if stopwatch:
+            stopwatch.lap("find_ball")
+        if label == debug_label:
+            debug_mask = mask
+    return positions, debug_mask
+
+
+# -------------------------------
+# Fused multi-color segmentation
+# -------------------------------
+class LabelLUT:
+    """
+    Precomputed pixel classifier for a set of HSV ranges.
+    Each range is an axis-aligned box in HSV space, so the 3D membership test
+    separates into one 256-entry table per channel: `channel_luts[c]` holds,
+    for every value of channel c, a bitmask of the colors whose range contains it.
+    AND-ing the three looked-up channels gives the 3D membership bitmask: one
+    bit plane per color, so a pixel inside overlapping ranges belongs to each
+    of them, exactly as with a separate inRange per color. `mask_luts[i]`
+    turns the bitmask into color i's 0/255 mask.
+    """
+    def __init__(self, hsv_ranges):
+        self.labels = list(hsv_ranges.keys())
+        if len(self.labels) > 8:
+            raise ValueError("LabelLUT supports at most 8 colors")
+        self.channel_luts = [np.zeros(256, np.uint8) for _ in range(3)]
+        for bit, settings in enumerate(hsv_ranges.values()):
+            for channel, lut in enumerate(self.channel_luts):
+                lo = max(int(settings["lower"][channel]), 0)
+                hi = min(int(settings["upper"][channel]), 255)
+                if lo <= hi:
+                    lut[lo:hi + 1] |= 1 << bit
+        values = np.arange(256)
+        self.mask_luts = [np.where(values & (1 << bit), 255, 0).astype(np.uint8)
+                          for bit in range(len(self.labels))]
+
+    def classify(self, hsv):
+        """Membership bitmask image: bit i is set where the i-th color's range contains the pixel."""
+        h, s, v = (cv2.LUT(channel, lut) for channel, lut in zip(cv2.split(hsv), self.channel_luts))
+        return cv2.bitwise_and(cv2.bitwise_and(h, s), v)
+
+    def mask(self, bits, index):
+        """0/255 mask of the index-th color, identical to its cv2.inRange mask."""
+        return cv2.LUT(bits, self.mask_luts[index])
+
+
+# Furthest a pixel can influence process_mask's output: 8 passes of KERNEL
+MORPH_REACH = 8 * (KERNEL.shape[0] // 2)
+
+
+def detect_balls_fused(hsv, label_lut, debug_label=None, stopwatch=None):
+    """
+    Fused path: classify all colors in one lookup-table pass, then clean and
+    search each color's mask only inside the bounding box of its pixels,
+    widened by MORPH_REACH. Opening and closing never spread a mask past its
+    bounding box and every pixel in the box sees its whole neighbourhood, so
+    the positions are exactly those of per_color - overlapping ranges
+    included - for a fraction of the morphology work. The boxes of all colors
+    come from one OR-projection of the bitmask image onto its rows and columns.
+    """
+    bits = label_lut.classify(hsv)
+    if stopwatch:
+        stopwatch.lap("inRange")
+    height, width = bits.shape
+    columns = np.bitwise_or.reduce(bits, axis=0)
+    rows = np.bitwise_or.reduce(bits, axis=1)
+    positions = {}
+    debug_mask = None
+    for index, label in enumerate(label_lut.labels):
+        positions[label] = None
+        if label == debug_label:
+            debug_mask = np.zeros_like(bits)
+        xs = np.flatnonzero(columns & (1 << index))
+        if not xs.size:
+            continue
+        ys = np.flatnonzero(rows & (1 << index))
+        x0, y0 = max(xs[0] - MORPH_REACH, 0), max(ys[0] - MORPH_REACH, 0)
+        x1, y1 = min(xs[-1] + 1 + MORPH_REACH, width), min(ys[-1] + 1 + MORPH_REACH, height)
+        patch = process_mask(label_lut.mask(bits[y0:y1, x0:x1], index))
+        if stopwatch:
+            stopwatch.lap("process_mask")
+        positions[label] = find_ball(patch, (int(x0), int(y0)))
+        if stopwatch:
+            stopwatch.lap("find_ball")
+        if label == debug_label:
+            debug_mask[y0:y1, x0:x1] = patch
+    return positions, debug_mask
+
+
+# -------------------------------
+# Column-restricted (ROI) detection
+# -------------------------------
+# Each ball only moves vertically inside its own tube, so each color is searched
+# in a column strip (x0, x1) of the cropped frame. Strips are saved next to HSV.data.
+ROI_FILE = "ROI.data"
+DEFAULT_ROI_STRIPS = {
+    "Blue":   (0, 105),
+    "Orange": (105, 210),
+    "Green":  (210, 314),
+}
+ROI_MARGIN = 6        # extra columns of context for blur and morphology at strip edges
+MIN_ROW_PIXELS = 1    # mask pixels a row needs to count as part of the ball
+
+
+def load_roi_strips(path=ROI_FILE):
+    strips = dict(DEFAULT_ROI_STRIPS)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            for label in strips:
+                key = label.lower()
+                if key in data:
+                    x0, x1 = (int(v) for v in data[key])
+                    strips[label] = (x0, x1)
+    return strips
+
+
+def save_roi_strips(strips, path=ROI_FILE):
+    # Write through a file object so numpy keeps the exact file name (no .npz suffix).
+    with open(path, "wb") as f:
+        np.savez(f, **{label.lower(): np.array(bounds) for label, bounds in strips.items()})
+
+
+def longest_row_run(rows):
+    """(top, bottom) of the longest run of rows with ball pixels in a row projection, or None."""
+    active = rows >= MIN_ROW_PIXELS * 255
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], active.view(np.int8), [0]))))
+    if edges.size == 0:
+        return None
+    starts, ends = edges[::2], edges[1::2] - 1
+    i = int(np.argmax(ends - starts))
+    return int(starts[i]), int(ends[i])
+
+
+def find_ball_projection(mask, cut_top=False, cut_bottom=False, subpixel=False):
+    """
+    Locate the ball in a strip mask from its vertical projection: the longest
+    run of rows containing ball pixels gives the ball's extent, its middle the Y.
+    Returns (x, y) in mask coordinates, or None if the run is too short.
+    cut_top / cut_bottom mark mask edges that are search-window limits rather
+    than frame edges; a ball touching one may be cut off, so it is rejected.
+    With subpixel, Y is the (float) centroid of the run's rows, weighted by
+    how many ball pixels each row has.
+    """
+    rows = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    run = longest_row_run(rows)
+    if run is None:
+        return None
+    top, bottom = run
+    if (bottom - top) / 2 <= MIN_BALL_RADIUS:
+        return None
+    if (cut_top and top == 0) or (cut_bottom and bottom == len(rows) - 1):
+        return None
+    cols = np.flatnonzero(cv2.reduce(mask[top:bottom + 1], 0, cv2.REDUCE_MAX).ravel())
+    x = int((cols[0] + cols[-1]) / 2)
+    if subpixel:
+        weights = rows[top:bottom + 1].astype(np.float64)
+        return (x, top + float(np.dot(np.arange(len(weights)), weights) / weights.sum()))
+    return (x, int((top + bottom) / 2))
+
+
+def detect_balls_roi(cropped_frame, hsv_ranges, roi_strips, debug_label=None, row_windows=None,
+                     stopwatch=None):
+    """
+    ROI path: only each color's own column strip (plus a small margin) is
+    segmented, so other tubes can never produce a false detection. The strips
+    are packed side by side so blur and HSV conversion still run as a single
+    call on a much narrower image. Takes the BGR cropped frame, not HSV.
+    row_windows optionally limits each color to rows (y0, y1), e.g. around a
+    tracker's prediction; a missing or None entry means the full strip height.
+    """
+    height, width = cropped_frame.shape[:2]
+    row_windows = row_windows or {}
+    spans = []
+    offset = 0
+    top, bottom = height, 0
+    for label in hsv_ranges:
+        x0, x1 = roi_strips.get(label, (0, width))
+        x0, x1 = max(x0, 0), min(x1, width)
+        y0, y1 = row_windows.get(label) or (0, height)
+        y0, y1 = max(y0, 0), min(y1, height)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        left, right = max(x0 - ROI_MARGIN, 0), min(x1 + ROI_MARGIN, width)
+        # Rows processed for this color, with context for blur and morphology
+        r0, r1 = max(y0 - ROI_MARGIN, 0), min(y1 + ROI_MARGIN, height)
+        top, bottom = min(top, r0), max(bottom, r1)
+        spans.append((label, left, right, x0, x1, y0, y1, r0, r1, offset))
+        offset += right - left
+
+    positions = {label: None for label in hsv_ranges}
+    debug_mask = None
+    if not spans:
+        return positions, debug_mask
+    pieces = [cropped_frame[top:bottom, left:right] for _, left, right, *_ in spans]
+    packed = np.hstack(pieces) if len(pieces) > 1 else pieces[0]
+    if stopwatch:
+        stopwatch.lap("pack")
+    hsv = preprocess(packed, stopwatch)
+    for label, left, right, x0, x1, y0, y1, r0, r1, start in spans:
+        settings = hsv_ranges[label]
+        piece = hsv[r0 - top:r1 - top, start:start + right - left]
+        mask = cv2.inRange(piece, settings["lower"], settings["upper"])
+        if stopwatch:
+            stopwatch.lap("inRange")
+        mask = process_mask(mask)[y0 - r0:y1 - r0, x0 - left:x1 - left]
+        if stopwatch:
+            stopwatch.lap("process_mask")
+        pos = find_ball_projection(mask, cut_top=y0 > 0, cut_bottom=y1 < height)
+        if stopwatch:
+            stopwatch.lap("find_ball")
+        if pos:
+            positions[label] = (pos[0] + x0, pos[1] + y0)
+        if label == debug_label:
+            debug_mask = mask
+    return positions, debug_mask
+
+
+# -------------------------------
+# Coarse-to-fine (pyramid) detection
+# -------------------------------
+# The ROI path still blurs, converts and cleans every pixel of each tube strip
+# although the ball covers a small part of it. The pyramid path first looks
+# for each ball in its strip shrunk PYRAMID_SCALE times in each direction
+# (area averaging doubles as the blur; no morphology beyond one small open),
+# then runs the ROI pipeline only on a full-resolution patch around each
+# candidate and takes Y as the centroid of the patch's ball rows, to a
+# fraction of a pixel. If the refined ball is cut off by its patch (the coarse
+# guess was off), that color falls back to its whole strip for the frame.
+# On patches this small the pixel work is cheap and the fixed cost of each
+# call dominates, so only the strips (and tracker windows) are shrunk rather
+# than the whole frame, and the patches are blurred with a precomputed kernel.
+PYRAMID_SCALE = 4           # downscale factor of the coarse image
+PYRAMID_PATCH_MARGIN = 2    # coarse pixels added around a candidate before refining
+COARSE_KERNEL = np.ones((3, 3), np.uint8)
+# BLUR_KERNEL's Gaussian (sigma 0 = derived from the size, as in GaussianBlur)
+PATCH_BLUR_KERNEL = cv2.getGaussianKernel(BLUR_KERNEL[0], 0)
+
+
+def shrink(image, scale):
+    """
+    Area-average `image` by an integer `scale`. A power of two is done by
+    repeated halving: OpenCV's 2x area path is about twice as fast as its
+    general one for 4x, at the cost of one level of rounding.
+    """
+    while scale > 1 and scale % 2 == 0:
+        image = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        scale //= 2
+    if scale > 1:
+        image = cv2.resize(image, (image.shape[1] // scale, image.shape[0] // scale), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def preprocess_patch(patch, stopwatch=None):
+    """
+    preprocess() for small patches. GaussianBlur builds its kernel on every
+    call, which costs several times the blur itself on a patch; the separable
+    filter with the kernel built once gives the same image to within one level.
+    """
+    blurred = cv2.sepFilter2D(patch, -1, PATCH_BLUR_KERNEL, PATCH_BLUR_KERNEL)
+    if stopwatch:
+        stopwatch.lap("blur")
+    hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+    if stopwatch:
+        stopwatch.lap("cvtColor")
+    return hsv
+
+
+def find_coarse_candidate(mask):
+    """(top, bottom, left, right) of the largest blob's extent in a coarse strip mask, or None."""
+    rows = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    run = longest_row_run(rows)
+    if run is None:
+        return None
+    top, bottom = run
+    cols = np.flatnonzero(cv2.reduce(mask[top:bottom + 1], 0, cv2.REDUCE_MAX).ravel())
+    return top, bottom, int(cols[0]), int(cols[-1])
+
+
+def detect_balls_pyramid(cropped_frame, hsv_ranges, roi_strips, debug_label=None, row_windows=None,
+                         stopwatch=None, scale=PYRAMID_SCALE):
+    """
+    Pyramid path: same arguments and results as detect_balls_roi, but only a
+    1/scale^2 sized copy of each strip and one small patch per ball are
+    segmented. Y is returned as a float (sub-pixel centroid).
+    """
+    height, width = cropped_frame.shape[:2]
+    row_windows = row_windows or {}
+    small_height, small_width = height // scale, width // scale
+
+    positions = {label: None for label in hsv_ranges}
+    debug_mask = None
+    fallback = {}
+    margin = PYRAMID_PATCH_MARGIN * scale
+    for label, settings in hsv_ranges.items():
+        x0, x1 = roi_strips.get(label, (0, width))
+        x0, x1 = max(x0, 0), min(x1, width)
+        y0, y1 = row_windows.get(label) or (0, height)
+        y0, y1 = max(y0, 0), min(y1, height)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        # Coarse: the strip (and row window) shrunk on its own; averaging whole
+        # scale x scale blocks gives the same pixels as shrinking the frame.
+        sx0, sx1 = x0 // scale, min(-(-x1 // scale), small_width)
+        sy0, sy1 = y0 // scale, min(-(-y1 // scale), small_height)
+        if sx1 <= sx0 or sy1 <= sy0:
+            continue
+        small = shrink(cropped_frame[sy0 * scale:sy1 * scale, sx0 * scale:sx1 * scale], scale)
+        if stopwatch:
+            stopwatch.lap("resize")
+        small_hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        if stopwatch:
+            stopwatch.lap("cvtColor")
+        coarse = cv2.inRange(small_hsv, settings["lower"], settings["upper"])
+        coarse = cv2.morphologyEx(coarse, cv2.MORPH_OPEN, COARSE_KERNEL)
+        candidate = find_coarse_candidate(coarse)
+        if stopwatch:
+            stopwatch.lap("coarse")
+        if candidate is None:
+            continue
+        top, bottom, left, right = candidate
+
+        # Fine: a full-resolution patch around the candidate, inside the strip and window
+        py0, py1 = max((sy0 + top) * scale - margin, y0), min((sy0 + bottom + 1) * scale + margin, y1)
+        px0, px1 = max((sx0 + left) * scale - margin, x0), min((sx0 + right + 1) * scale + margin, x1)
+        r0, r1 = max(py0 - ROI_MARGIN, 0), min(py1 + ROI_MARGIN, height)
+        c0, c1 = max(px0 - ROI_MARGIN, 0), min(px1 + ROI_MARGIN, width)
+        hsv = preprocess_patch(cropped_frame[r0:r1, c0:c1], stopwatch)
+        mask = cv2.inRange(hsv, settings["lower"], settings["upper"])
+        mask = process_mask(mask)[py0 - r0:py1 - r0, px0 - c0:px1 - c0]
+        if stopwatch:
+            stopwatch.lap("process_mask")
+        pos = find_ball_projection(mask, cut_top=py0 > 0, cut_bottom=py1 < height, subpixel=True)
+        if stopwatch:
+            stopwatch.lap("find_ball")
+        if pos is None:
+            fallback[label] = settings
+            continue
+        positions[label] = (pos[0] + px0, pos[1] + py0)
+        if label == debug_label:
+            debug_mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+            debug_mask[py0 - y0:py1 - y0, px0 - x0:px1 - x0] = mask
+
+    if fallback:
+        found, fallback_mask = detect_balls_roi(cropped_frame, fallback, roi_strips, debug_label,
+                                                row_windows, stopwatch)
+        positions.update(found)
+        if debug_label in fallback:
+            debug_mask = fallback_mask
+    return positions, debug_mask
@@ -0,0 +1,138 @@
+from calibration import CalibrationProfile
+from camera import CROP_HEIGHT, mirror_strip, mirror_x
+from detection import (HSV_FILE, ROI_FILE, detect_balls_fused, detect_balls_per_color,
+                       detect_balls_pyramid, detect_balls_roi, load_hsv_ranges, load_roi_strips,
+                       preprocess)
+from mapping import CURVE_FILE, ValueMapper
+from tracking import BallTracker
+
+# =============================================================================
+# Detection Engine
+# =============================================================================
+# Frame in, ball positions and Blue/Orange/Green readings out. The engine owns
+# everything detection needs - HSV ranges, tube strips, the fused lookup table,
+# the tracker - and has no GUI, camera or file I/O of its own (from_files reads
+# the calibration once, when asked), so the app, replay tools, worker processes
+# and servers all run exactly the same code.
+# The HSV ranges and lookup table come as one compiled CalibrationProfile
+# (calibration.py); set_profile() swaps it between frames without stopping
+# the pipeline.
+
+DETECTION_MODES = ("roi", "pyramid", "fused", "per_color")
+
+
+class DetectionEngine:
+    """
+    hsv_ranges - {label: {"lower", "upper", "draw_color"}} or a CalibrationProfile
+    mode      - "roi", "pyramid", "fused" or "per_color" (see detection.py)
+    mirrored  - frames are in camera orientation; strips and x are mirrored
+    tracking  - smooth positions with a BallTracker and, in "roi" and
+                "pyramid" mode, search only around each ball's predicted position
+    debug_label - color whose cleaned mask is returned as "debug_mask"
+    mapper    - mapping.ValueMapper turning ball Y into readings (linear by default)
+    """
+    def __init__(self, hsv_ranges, roi_strips, mode="roi", mirrored=False, tracking=True,
+                 frame_height=CROP_HEIGHT, debug_label=None, mapper=None):
+        if mode not in DETECTION_MODES:
+            raise ValueError(f"Unknown detection mode: {mode}")
+        if not isinstance(hsv_ranges, CalibrationProfile):
+            hsv_ranges = CalibrationProfile(hsv_ranges)
+        self.profile = hsv_ranges
+        self.labels = self.profile.labels
+        self.mode = mode
+        self.tracking = tracking
+        self.frame_height = frame_height
+        self.debug_label = debug_label
+        self.mapper = mapper or ValueMapper()
+        self.display_strips = roi_strips
+        self.set_mirrored(mirrored)
+        self.reset()
+
+    @classmethod
+    def from_files(cls, hsv_path=HSV_FILE, roi_path=ROI_FILE, curve_path=CURVE_FILE, **kwargs):
+        """Engine for the calibration saved by color_calibration.py (and MAPPING.json, if any)."""
+        return cls(load_hsv_ranges(hsv_path), load_roi_strips(roi_path),
+                   mapper=ValueMapper.from_file(curve_path), **kwargs)
+
+    @property
+    def hsv_ranges(self):
+        return self.profile.hsv_ranges
+
+    @property
+    def label_lut(self):
+        return self.profile.label_lut
+
+    def set_profile(self, profile):
+        """
+        Use another compiled calibration profile from the next frame on. Safe
+        to call from any thread: a frame being detected finishes with the
+        profile it started with.
+        """
+        if profile.labels != self.labels:
+            raise ValueError(f"Profile {profile} has colors {profile.labels}, expected {self.labels}")
+        self.profile = profile
+
+    def set_mirrored(self, mirrored):
+        # Frames in camera orientation are not flipped; mirror the tube strips
+        # once here and the detected x coordinates per frame instead.
+        self.mirrored = mirrored
+        if mirrored:
+            self.roi_strips = {label: mirror_strip(strip) for label, strip in self.display_strips.items()}
+        else:
+            self.roi_strips = self.display_strips
+
+    def reset(self):
+        """Forget the tracked balls (call when a new session starts)."""
+        self.tracker = BallTracker(self.labels, self.frame_height) if self.tracking else None
+
+    def process(self, frame, timestamp, telemetry=None):
+        """
+        Detect the balls in one cropped BGR frame captured at `timestamp`
+        (seconds, monotonic). Returns a dict with
+          positions  - {label: (x, y) or None} in display orientation (smoothed when tracking)
+          velocities - {label: pixels/sec or None}
+          bridged    - {label: True if the position is held over a missed detection}
+          values     - {label: reading} as shown on the therapy screen
+          hsv        - the HSV frame, if the detector computed one for the whole frame
+          debug_mask - cleaned mask of debug_label (in frame orientation), or None
+        """
+        stopwatch = telemetry.stopwatch() if telemetry is not None else None
+        profile = self.profile
+        hsv = None
+        row_windows = self.tracker.search_windows(timestamp) if self.tracker else None
+        if stopwatch:
+            stopwatch.lap("track")
+        if self.mode == "roi":
+            positions, debug_mask = detect_balls_roi(frame, profile.hsv_ranges, self.roi_strips,
+                                                     self.debug_label, row_windows, stopwatch)
+        elif self.mode == "pyramid":
+            positions, debug_mask = detect_balls_pyramid(frame, profile.hsv_ranges, self.roi_strips,
+                                                         self.debug_label, row_windows, stopwatch)
+        elif self.mode == "fused":
+            hsv = preprocess(frame, stopwatch)
+            positions, debug_mask = detect_balls_fused(hsv, profile.label_lut, self.debug_label, stopwatch)
+        else:
+            hsv = preprocess(frame, stopwatch)
+            positions, debug_mask = detect_balls_per_color(hsv, profile.hsv_ranges, self.debug_label, stopwatch)
+        if telemetry is not None:
+            telemetry.record_detections(positions)
+
+        if self.mirrored:
+            # Mirror effect, applied to coordinates rather than the image
+            positions = {label: (mirror_x(pos[0]), pos[1]) if pos else None
+                         for label, pos in positions.items()}
+
+        velocities = {label: None for label in positions}
+        bridged = {label: False for label in positions}
+        if self.tracker:
+            positions = self.tracker.update(positions, timestamp)
+            velocities = self.tracker.velocities
+            bridged = self.tracker.bridged
+            if stopwatch:
+                stopwatch.lap("track")
+        values = self.mapper.map_positions(positions)
+        if stopwatch:
+            stopwatch.lap("mapping")
+            telemetry.record_stopwatch(stopwatch)
+        return {"positions": positions, "velocities": velocities, "bridged": bridged, "values": values,
+                "hsv": hsv, "debug_mask": debug_mask}
@@ -0,0 +1,119 @@
+import http.client
+import json
+import socket
+from urllib.parse import quote, urlsplit
+
+# =============================================================================
+# Fleet Client
+# =============================================================================
+# Pushes this device's sessions to the fleet ingestion service
+# (fleet_server.py). One HTTP/1.1 connection is opened on first use and kept
+# for every following request; if the server has closed it in the meantime,
+# the request is retried once on a fresh connection. Batches are idempotent
+# on the server (keyed by device and session id), so a retry never
+# double-counts. FleetTarget plugs the client into a SyncWorker
+# (sync_queue.py), which provides the outbox, batching and backoff.
+
+FLEET_BATCH_SIZE = 200        # sessions per request
+FLEET_TIMEOUT = 10.0          # seconds
+
+
+class FleetError(IOError):
+    pass
+
+
+class FleetClient:
+    """Persistent connection to a fleet service at `url` (e.g. http://fleet.local:8600)."""
+    def __init__(self, url, device_id, ward=None, timeout=FLEET_TIMEOUT, keep_alive=True):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported fleet URL: {url}")
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip("/")
+        self.device_id = device_id
+        self.ward = ward
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.connections = 0       # connections opened, for diagnostics
+        self._conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        self._conn = cls(self.host, self.port, timeout=self.timeout)
+        self.connections += 1
+        return self._conn
+
+    def request(self, method, path, payload=None):
+        """Send one request and return the decoded JSON response (None for 404)."""
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        if not self.keep_alive:
+            headers["Connection"] = "close"
+        for attempt in (0, 1):
+            reused = self._conn is not None
+            conn = self._conn or self._connect()
+            try:
+                conn.request(method, self.base_path + path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.close()
+                # A kept-alive connection may have been closed by the server: retry once.
+                if reused and attempt == 0 and not isinstance(e, socket.timeout):
+                    continue
+                raise FleetError(f"{method} {path} failed: {e}") from e
+            if not self.keep_alive or response.will_close:
+                self.close()
+            break
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise FleetError(f"{method} {path} returned {response.status}: {data[:200]!r}")
+        return json.loads(data)
+
+    def push(self, rows):
+        """Upload (id, card_id, timestamp, blue, orange, green) rows. Returns (accepted, duplicates)."""
+        result = self.request("POST", "/sessions", {
+            "device_id": self.device_id, "ward": self.ward, "sessions": [list(row) for row in rows]})
+        return result["accepted"], result["duplicates"]
+
+    def patient_summary(self, card_id):
+        return self.request("GET", "/patients/" + quote(str(card_id), safe=""))
+
+    def ward_summary(self, ward=None):
+        return self.request("GET", "/wards/" + quote(str(ward or self.ward), safe=""))
+
+    def health(self):
+        return self.request("GET", "/health")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class FleetTarget:
+    """SyncWorker target that uploads pending sessions to the fleet service in batches."""
+    def __init__(self, client, batch_size=FLEET_BATCH_SIZE):
+        self.client = client
+        self.batch_size = batch_size
+        self.key = f"fleet:{client.url}"
+
+    def __str__(self):
+        return self.client.url
+
+    def ready(self):
+        pass
+
+    def deliver(self, store, synced_id):
+        """Push everything after `synced_id`; progress is kept per batch if a later one fails."""
+        while True:
+            rows = store.rows(synced_id, limit=self.batch_size)
+            if not rows:
+                return synced_id
+            self.client.push(rows)
+            synced_id = rows[-1][0]
+            store.mark_synced(self.key, synced_id)
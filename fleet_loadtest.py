@@ -0,0 +1,122 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from fleet_client import FleetClient
+from fleet_server import FleetServer, FleetStore
+from telemetry import percentile
+
+# =============================================================================
+# Fleet Load Test
+# =============================================================================
+# Simulates a fleet of devices pushing session batches to the ingestion
+# service at the same time, each device on its own thread with its own
+# (kept-alive) connection, then checks that every session arrived exactly once.
+# Without --url a local stand-in server is started on a temporary database.
+#
+#   python fleet_loadtest.py --devices 40 --batches 25 --batch-size 20
+#   python fleet_loadtest.py --url http://fleet.local:8600 --no-keep-alive
+
+
+def device_sessions(device, batches, batch_size, patients, rng):
+    """[[id, card_id, timestamp, blue, orange, green], ...] batches for one device."""
+    start = datetime(2024, 1, 1) + timedelta(minutes=device)
+    session_id = 0
+    result = []
+    for _ in range(batches):
+        batch = []
+        for _ in range(batch_size):
+            session_id += 1
+            timestamp = (start + timedelta(hours=session_id)).strftime("%Y-%m-%d %H:%M:%S")
+            batch.append([session_id, f"card-{rng.randrange(patients)}", timestamp,
+                          rng.randrange(0, 601), rng.randrange(600, 901), rng.randrange(900, 1201)])
+        result.append(batch)
+    return result
+
+
+def run_device(client, batches, latencies, errors, resend):
+    for batch in batches:
+        start = time.perf_counter()
+        try:
+            client.push(batch)
+            if resend:
+                # A retried upload after a lost response must not double-count.
+                client.push(batch)
+        except Exception as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the fleet ingestion service.")
+    parser.add_argument("--url", help="service to test (default: start a local stand-in)")
+    parser.add_argument("--devices", type=int, default=40)
+    parser.add_argument("--batches", type=int, default=25, help="batches per device")
+    parser.add_argument("--batch-size", type=int, default=20, help="sessions per batch")
+    parser.add_argument("--patients", type=int, default=500)
+    parser.add_argument("--wards", type=int, default=4)
+    parser.add_argument("--no-keep-alive", action="store_true", help="open a connection per request")
+    parser.add_argument("--resend", action="store_true", help="push every batch twice")
+    args = parser.parse_args()
+
+    server = store = None
+    if args.url:
+        url = args.url
+    else:
+        temp_dir = tempfile.mkdtemp()
+        store = FleetStore(os.path.join(temp_dir, "fleet.db"))
+        server = FleetServer(store, port=0)
+        server.start()
+        url = server.url
+        print(f"Local stand-in server at {url} ({store.path})")
+
+    rng = random.Random(0)
+    run_id = f"loadtest-{int(time.time())}"
+    latencies, errors, threads, clients = [], [], [], []
+    for device in range(args.devices):
+        ward = f"{run_id}-ward-{device % args.wards}"
+        client = FleetClient(url, f"{run_id}-device-{device}", ward, keep_alive=not args.no_keep_alive)
+        batches = device_sessions(device, args.batches, args.batch_size, args.patients, rng)
+        clients.append(client)
+        threads.append(threading.Thread(target=run_device,
+                                        args=(client, batches, latencies, errors, args.resend)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    sent = args.devices * args.batches * args.batch_size
+    requests = len(latencies) * (2 if args.resend else 1)
+    latencies_ms = sorted(s * 1000 for s in latencies)
+    print(f"{args.devices} devices, {sent} sessions in {requests} requests, {elapsed:.2f} s")
+    print(f"  throughput  {sent / elapsed:8.0f} sessions/s  {requests / elapsed:6.0f} requests/s")
+    if latencies_ms:
+        print("  latency ms  " + "  ".join(f"p{p} {percentile(latencies_ms, p):.1f}" for p in (50, 95, 99))
+              + f"  max {latencies_ms[-1]:.1f}")
+    print(f"  connections {sum(c.connections for c in clients)}  errors {len(errors)}")
+    for error in errors[:5]:
+        print("   ", error)
+
+    # Every session must be counted exactly once in the ward rollups.
+    checker = FleetClient(url, "loadtest-check")
+    counted = sum((checker.ward_summary(f"{run_id}-ward-{w}") or {"sessions": 0})["sessions"]
+                  for w in range(args.wards))
+    checker.close()
+    print(f"  ward rollups count {counted} of {sent} sessions: {'OK' if counted == sent else 'MISMATCH'}")
+
+    if server:
+        server.stop()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from session_store import READING_COLUMNS
+
+# =============================================================================
+# Fleet Ingestion Service
+# =============================================================================
+# Devices no longer share one synced spreadsheet. Each unit pushes its saved
+# sessions in batches to this service (fleet_client.py), which stores them in
+# one SQLite database in WAL mode. A session is identified by (device_id, its
+# id on the device), so a batch resent after a timeout is not counted twice.
+# Per-patient and per-ward/per-day rollups are updated in the same transaction
+# as the insert, so aggregate queries read one or a few precomputed rows
+# however many sessions are on file. The HTTP server speaks HTTP/1.1 with
+# Content-Length on every response, so devices keep their connection open.
+#
+#   python fleet_server.py --port 8600 --db fleet_sessions.db
+#
+#   POST /sessions        {"device_id", "ward", "sessions": [[id, card_id, timestamp, blue, orange, green], ...]}
+#   GET  /patients/<card> per-patient aggregate
+#   GET  /wards/<ward>    per-ward aggregate with a per-day breakdown
+#   GET  /health
+
+FLEET_PORT = 8600
+FLEET_DB_PATH = "fleet_sessions.db"
+FLEET_MAX_BATCH = 1000        # sessions accepted per request
+FLEET_LISTEN_BACKLOG = 128    # pending connections; the default of 5 resets devices connecting together
+
+
+def _best(column):
+    # MAX() of anything and NULL is NULL, hence the COALESCEs
+    return (f"best_{column} = MAX(COALESCE(best_{column}, excluded.best_{column}), "
+            f"COALESCE(excluded.best_{column}, best_{column}))")
+
+
+def _reading_stats(row, offset):
+    # (best_*, total_*, counted_*) columns starting at `offset` -> {"best": {...}, "mean": {...}}
+    n = len(READING_COLUMNS)
+    best = dict(zip(READING_COLUMNS, row[offset:offset + n]))
+    totals = row[offset + n:offset + 2 * n]
+    counts = row[offset + 2 * n:offset + 3 * n]
+    mean = {column: (total / count if count else None)
+            for column, total, count in zip(READING_COLUMNS, totals, counts)}
+    return {"best": best, "mean": mean}
+
+
+ROLLUP_COLUMNS = ", ".join(f"best_{c} INTEGER, total_{c} INTEGER NOT NULL DEFAULT 0, "
+                           f"counted_{c} INTEGER NOT NULL DEFAULT 0" for c in READING_COLUMNS)
+STAT_COLUMNS = ", ".join([f"best_{c}" for c in READING_COLUMNS] + [f"total_{c}" for c in READING_COLUMNS]
+                         + [f"counted_{c}" for c in READING_COLUMNS])
+STAT_UPDATES = ",\n".join([_best(c) for c in READING_COLUMNS]
+                          + [f"total_{c} = total_{c} + excluded.total_{c}" for c in READING_COLUMNS]
+                          + [f"counted_{c} = counted_{c} + excluded.counted_{c}" for c in READING_COLUMNS])
+
+
+class FleetStore:
+    """Sessions from every device plus their rollups. Safe to share between threads."""
+    def __init__(self, path=FLEET_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                session_id INTEGER NOT NULL,
+                ward TEXT,
+                card_id TEXT NOT NULL,
+                timestamp TEXT,
+                blue INTEGER,
+                orange INTEGER,
+                green INTEGER,
+                received_at REAL,
+                UNIQUE (device_id, session_id)
+            )""")
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS patient_rollup (
+                card_id TEXT PRIMARY KEY,
+                ward TEXT,
+                sessions INTEGER NOT NULL DEFAULT 0,
+                last_timestamp TEXT,
+                {ROLLUP_COLUMNS}
+            )""")
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS ward_rollup (
+                ward TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sessions INTEGER NOT NULL DEFAULT 0,
+                {ROLLUP_COLUMNS},
+                PRIMARY KEY (ward, day)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS patient_rollup_ward ON patient_rollup (ward)")
+        self.conn.commit()
+
+    def ingest(self, device_id, ward, sessions):
+        """
+        Store one batch of [id, card_id, timestamp, blue, orange, green] rows
+        from `device_id`. Returns (accepted, duplicates).
+        """
+        device_id, ward = str(device_id), str(ward or "")
+        received_at = time.time()
+        accepted = 0
+        with self._lock:
+            try:
+                for row in sessions:
+                    session_id, card_id, timestamp = int(row[0]), str(row[1]), row[2]
+                    readings = list(row[3:3 + len(READING_COLUMNS)])
+                    readings += [None] * (len(READING_COLUMNS) - len(readings))
+                    cursor = self.conn.execute(
+                        "INSERT OR IGNORE INTO sessions (device_id, session_id, ward, card_id, timestamp, "
+                        "blue, orange, green, received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [device_id, session_id, ward, card_id, timestamp] + readings + [received_at])
+                    if cursor.rowcount != 1:
+                        continue
+                    accepted += 1
+                    stats = readings + [r or 0 for r in readings] + [int(r is not None) for r in readings]
+                    self.conn.execute(f"""
+                        INSERT INTO patient_rollup (card_id, ward, sessions, last_timestamp, {STAT_COLUMNS})
+                        VALUES (?, ?, 1, ?, {", ".join("?" * len(stats))})
+                        ON CONFLICT (card_id) DO UPDATE SET
+                            ward = excluded.ward,
+                            sessions = sessions + 1,
+                            last_timestamp = MAX(COALESCE(last_timestamp, excluded.last_timestamp),
+                                                 COALESCE(excluded.last_timestamp, last_timestamp)),
+                            {STAT_UPDATES}
+                        """, [card_id, ward, timestamp] + stats)
+                    day = timestamp[:10] if timestamp else "undated"
+                    self.conn.execute(f"""
+                        INSERT INTO ward_rollup (ward, day, sessions, {STAT_COLUMNS})
+                        VALUES (?, ?, 1, {", ".join("?" * len(stats))})
+                        ON CONFLICT (ward, day) DO UPDATE SET
+                            sessions = sessions + 1,
+                            {STAT_UPDATES}
+                        """, [ward, day] + stats)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return accepted, len(sessions) - accepted
+
+    def patient(self, card_id):
+        """{"card_id", "ward", "sessions", "last_timestamp", "best", "mean"}, or None if unknown."""
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT ward, sessions, last_timestamp, {STAT_COLUMNS} FROM patient_rollup WHERE card_id = ?",
+                (str(card_id),)).fetchone()
+        if row is None:
+            return None
+        return dict(card_id=str(card_id), ward=row[0], sessions=row[1], last_timestamp=row[2],
+                    **_reading_stats(row, 3))
+
+    def ward(self, ward, days=30):
+        """Totals for a ward plus its last `days` days, newest first, or None if unknown."""
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT day, sessions, {STAT_COLUMNS} FROM ward_rollup WHERE ward = ? ORDER BY day DESC",
+                (ward,)).fetchall()
+            patients = self.conn.execute(
+                "SELECT COUNT(*) FROM patient_rollup WHERE ward = ?", (ward,)).fetchone()[0]
+        if not rows:
+            return None
+        # Totals over all days: sum the per-day rollups
+        n = len(READING_COLUMNS)
+        total = [None] * n + [0] * (2 * n)
+        for row in rows:
+            for i, value in enumerate(row[2:]):
+                if i < n:
+                    if value is not None and (total[i] is None or value > total[i]):
+                        total[i] = value
+                else:
+                    total[i] += value
+        return dict(ward=ward, patients=patients, sessions=sum(row[1] for row in rows),
+                    **_reading_stats(total, 0),
+                    days=[dict(day=row[0], sessions=row[1], **_reading_stats(row, 2)) for row in rows[:days]])
+
+    def counts(self):
+        with self._lock:
+            sessions, devices = self.conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT device_id) FROM sessions").fetchone()
+        return {"sessions": sessions, "devices": devices}
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class FleetHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = FLEET_LISTEN_BACKLOG
+
+
+class FleetServer:
+    """FleetStore behind HTTP, served from a daemon thread (or serve_forever())."""
+    def __init__(self, store, port=FLEET_PORT, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive: devices reuse one connection for all their requests
+            protocol_version = "HTTP/1.1"
+            # Buffered: headers and body leave in one send (flushed after each request).
+            # Sent separately, Nagle and the client's delayed ACK add ~40 ms per request.
+            wbufsize = -1
+
+            def send_json(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parts = [unquote(p) for p in self.path.split("?")[0].strip("/").split("/")]
+                if parts == ["health"]:
+                    self.send_json(200, dict(status="ok", **store.counts()))
+                    return
+                result = None
+                if len(parts) == 2 and parts[0] == "patients":
+                    result = store.patient(parts[1])
+                elif len(parts) == 2 and parts[0] == "wards":
+                    result = store.ward(parts[1])
+                if result is None:
+                    self.send_json(404, {"error": "not found"})
+                else:
+                    self.send_json(200, result)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if self.path.rstrip("/") != "/sessions":
+                    self.send_json(404, {"error": "not found"})
+                    return
+                try:
+                    batch = json.loads(body)
+                    sessions = batch["sessions"]
+                    if len(sessions) > FLEET_MAX_BATCH:
+                        raise ValueError(f"more than {FLEET_MAX_BATCH} sessions in one batch")
+                    accepted, duplicates = store.ingest(batch["device_id"], batch.get("ward"), sessions)
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                self.send_json(200, {"accepted": accepted, "duplicates": duplicates})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.store = store
+        self.server = FleetHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fleet-http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect therapy sessions from a fleet of devices.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=FLEET_PORT)
+    parser.add_argument("--db", default=FLEET_DB_PATH)
+    args = parser.parse_args()
+    store = FleetStore(args.db)
+    server = FleetServer(store, args.port, args.host)
+    print(f"Fleet service listening on {args.host}:{server.port}, database {args.db}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+        store.close()
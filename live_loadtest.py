@@ -0,0 +1,159 @@
+import argparse
+import json
+import random
+import threading
+import time
+
+from live_server import LiveHub, LiveServer
+from live_stream import LiveDecoder, LivePublisher, WebSocketClient
+from telemetry import percentile
+
+# =============================================================================
+# Live Stream Load Test
+# =============================================================================
+# Many devices stream readings at the display rate to one hub while
+# dashboards watch all of them. Reports what publish() costs the caller (the
+# therapy screen), bytes per sample against one plain JSON message per
+# sample, end-to-end latency from publish() to a dashboard, and - with
+# --slow-watcher - that a lagging dashboard is dropped to the latest readings
+# without delaying anyone else. Every dashboard must end on each device's last
+# published readings. Without --url a local stand-in hub is started.
+#
+#   python live_loadtest.py --devices 50 --rate 30 --seconds 10 --slow-watcher
+#   python live_loadtest.py --url ws://dashboard.local:8700
+
+
+class DashboardClient:
+    """Watches every device through the hub and records what arrives."""
+    def __init__(self, url, delay=0.0, receive_buffer=None):
+        self.client = WebSocketClient(url + "/watch", receive_buffer=receive_buffer)
+        self.delay = delay          # seconds spent per message (a slow dashboard)
+        self.decoders = {}
+        self.latencies = []
+        self.samples = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                text = self.client.receive()
+            except (OSError, ValueError):
+                return
+            if text is None:
+                return
+            now = time.time()
+            message = json.loads(text)
+            samples = self.decoders.setdefault(message["device"], LiveDecoder()).decode(message)
+            self.samples += len(samples)
+            self.latencies.extend(now - timestamp for timestamp, _ in samples)
+            if self.delay:
+                time.sleep(self.delay)
+
+    def latest(self, device):
+        decoder = self.decoders.get(device)
+        return decoder.last[1] if decoder and decoder.last else None
+
+    def close(self):
+        self.client.close()
+        self.thread.join(2.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test live streaming of readings.")
+    parser.add_argument("--url", help="hub to test (default: start a local stand-in)")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=30.0, help="readings per second per device")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--watchers", type=int, default=2, help="dashboards watching every device")
+    parser.add_argument("--slow-watcher", action="store_true", help="add a dashboard that reads slowly")
+    parser.add_argument("--still", type=float, default=0.3, help="share of readings that repeat the last one")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        server = LiveServer(LiveHub(), port=0)
+        server.start()
+        url = server.url
+        print(f"Local stand-in hub at {url}")
+
+    dashboards = [DashboardClient(url) for _ in range(args.watchers)]
+    # A dashboard on a slow link: little in flight, and 20 ms spent on every message
+    slow = DashboardClient(url, delay=0.02, receive_buffer=4096) if args.slow_watcher else None
+    run_id = f"loadtest-{int(time.time())}"
+    publishers = [LivePublisher(url, f"{run_id}-device-{i}") for i in range(args.devices)]
+    for i, publisher in enumerate(publishers):
+        publisher.start()
+        publisher.start_session(f"card-{i}")
+
+    # One loop drives every device, as the Tk thread drives one: publish() must stay cheap
+    rng = random.Random(0)
+    values = [{"Blue": 0, "Orange": 600, "Green": 900} for _ in publishers]
+    plain_bytes = 0
+    publish_costs = []
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    tick = start
+    while tick - start < args.seconds:
+        now = time.time()
+        for i, publisher in enumerate(publishers):
+            if rng.random() >= args.still:
+                for label, (low, high) in (("Blue", (0, 600)), ("Orange", (600, 900)), ("Green", (900, 1200))):
+                    values[i][label] = min(max(values[i][label] + rng.randrange(-20, 21), low), high)
+            plain_bytes += len(json.dumps({"device": publisher.device_id, "session": f"card-{i}",
+                                           "timestamp": now, **values[i]}))
+            before = time.perf_counter()
+            publisher.publish(values[i], now)
+            publish_costs.append(time.perf_counter() - before)
+        tick += interval
+        time.sleep(max(0.0, tick - time.perf_counter()))
+    elapsed = time.perf_counter() - start
+
+    # Every dashboard, slow or not, must end on each device's last readings
+    final = [tuple(v[label] for label in p.labels) for p, v in zip(publishers, values)]
+    watching = [(f"dashboard {i}", d) for i, d in enumerate(dashboards)] + ([("slow dashboard", slow)] if slow else [])
+    caught_up = {}
+    deadline = time.perf_counter() + 15.0
+    while len(caught_up) < len(watching) and time.perf_counter() < deadline:
+        for name, dashboard in watching:
+            if name not in caught_up and all(dashboard.latest(p.device_id) == v for p, v in zip(publishers, final)):
+                caught_up[name] = time.perf_counter() - start - elapsed
+        time.sleep(0.01)
+    for publisher in publishers:
+        publisher.stop()
+    statuses = [p.status() for p in publishers]
+    published = sum(s["published"] for s in statuses)
+    sent = sum(s["sent"] for s in statuses)
+    bytes_sent = sum(s["bytes_sent"] for s in statuses)
+    costs_us = sorted(c * 1e6 for c in publish_costs)
+    print(f"{args.devices} devices at {args.rate:.0f} readings/s for {elapsed:.1f} s: "
+          f"{published} readings ({published / elapsed:.0f}/s)")
+    print(f"  publish()   p50 {percentile(costs_us, 50):.1f} us  p99 {percentile(costs_us, 99):.1f} us  "
+          f"max {costs_us[-1]:.1f} us")
+    print(f"  sent        {sent} samples ({sum(s['unchanged'] for s in statuses)} unchanged skipped, "
+          f"{sum(s['dropped'] for s in statuses)} dropped) in {sum(s['messages'] for s in statuses)} messages, "
+          f"{sum(s['connections'] for s in statuses)} connections, {sum(s['failures'] for s in statuses)} failures")
+    print(f"  bytes       {bytes_sent / max(published, 1):.1f} per reading vs {plain_bytes / max(published, 1):.1f} "
+          f"as one JSON message each ({plain_bytes / max(bytes_sent, 1):.1f}x less)")
+    for name, dashboard in watching:
+        latencies_ms = sorted(s * 1000 for s in dashboard.latencies)
+        line = f"  {name:<15} {dashboard.samples} samples"
+        if latencies_ms:
+            line += ", latency ms " + " ".join(f"p{p} {percentile(latencies_ms, p):.1f}" for p in (50, 95, 99))
+        correct = sum(dashboard.latest(p.device_id) == v for p, v in zip(publishers, final))
+        if name in caught_up:
+            line += f", on the latest readings {caught_up[name]:.2f} s after the last one"
+        print(line + f" ({correct}/{len(publishers)} devices)")
+    if server:
+        print(f"  hub         {server.hub.status()}")
+
+    for dashboard in dashboards + ([slow] if slow else []):
+        dashboard.close()
+    if server:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
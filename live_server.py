@@ -0,0 +1,239 @@
+import argparse
+import json
+import socket
+import socketserver
+import threading
+from collections import deque
+from urllib.parse import unquote
+
+from live_stream import (LIVE_TIMEOUT, OP_CLOSE, OP_PONG, OP_TEXT, LiveDecoder, WebSocketError, accept_key,
+                         encode_frame, read_message)
+
+# =============================================================================
+# Live Stream Hub
+# =============================================================================
+# Stand-in for the dashboard side of live_stream.py: devices connect to
+# /publish/<device>, dashboards to /watch (every device) or /watch/<device>,
+# and every message a device sends is relayed to the dashboards watching it.
+# The hub decodes each device's stream, so it always knows the current
+# readings: a dashboard that connects gets a keyframe per device straight
+# away, and a dashboard that falls behind (more than LIVE_WATCHER_QUEUE
+# messages waiting) has its backlog for that device replaced by one keyframe
+# of the latest readings instead of slowing the devices or the other
+# dashboards down.
+#
+#   python live_server.py --port 8700
+
+LIVE_PORT = 8700
+LIVE_WATCHER_QUEUE = 64       # messages waiting for one dashboard before it is dropped to the latest
+LIVE_LISTEN_BACKLOG = 128
+LIVE_WATCHER_SNDBUF = 8192    # bytes; a small socket buffer makes a lagging dashboard show up in its queue
+
+
+class Watcher:
+    """Outgoing message queue of one dashboard connection."""
+    def __init__(self, device=None):
+        self.device = device        # None = every device
+        self.queue = deque()        # (device, message)
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def push(self, device, message, keyframe=None):
+        with self.ready:
+            if len(self.queue) >= LIVE_WATCHER_QUEUE:
+                # Lagging: replace this device's backlog with one keyframe of the latest
+                # readings, in the place of its oldest message so it is not sent last again
+                latest = keyframe() if keyframe is not None else message
+                queue, self.queue = self.queue, deque()
+                for item in queue:
+                    if item[0] != device:
+                        self.queue.append(item)
+                    elif latest is not None:
+                        self.queue.append((device, latest))
+                        latest = None
+                    else:
+                        self.dropped += 1
+                if latest is None:
+                    self.dropped += 1       # the new message itself is folded into the keyframe
+                    self.ready.notify()
+                    return
+                message = latest
+            self.queue.append((device, message))
+            self.ready.notify()
+
+    def pop(self, timeout):
+        with self.ready:
+            if not self.queue and not self.closed:
+                self.ready.wait(timeout)
+            return self.queue.popleft()[1] if self.queue else None
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class LiveHub:
+    """Relays device streams to dashboards. Safe to share between threads."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decoders = {}          # device -> LiveDecoder
+        self.watchers = set()
+        self.messages = 0
+        self.samples = 0
+
+    def publish(self, device, text):
+        message = json.loads(text)
+        # Relayed as sent, with the device named for dashboards watching several
+        text = '{"device":' + json.dumps(device) + "," + text[1:]
+        with self._lock:
+            decoder = self.decoders.setdefault(device, LiveDecoder())
+            self.samples += len(decoder.decode(message))
+            self.messages += 1
+            watchers = [w for w in self.watchers if w.device in (None, device)]
+        # A stream that is out of sync (a message was lost) is only relayed again from its next keyframe
+        if decoder.in_sync or message.get("end"):
+            for watcher in watchers:
+                watcher.push(device, text, lambda: self.keyframe(device))
+
+    def keyframe(self, device):
+        with self._lock:
+            decoder = self.decoders.get(device)
+            keyframe = decoder.keyframe() if decoder else None
+        return '{"device":' + json.dumps(device) + "," + keyframe[1:] if keyframe else None
+
+    def add_watcher(self, watcher):
+        with self._lock:
+            self.watchers.add(watcher)
+            devices = [d for d in self.decoders if watcher.device in (None, d)]
+        for device in devices:
+            keyframe = self.keyframe(device)
+            if keyframe:
+                watcher.push(device, keyframe)
+
+    def remove_watcher(self, watcher):
+        with self._lock:
+            self.watchers.discard(watcher)
+        watcher.close()
+
+    def status(self):
+        with self._lock:
+            return {"devices": len(self.decoders), "watchers": len(self.watchers), "messages": self.messages,
+                    "samples": self.samples, "dropped": sum(w.dropped for w in self.watchers)}
+
+
+class LiveTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = LIVE_LISTEN_BACKLOG
+
+
+class LiveServer:
+    """LiveHub behind WebSockets, served from a daemon thread."""
+    def __init__(self, hub, port=LIVE_PORT, host="127.0.0.1"):
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.send_lock = threading.Lock()    # pongs are sent from the reading thread too
+                self.request.settimeout(LIVE_TIMEOUT)
+                path = self.handshake()
+                if path is None:
+                    return
+                self.request.settimeout(None)
+                parts = [unquote(p) for p in path.split("?")[0].strip("/").split("/")]
+                try:
+                    if len(parts) == 2 and parts[0] == "publish":
+                        self.serve_publisher(parts[1])
+                    elif parts[0] == "watch" and len(parts) <= 2:
+                        self.serve_watcher(parts[1] if len(parts) == 2 else None)
+                    else:
+                        self.send(b"unknown path", OP_CLOSE)
+                except (OSError, WebSocketError):
+                    pass
+
+            def handshake(self):
+                try:
+                    request_line = self.rfile.readline(8192).decode("latin-1")
+                    headers = {}
+                    while True:
+                        line = self.rfile.readline(8192).decode("latin-1").strip()
+                        if not line:
+                            break
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                except OSError:
+                    return None
+                key = headers.get("sec-websocket-key")
+                if not request_line.startswith("GET ") or not key or "websocket" not in headers.get("upgrade", "").lower():
+                    self.wfile.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return None
+                self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                                  f"Connection: Upgrade\r\nSec-WebSocket-Accept: {accept_key(key)}\r\n\r\n").encode())
+                return request_line.split()[1]
+
+            def send(self, payload, opcode=OP_TEXT):
+                with self.send_lock:
+                    self.request.sendall(encode_frame(payload, opcode))
+
+            def serve_publisher(self, device):
+                while True:
+                    opcode, payload = read_message(self.rfile, lambda p: self.send(p, OP_PONG))
+                    if opcode == OP_CLOSE:
+                        self.send(b"", OP_CLOSE)
+                        return
+                    if opcode == OP_TEXT:
+                        try:
+                            hub.publish(device, payload.decode())
+                        except (ValueError, KeyError, TypeError) as e:
+                            print(f"Bad live message from {device}: {e}")
+
+            def serve_watcher(self, device):
+                watcher = Watcher(device)
+                self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, LIVE_WATCHER_SNDBUF)
+                # Reads only to notice the dashboard closing (and answer its pings)
+                def read():
+                    try:
+                        while read_message(self.rfile, lambda p: self.send(p, OP_PONG))[0] != OP_CLOSE:
+                            pass
+                    except (OSError, WebSocketError):
+                        pass
+                    watcher.close()
+
+                threading.Thread(target=read, name="live-watch-read", daemon=True).start()
+                hub.add_watcher(watcher)
+                self.request.settimeout(LIVE_TIMEOUT)
+                try:
+                    while not watcher.closed:
+                        message = watcher.pop(1.0)
+                        if message is not None:
+                            self.send(message.encode())
+                finally:
+                    hub.remove_watcher(watcher)
+
+        self.hub = hub
+        self.server = LiveTCPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"ws://{host}:{self.port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="live-hub", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay live readings from devices to dashboards.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=LIVE_PORT)
+    args = parser.parse_args()
+    server = LiveServer(LiveHub(), args.port, args.host)
+    print(f"Live stream hub listening on {args.host}:{server.port} (/publish/<device>, /watch[/<device>])")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
@@ -0,0 +1,408 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+# =============================================================================
+# Live Streaming
+# =============================================================================
+# Streams the Blue/Orange/Green readings of a running session to a dashboard
+# hub (live_server.py) over a WebSocket, so remote staff can watch an attempt
+# as it happens. The therapy screen calls publish() for every displayed
+# result; that only appends to a short in-memory list. A sender thread sends
+# what has accumulated every LIVE_BATCH_INTERVAL as one message, skipping
+# samples that did not change and delta-encoding the rest: each sample is
+# [ms since the previous sample, change of each reading]. A keyframe (first
+# sample absolute) starts every session, follows any gap and is repeated every
+# LIVE_KEYFRAME_INTERVAL, so a receiver that missed something resyncs quickly.
+# When the hub or the network can't keep up, nothing waits: samples pile up
+# to LIVE_MAX_PENDING, after which all but the newest are dropped and the
+# next message is a keyframe (latest wins). A lost connection is reopened
+# with exponential backoff.
+#
+# Messages (JSON text frames; the device is named once, in the URL):
+#   {"seq", "t0", "samples": [[dt_ms, d1, d2, d3], ...]}
+#   keyframes add "key": true, "session" and "labels"; {"seq", "end": true} ends a session.
+# The hub adds "device" to each message it relays to dashboards.
+
+LIVE_BATCH_INTERVAL = 0.05     # seconds between messages
+LIVE_KEYFRAME_INTERVAL = 2.0   # seconds between keyframes (also a heartbeat while nothing changes)
+LIVE_MAX_PENDING = 64          # samples held while sending is slow before dropping to the latest
+LIVE_TIMEOUT = 5.0             # seconds for connecting and for one send
+LIVE_BACKOFF_MIN = 1.0
+LIVE_BACKOFF_MAX = 30.0
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+# -------------------------------
+# WebSocket framing (RFC 6455)
+# -------------------------------
+class WebSocketError(IOError):
+    pass
+
+
+def accept_key(key):
+    """Sec-WebSocket-Accept for a client's Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+
+def encode_frame(payload, opcode=OP_TEXT, mask=False):
+    """One unfragmented frame; clients must mask what they send, servers must not."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, (0x80 if mask else 0) | length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, (0x80 if mask else 0) | 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, (0x80 if mask else 0) | 127, length)
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + apply_mask(payload, key)
+
+
+def apply_mask(payload, key):
+    # XOR with the repeated 4-byte key, as one big-integer operation
+    if not payload:
+        return payload
+    repeated = (key * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(payload), "big")
+
+
+def read_exact(stream, count):
+    data = stream.read(count)
+    if data is None or len(data) < count:
+        raise WebSocketError("connection closed")
+    return data
+
+
+def read_frame(stream):
+    """(opcode, payload) of the next frame from a buffered binary stream."""
+    first, second = read_exact(stream, 2)
+    opcode, length = first & 0x0F, second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", read_exact(stream, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", read_exact(stream, 8))[0]
+    key = read_exact(stream, 4) if second & 0x80 else None
+    payload = read_exact(stream, length) if length else b""
+    if key:
+        payload = apply_mask(payload, key)
+    return first & 0x80, opcode, payload
+
+
+def read_message(stream, send_pong=None):
+    """
+    Next complete data message as (opcode, payload), joining fragments and
+    answering pings on the way. Returns (OP_CLOSE, payload) when the peer closes.
+    """
+    parts = []
+    message_opcode = None
+    while True:
+        fin, opcode, payload = read_frame(stream)
+        if opcode == OP_CLOSE:
+            return OP_CLOSE, payload
+        if opcode == OP_PING:
+            if send_pong:
+                send_pong(payload)
+            continue
+        if opcode == OP_PONG:
+            continue
+        if opcode != OP_CONTINUATION:
+            message_opcode = opcode
+        parts.append(payload)
+        if fin:
+            return message_opcode, b"".join(parts)
+
+
+class WebSocketClient:
+    """Client side of one WebSocket connection (ws:// only), for sending small messages."""
+    def __init__(self, url, timeout=LIVE_TIMEOUT, receive_buffer=None):
+        parts = urlsplit(url)
+        if parts.scheme != "ws":
+            raise ValueError(f"Unsupported live stream URL: {url}")
+        if receive_buffer:
+            # Must be set before connecting to limit the receive window
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+            self.sock.settimeout(timeout)
+            self.sock.connect((parts.hostname, parts.port or 80))
+        else:
+            self.sock = socket.create_connection((parts.hostname, parts.port or 80), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.sock.makefile("rb")
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f"GET {parts.path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+                           "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                           f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        status = self.stream.readline().decode("latin-1")
+        headers = {}
+        while True:
+            line = self.stream.readline().decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if " 101 " not in status or headers.get("sec-websocket-accept") != accept_key(key):
+            self.close()
+            raise WebSocketError(f"WebSocket handshake failed: {status.strip()}")
+
+    def send(self, text):
+        self.sock.sendall(encode_frame(text.encode(), OP_TEXT, mask=True))
+
+    def receive(self):
+        """Next text message, or None once the server has closed the connection."""
+        opcode, payload = read_message(self.stream, lambda p: self.sock.sendall(encode_frame(p, OP_PONG, True)))
+        return None if opcode == OP_CLOSE else payload.decode()
+
+    def close(self):
+        try:
+            self.sock.sendall(encode_frame(b"", OP_CLOSE, mask=True))
+        except OSError:
+            pass
+        self.stream.close()
+        self.sock.close()
+
+
+# -------------------------------
+# Delta encoding
+# -------------------------------
+def encode_batch(session, seq, samples, previous, labels, key):
+    """
+    Message for `samples` [(timestamp, (v1, v2, v3)), ...]. A keyframe's first
+    sample is absolute; every other value is the change from the sample
+    before it (`previous`, the last sample sent, for a delta message's first).
+    """
+    rows = []
+    last_time, last_values = (samples[0][0], (0,) * len(labels)) if key else previous
+    for timestamp, values in samples:
+        rows.append([int(round((timestamp - last_time) * 1000))] +
+                    [v - p for v, p in zip(values, last_values)])
+        last_time, last_values = timestamp, values
+    message = {"seq": seq, "t0": round(samples[0][0], 3), "samples": rows}
+    if key:
+        message.update(key=True, session=session, labels=list(labels))
+        rows[0][0] = 0
+    return json.dumps(message, separators=(",", ":"))
+
+
+class LiveDecoder:
+    """Turns one device's messages back into absolute samples, detecting gaps."""
+    def __init__(self):
+        self.labels = None
+        self.session = None
+        self.seq = None
+        self.last = None          # (timestamp, values) of the last decoded sample
+        self.in_sync = False
+        self.gaps = 0
+
+    def decode(self, message):
+        """[(timestamp, values), ...] of a decoded message; [] while out of sync or for an end message."""
+        if message.get("end"):
+            self.session, self.in_sync, self.seq = None, False, message.get("seq")
+            return []
+        seq = message["seq"]
+        if message.get("key"):
+            self.labels = message.get("labels", self.labels)
+            self.session = message.get("session")
+            timestamp, values = message["t0"], (0,) * len(self.labels)
+        elif self.in_sync and seq == self.seq + 1:
+            timestamp, values = self.last
+            timestamp = message["t0"]
+        else:
+            if self.in_sync:
+                self.gaps += 1
+            self.in_sync = False
+            self.seq = seq
+            return []
+        samples = []
+        first = True
+        for row in message["samples"]:
+            if not first:
+                timestamp += row[0] / 1000.0
+            first = False
+            values = tuple(v + d for v, d in zip(values, row[1:]))
+            samples.append((timestamp, values))
+        self.seq, self.in_sync = seq, True
+        if samples:
+            self.last = samples[-1]
+        return samples
+
+    def keyframe(self):
+        """A keyframe restating the last decoded sample (what a late or lagging receiver needs)."""
+        if not self.in_sync or self.last is None:
+            return None
+        timestamp, values = self.last
+        return json.dumps({"seq": self.seq, "t0": timestamp, "samples": [[0] + list(values)],
+                           "key": True, "session": self.session, "labels": self.labels}, separators=(",", ":"))
+
+
+# -------------------------------
+# Publisher
+# -------------------------------
+class LivePublisher:
+    """
+    Streams one device's readings to the hub at `url` (e.g. ws://dashboard.local:8700)
+    from a background thread. publish() never blocks on the network.
+    """
+    def __init__(self, url, device_id, labels=("Blue", "Orange", "Green"), batch_interval=LIVE_BATCH_INTERVAL,
+                 keyframe_interval=LIVE_KEYFRAME_INTERVAL, max_pending=LIVE_MAX_PENDING, timeout=LIVE_TIMEOUT):
+        self.url = url.rstrip("/") + "/publish/" + quote(str(device_id), safe="")
+        self.device_id = str(device_id)
+        self.labels = tuple(labels)
+        self.batch_interval = batch_interval
+        self.keyframe_interval = keyframe_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.published = 0         # samples accepted by publish()
+        self.unchanged = 0         # samples skipped because no reading changed
+        self.dropped = 0           # samples dropped while sending was slow
+        self.sent = 0              # samples sent
+        self.messages = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.failures = 0
+        self._client = None
+        self._pending = []
+        self._session = None
+        self._session_changed = False
+        self._last_values = None   # last published values (for skipping unchanged samples)
+        self._last_sent = None     # (timestamp, values) last sent, the base of the next delta
+        self._last_key = 0.0
+        self._need_key = True
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-stream", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def start_session(self, session):
+        with self._lock:
+            self._session = str(session)
+            self._session_changed = True
+            self._pending.clear()
+            self._last_values = None
+            self._need_key = True
+
+    def end_session(self):
+        with self._lock:
+            if self._session is not None:
+                self._session = None
+                self._session_changed = True
+                self._pending.clear()
+
+    def publish(self, values, timestamp=None):
+        """Queue {label: reading} as of `timestamp` (time.time()); drops to the latest if sending lags."""
+        values = tuple(int(values.get(label) or 0) for label in self.labels)
+        with self._lock:
+            if self._session is None:
+                return
+            self.published += 1
+            if values == self._last_values:
+                self.unchanged += 1
+                return
+            self._last_values = values
+            self._pending.append((time.time() if timestamp is None else timestamp, values))
+            if len(self._pending) > self.max_pending:
+                self.dropped += len(self._pending) - 1
+                del self._pending[:-1]
+                self._need_key = True
+
+    def status(self):
+        with self._lock:
+            return {"url": self.url, "connected": self._client is not None, "published": self.published,
+                    "unchanged": self.unchanged, "sent": self.sent, "dropped": self.dropped,
+                    "pending": len(self._pending), "messages": self.messages, "bytes_sent": self.bytes_sent,
+                    "connections": self.connections, "failures": self.failures}
+
+    def _take_batches(self, now):
+        # Under the lock: swap out what is pending and advance the sequence state only.
+        # Returns [(seq, session, samples, previous, key), ...]; session None ends a session.
+        # Encoding is left to _encode(), outside the lock, so publish() never waits on it.
+        batches = []
+        if self._session_changed:
+            self._session_changed = False
+            if self._last_sent is not None or self._session is None:
+                self._seq += 1
+                batches.append((self._seq, None, [], None, False))
+            self._last_sent = None
+        if self._session is None:
+            return batches
+        samples, self._pending = self._pending, []
+        key = self._need_key or now - self._last_key >= self.keyframe_interval
+        if key and not samples and self._last_sent is not None:
+            samples = [(now, self._last_sent[1])]     # heartbeat: restate the current readings
+        if not samples:
+            return batches
+        self._seq += 1
+        batches.append((self._seq, self._session, samples, self._last_sent, key))
+        self._last_sent = samples[-1]
+        if key:
+            self._need_key = False
+            self._last_key = now
+        return batches
+
+    def _encode(self, batch):
+        seq, session, samples, previous, key = batch
+        if session is None:
+            return json.dumps({"seq": seq, "end": True}, separators=(",", ":"))
+        return encode_batch(session, seq, samples, previous, self.labels, key)
+
+    def _connect(self):
+        client = WebSocketClient(self.url, self.timeout)
+        with self._lock:
+            self._client = client
+            self.connections += 1
+            self._need_key = True
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stop.wait(backoff or self.batch_interval):
+            backoff = 0.0
+            try:
+                if self._client is None:
+                    # Connect only when there is something to send; meanwhile the
+                    # pending samples stay capped at the latest ones.
+                    with self._lock:
+                        due = bool(self._pending) or self._session_changed
+                    if not due:
+                        continue
+                    self._connect()
+                with self._lock:
+                    batches = self._take_batches(time.time())
+                for batch in batches:
+                    message = self._encode(batch)
+                    self._client.send(message)
+                    with self._lock:
+                        self.messages += 1
+                        self.bytes_sent += len(message)
+                        self.sent += len(batch[2])
+            except (OSError, ValueError) as e:
+                with self._lock:
+                    self.failures += 1
+                    client, self._client = self._client, None
+                    self._need_key = True
+                    failures = self.failures
+                if client is not None:
+                    client.close()
+                backoff = min(LIVE_BACKOFF_MIN * 2 ** min(failures - 1, 8), LIVE_BACKOFF_MAX)
+                print(f"Live stream to {self.url} failed ({e}); retrying in {backoff:.0f} s")
+            else:
+                with self._lock:
+                    self.failures = 0
+        if self._client is not None:
+            self._client.close()
+            self._client = None
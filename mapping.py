@@ -0,0 +1,171 @@
+import json
+import os
+import time
+
+import numpy as np
+
+# =============================================================================
+# Ball Height -> Reading
+# =============================================================================
+# The raw ball Y in the cropped frame is clamped to the calibrated range, mapped
+# onto the on-screen column (top = full scale, bottom = column minimum) and the
+# column position is converted to the column's reading. The readings shown on
+# screen and saved with a session go through exactly this arithmetic, so the
+# replay tools use it too.
+
+# The cropped camera view is 352 pixels tall. In our setup, raw ball Y values
+# never go below about 256, so any raw Y above the column (< 256) is treated as 256.
+DETECTION_Y_MIN = 256
+DETECTION_Y_MAX = 352
+
+# Reading at the bottom and top of each column
+VALUE_RANGES = {
+    "Blue":   (0, 600),
+    "Orange": (600, 900),
+    "Green":  (900, 1200),
+}
+
+# Canvas Y of the top and bottom of the columns in the therapy view
+# (RULER_TOP_MARGIN and CANVAS_HEIGHT in data.py).
+COLUMN_TOP = 50
+COLUMN_BOTTOM = 670
+
+
+def canvas_y(ball_y, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+    """
+    Map a raw ball Y to a canvas Y: ball_y <= DETECTION_Y_MIN maps to `top`,
+    ball_y >= DETECTION_Y_MAX to `bottom`.
+    """
+    clamped_y = max(ball_y, DETECTION_Y_MIN)
+    normalized = (clamped_y - DETECTION_Y_MIN) / (DETECTION_Y_MAX - DETECTION_Y_MIN)
+    normalized = max(0, min(normalized, 1))
+    return top + normalized * (bottom - top)
+
+
+def column_value(label, y, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+    """Reading for a ball drawn at canvas Y `y` in the column of `label`."""
+    low, high = VALUE_RANGES[label]
+    raw = (bottom - y) / (bottom - top) * (high - low) + low
+    return int(round(raw))
+
+
+def ball_values(positions, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+    """{label: reading} for {label: (x, y) or None}; a missing ball reads 0."""
+    return {label: column_value(label, canvas_y(pos[1], top, bottom), top, bottom) if pos else 0
+            for label, pos in positions.items()}
+
+
+# =============================================================================
+# Batch mapping and per-device calibration curves
+# =============================================================================
+# The same mapping for whole arrays of raw Y values (a session, a replayed
+# recording) in a handful of NumPy operations. Missing balls are NaN and map
+# to 0. The arithmetic is done in the same order on float64, and np.rint rounds
+# half to even like round(), so the results match ball_values exactly.
+#
+# A device can replace the linear mapping of any column with a calibration
+# curve measured against a reference spirometer: MAPPING.json holds, per color,
+# [raw ball Y, reading] points, interpolated piecewise-linearly (np.interp)
+# and held constant beyond the first and last point. Readings past the ends
+# of the column are clamped to VALUE_RANGES, and every curve has to reach the
+# top of its column, or the end-of-session confirmation could never fire.
+CURVE_FILE = "MAPPING.json"
+
+
+def canvas_y_array(ys, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+    ys = np.asarray(ys, dtype=np.float64)
+    normalized = (np.maximum(ys, DETECTION_Y_MIN) - DETECTION_Y_MIN) / (DETECTION_Y_MAX - DETECTION_Y_MIN)
+    return top + np.clip(normalized, 0, 1) * (bottom - top)
+
+
+def column_values(label, ys, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+    """Readings (int array) for raw ball Ys of one color; NaN (no ball) reads 0."""
+    ys = np.asarray(ys, dtype=np.float64)
+    low, high = VALUE_RANGES[label]
+    raw = (bottom - canvas_y_array(ys, top, bottom)) / (bottom - top) * (high - low) + low
+    return np.where(np.isnan(ys), 0, np.rint(raw)).astype(np.int64)
+
+
+def load_curves(path=CURVE_FILE):
+    """{label: (raw Ys, readings)} from a calibration file; {} if there is none."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    curves = {}
+    for label, points in data.items():
+        points = np.array(sorted(points), dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < 2:
+            raise ValueError(f"{path}: curve for {label} needs at least two [y, reading] points")
+        if label not in VALUE_RANGES:
+            raise ValueError(f"{path}: unknown color {label}")
+        low, high = VALUE_RANGES[label]
+        readings = points[:, 1]
+        if readings.max() < high:
+            raise ValueError(f"{path}: curve for {label} tops out at {readings.max():g}, "
+                             f"below the top of the column ({high})")
+        if readings.min() < low or readings.max() > high:
+            print(f"{path}: readings for {label} clamped to {low}-{high}")
+            readings = np.clip(readings, low, high)
+        curves[label] = (points[:, 0], readings)
+    return curves
+
+
+class ValueMapper:
+    """
+    Raw ball Y -> reading for every column: the device's calibration curve
+    where one is configured, the legacy linear mapping otherwise.
+    """
+    def __init__(self, curves=None, top=COLUMN_TOP, bottom=COLUMN_BOTTOM):
+        self.curves = curves or {}
+        self.top = top
+        self.bottom = bottom
+
+    @classmethod
+    def from_file(cls, path=CURVE_FILE, **kwargs):
+        return cls(load_curves(path), **kwargs)
+
+    def value(self, label, y):
+        """Reading for one raw Y (None = no ball)."""
+        if y is None:
+            return 0
+        if label in self.curves:
+            return int(round(float(np.interp(y, *self.curves[label]))))
+        return column_value(label, canvas_y(y, self.top, self.bottom), self.top, self.bottom)
+
+    def values(self, label, ys):
+        """Readings (int array) for an array of raw Ys (NaN = no ball)."""
+        if label not in self.curves:
+            return column_values(label, ys, self.top, self.bottom)
+        ys = np.asarray(ys, dtype=np.float64)
+        return np.where(np.isnan(ys), 0, np.rint(np.interp(ys, *self.curves[label]))).astype(np.int64)
+
+    def map_positions(self, positions):
+        """{label: reading} for one frame's {label: (x, y) or None}."""
+        return {label: self.value(label, pos[1] if pos else None) for label, pos in positions.items()}
+
+    def map_series(self, ys_by_label):
+        """{label: int array} for {label: array of raw Ys}, e.g. a whole session."""
+        return {label: self.values(label, ys) for label, ys in ys_by_label.items()}
+
+    def reading_canvas_y(self, label, value):
+        """Canvas Y at which `value` sits on the column's (linear) ruler."""
+        low, high = VALUE_RANGES[label]
+        return self.bottom - (value - low) / (high - low) * (self.bottom - self.top)
+
+
+if __name__ == "__main__":
+    # python mapping.py - check the batch mapping against the scalar one and time it
+    ys = np.concatenate([np.arange(0, 400, 0.125), [np.nan]])
+    positions = [None if np.isnan(y) else (0, y) for y in ys]
+    for label in VALUE_RANGES:
+        scalar = [ball_values({label: pos})[label] for pos in positions]
+        assert column_values(label, ys).tolist() == scalar, label
+    print(f"Batch mapping matches the scalar mapping for {len(ys)} Y values per color")
+
+    session = np.random.default_rng(0).uniform(200, 360, 1000 * 900)   # 1000 sessions x 30 s x 30 fps
+    start = time.perf_counter()
+    for label in VALUE_RANGES:
+        column_values(label, session)
+    elapsed = time.perf_counter() - start
+    print(f"Mapped {3 * session.size} readings in {elapsed * 1000:.0f} ms")
@@ -0,0 +1,452 @@
+import argparse
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from calibration import CalibrationProfile
+from engine import DetectionEngine
+from pipeline import FrameResult
+from render import CanvasRenderer
+from telemetry import Telemetry
+
+# =============================================================================
+# Multi-Stream Detection
+# =============================================================================
+# One Pi driving several spirometers, each with its own camera and patient.
+# Detection for every stream runs in its own worker process, so streams use
+# separate cores instead of sharing one interpreter. Frames are not pickled:
+# each stream has a shared-memory block of STREAM_SLOTS frame slots, the
+# parent copies a captured frame into a free slot and sends only
+# (slot, frame id, timestamp) down a pipe; the worker detects straight from
+# shared memory and sends back the small result dict. A slot is not written
+# again until its result has come back, so neither side ever sees a
+# half-written frame.
+#
+# StreamWorker puts a capture thread in front of a DetectorProcess with the
+# same latest-frame-wins behaviour as pipeline.DetectionPipeline: one frame
+# in the worker, the newest captured frame waiting in the other slot (older
+# waiting frames are overwritten and counted as dropped), and the same
+# start/pause/resume/poll interface for the UI. MultiStreamStation shows all
+# streams side by side in one Tk window, each with its own card and session.
+#
+#   python multistream.py camera@0 camera@1
+#   python multistream.py synthetic synthetic synthetic
+
+STREAM_SLOTS = 2
+RESULT_KEYS = ("positions", "velocities", "bridged", "values")
+WORKER_START_METHOD = "spawn"    # never fork a process that has Tk and camera threads
+CAPTURE_RETRY_DELAY = 0.05
+
+
+def _worker_main(conn, shm_name, shape, engine_kwargs):
+    """Detection worker process: frames from shared memory, results over `conn`."""
+    # Spawned workers share the parent's resource tracker, so attaching here does
+    # not make the block disappear when a worker exits; the parent unlinks it.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, np.uint8, buffer=shm.buf)
+    engine = DetectionEngine(**engine_kwargs)
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            kind = message[0]
+            if kind == "frame":
+                _, slot, frame_id, captured_at = message
+                result = engine.process(frames[slot], captured_at)
+                conn.send((slot, frame_id, captured_at, time.perf_counter(),
+                           {key: result[key] for key in RESULT_KEYS}))
+            elif kind == "reset":
+                engine.reset()
+            elif kind == "profile":
+                engine.set_profile(CalibrationProfile(message[1]))
+            elif kind == "mirrored":
+                engine.set_mirrored(message[1])
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del frames
+        shm.close()
+
+
+class DetectorProcess:
+    """
+    A DetectionEngine in a worker process, fed through shared-memory frame
+    slots. Write a frame into `frames[slot]`, then submit(slot, ...); the slot
+    stays reserved until receive() returns its result. Timestamps are
+    time.perf_counter() values (CLOCK_MONOTONIC, the same in every process).
+    """
+    def __init__(self, engine_kwargs, frame_shape, slots=STREAM_SLOTS, name="detector"):
+        shape = (slots,) + tuple(frame_shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.frames = np.ndarray(shape, np.uint8, buffer=self.shm.buf)
+        context = multiprocessing.get_context(WORKER_START_METHOD)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, name=name, daemon=True,
+                                       args=(child_conn, self.shm.name, shape, engine_kwargs))
+        self.process.start()
+        child_conn.close()
+        self.free = list(range(slots))
+        self._send_lock = threading.Lock()
+
+    def submit(self, slot, frame_id, captured_at):
+        self.free.remove(slot)
+        self.send("frame", slot, frame_id, captured_at)
+
+    def send(self, *message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def receive(self, timeout=None):
+        """Next FrameResult (its slot is free again), or None on timeout."""
+        if timeout is not None and not self.conn.poll(timeout):
+            return None
+        slot, frame_id, captured_at, detected_at, data = self.conn.recv()
+        self.free.append(slot)
+        return FrameResult(frame_id, captured_at, detected_at, data)
+
+    def close(self, timeout=2.0):
+        try:
+            with self._send_lock:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+
+class StreamWorker:
+    """
+    One spirometer: `source` (camera.FrameSource) read on a capture thread,
+    detection in a DetectorProcess. Same start/stop/pause/resume/poll/snapshot
+    interface as pipeline.DetectionPipeline.
+    """
+    def __init__(self, name, source, engine_kwargs, frame_shape, telemetry=None):
+        self.name = name
+        self.source = source
+        self.stats = telemetry if telemetry is not None else Telemetry()
+        self.detector = DetectorProcess(dict(engine_kwargs, mirrored=source.mirrored), frame_shape,
+                                        name=f"detect-{name}")
+        self.running = False
+        self.dropped_frames = 0
+        self._lock = threading.Lock()
+        self._in_flight = False
+        self._pending = None           # (slot, frame_id, captured_at) waiting for the worker
+        self._result = None
+        self._active = threading.Event()
+        self._active.set()
+        self._threads = []
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name=f"capture-{self.name}", daemon=True),
+            threading.Thread(target=self._result_loop, name=f"results-{self.name}", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        self._active.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self.detector.close()
+        self.source.close()
+
+    def pause(self):
+        self._active.clear()
+
+    def resume(self):
+        with self._lock:
+            self._result = None
+        self._active.set()
+
+    @property
+    def paused(self):
+        return not self._active.is_set()
+
+    def reset(self):
+        """Forget tracked balls (new session)."""
+        self.detector.send("reset")
+
+    def set_profile(self, profile):
+        """Use another calibration profile (calibration.CalibrationProfile) from the next frame on."""
+        self.detector.send("profile", profile.hsv_ranges)
+
+    def _capture_loop(self):
+        frame_id = 0
+        while self.running:
+            if not self._active.wait(0.1):
+                continue
+            try:
+                frame = self.source.read()
+            except Exception as e:
+                print(f"Error capturing frame on {self.name}:", e)
+                frame = None
+            if frame is None:
+                time.sleep(CAPTURE_RETRY_DELAY)
+                continue
+            captured_at = time.perf_counter()
+            frame_id += 1
+            self.stats.tick("capture")
+            with self._lock:
+                if self._pending is not None:
+                    # Still waiting for the worker: the newer frame replaces the waiting one
+                    slot = self._pending[0]
+                    self.dropped_frames += 1
+                else:
+                    slot = self.detector.free[0]
+                np.copyto(self.detector.frames[slot], frame)
+                if self._in_flight:
+                    self._pending = (slot, frame_id, captured_at)
+                else:
+                    self.detector.submit(slot, frame_id, captured_at)
+                    self._in_flight = True
+
+    def _result_loop(self):
+        while self.running:
+            try:
+                result = self.detector.receive(0.1)
+            except (EOFError, OSError):
+                if self.running:
+                    print(f"Detection worker for {self.name} stopped")
+                return
+            if result is None:
+                continue
+            self.stats.tick("detect")
+            self.stats.record_latency("detect", result.detected_at - result.captured_at)
+            with self._lock:
+                self._in_flight = False
+                if self._pending is not None:
+                    self.detector.submit(*self._pending)
+                    self._pending = None
+                    self._in_flight = True
+                if self._result is not None:
+                    self.dropped_frames += 1
+                self._result = result
+
+    def poll(self):
+        """Newest result not yet seen by the caller, or None."""
+        with self._lock:
+            result, self._result = self._result, None
+        if result is not None:
+            self.stats.record_latency("end_to_end", time.perf_counter() - result.captured_at)
+            self.stats.tick("display")
+        return result
+
+    def snapshot(self):
+        return self.stats.snapshot(self.dropped_frames)
+
+
+# =============================================================================
+# Multiplexed UI: one panel per stream
+# =============================================================================
+# Each panel has its own card entry (the RFID reader types into the focused
+# one), ball columns and readings. A session keeps the highest reading of
+# each color; "Finished" saves them through the same store, sync and patient
+# index as the single-stream app (data.py). tkinter and data.py are imported
+# inside the UI code rather than at the top, so the worker processes, which
+# import this module, stay small.
+
+PANEL_WIDTH = 300
+PANEL_CANVAS_HEIGHT = 420
+PANEL_COLUMN_TOP = 30
+PANEL_BALL_RADIUS = 14
+PANEL_POLL_INTERVAL_MS = 15
+BALL_COLORS = {"Blue": "blue", "Orange": "orange", "Green": "green"}
+
+
+class StreamPanel:
+    def __init__(self, parent, worker, labels):
+        import tkinter as tk
+        from data import BACKGROUND_COLOR, FONT_NAME, TEXT_COLOR
+
+        self.tk = tk
+        self.worker = worker
+        self.labels = labels
+        self.card_id = None
+        self.started_at = None
+        self.peaks = dict.fromkeys(labels, 0)
+        self.frame = tk.Frame(parent, bg=BACKGROUND_COLOR, padx=8, pady=8)
+        tk.Label(self.frame, text=worker.name, font=(FONT_NAME, 14, "bold"),
+                 bg=BACKGROUND_COLOR, fg=TEXT_COLOR).pack()
+        self.status = tk.Label(self.frame, text="Scan card:", font=(FONT_NAME, 11),
+                               bg=BACKGROUND_COLOR, fg=TEXT_COLOR, justify="left")
+        self.status.pack()
+        self.entry = tk.Entry(self.frame, font=(FONT_NAME, 12))
+        self.entry.pack(pady=4)
+        self.entry.bind("<Return>", self.on_scan)
+
+        self.canvas = tk.Canvas(self.frame, width=PANEL_WIDTH, height=PANEL_CANVAS_HEIGHT,
+                                bg=BACKGROUND_COLOR, highlightthickness=0)
+        self.canvas.pack()
+        column_width = PANEL_WIDTH // len(labels)
+        self.balls, self.texts, self.centers = {}, {}, {}
+        for i, label in enumerate(labels):
+            x0, x1 = i * column_width + 20, (i + 1) * column_width - 20
+            self.centers[label] = (x0 + x1) // 2
+            self.canvas.create_rectangle(x0, PANEL_COLUMN_TOP, x1, PANEL_CANVAS_HEIGHT - 2, outline=TEXT_COLOR)
+            self.texts[label] = self.canvas.create_text(self.centers[label], 12, text=f"{label}: 0",
+                                                        fill=TEXT_COLOR, font=(FONT_NAME, 10))
+            self.balls[label] = self.canvas.create_oval(0, 0, 0, 0, fill="white")
+        self.renderer = CanvasRenderer(self.canvas)
+        self.finish_button = tk.Button(self.frame, text="Finished", font=(FONT_NAME, 12),
+                                       command=self.finish, state="disabled")
+        self.finish_button.pack(pady=6)
+
+    def on_scan(self, event):
+        from data import get_patient_index
+
+        card_id = self.entry.get().strip()
+        self.entry.delete(0, self.tk.END)
+        if not card_id or self.card_id is not None:
+            return
+        self.card_id = card_id
+        self.started_at = time.perf_counter()
+        self.peaks = dict.fromkeys(self.labels, 0)
+        self.worker.reset()
+        self.worker.resume()
+        history = get_patient_index().lookup(card_id)
+        best = " / ".join("-" if history.best[c] is None else str(history.best[c]) for c in history.best)
+        self.status.config(text=f"Card {card_id} - session {history.sessions + 1}\nBest: {best}")
+        self.finish_button.config(state="normal")
+
+    def update(self, result):
+        from mapping import VALUE_RANGES
+
+        bottom = PANEL_CANVAS_HEIGHT - 2
+        for label in self.labels:
+            position = result.data["positions"].get(label)
+            value = result.data["values"].get(label, 0)
+            low, high = VALUE_RANGES.get(label, (0, 1))
+            if position and not result.data["bridged"].get(label):
+                self.peaks[label] = max(self.peaks[label], value)
+                y = bottom - (value - low) / (high - low) * (bottom - PANEL_COLUMN_TOP)
+            else:
+                y = bottom - PANEL_BALL_RADIUS
+            x = self.centers[label]
+            r = PANEL_BALL_RADIUS
+            self.renderer.set(self.balls[label], (x - r, y - r, x + r, y + r),
+                              fill=BALL_COLORS.get(label, "gray") if position else "white")
+            self.renderer.set(self.texts[label], text=f"{label}: {value:d}")
+
+    def finish(self):
+        from datetime import datetime
+        from tkinter import messagebox
+        from data import get_patient_index, save_session
+
+        self.finish_button.config(state="disabled")
+        data = [self.card_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")] + [self.peaks[l] for l in self.labels]
+        future = save_session(data)
+
+        def wait_for_save():
+            if not future.done():
+                self.frame.after(PANEL_POLL_INTERVAL_MS, wait_for_save)
+                return
+            try:
+                row_id = future.result()
+            except Exception as e:
+                self.finish_button.config(state="normal")
+                messagebox.showerror("File Error", f"Could not save data for {self.worker.name}:\n{e}")
+                return
+            get_patient_index().record(row_id, data)
+            self.worker.pause()
+            self.card_id = None
+            self.status.config(text=f"Saved {' / '.join(str(v) for v in data[2:])}\nScan card:")
+            self.entry.focus_set()
+
+        wait_for_save()
+
+
+class MultiStreamStation:
+    """All streams in one window, polled from the Tk thread."""
+    def __init__(self, root, workers, labels):
+        from data import BACKGROUND_COLOR
+
+        self.root = root
+        self.workers = workers
+        self.root.title("Respiratory Therapy Station")
+        self.root.configure(bg=BACKGROUND_COLOR)
+        self.panels = [StreamPanel(root, worker, labels) for worker in workers]
+        for panel in self.panels:
+            panel.frame.pack(side="left", fill="y")
+        self.panels[0].entry.focus_set()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.poll()
+
+    def poll(self):
+        for panel in self.panels:
+            if panel.card_id is None:
+                continue
+            result = panel.worker.poll()
+            # Frames captured before the card was scanned belong to nobody
+            if result is not None and result.captured_at >= panel.started_at:
+                panel.update(result)
+            panel.renderer.flush()
+        self.poll_job = self.root.after(PANEL_POLL_INTERVAL_MS, self.poll)
+
+    def on_closing(self):
+        self.root.after_cancel(self.poll_job)
+        self.root.destroy()
+
+
+def main():
+    import tkinter as tk
+    from calibration import CALIBRATION_DIR, ProfileStore, ProfileWatcher
+    from camera import CROP_HEIGHT, CROP_WIDTH, open_frame_source
+    from data import (DETECTION_MODE, DEVICE_ID, TRACKING_ENABLED, check_and_create_lock,
+                      cleanup_lock, get_sync_worker)
+    from detection import HSV_FILE, ROI_FILE, load_hsv_ranges, load_roi_strips
+    from mapping import CURVE_FILE, ValueMapper
+
+    parser = argparse.ArgumentParser(description="Run several spirometers from one device.")
+    parser.add_argument("sources", nargs="+", help="frame sources, e.g. camera@0 camera@1 synthetic")
+    parser.add_argument("--mode", default=DETECTION_MODE)
+    args = parser.parse_args()
+
+    if not check_and_create_lock():
+        return
+    profiles = ProfileStore(CALIBRATION_DIR, DEVICE_ID)
+    profile = profiles.load()
+    engine_kwargs = {"hsv_ranges": profile.hsv_ranges if profile else load_hsv_ranges(HSV_FILE),
+                     "roi_strips": load_roi_strips(ROI_FILE), "mode": args.mode,
+                     "tracking": TRACKING_ENABLED, "mapper": ValueMapper.from_file(CURVE_FILE)}
+    workers = []
+    watcher = None
+    try:
+        for i, spec in enumerate(args.sources):
+            worker = StreamWorker(f"Stream {i + 1}", open_frame_source(spec), engine_kwargs,
+                                  (CROP_HEIGHT, CROP_WIDTH, 3))
+            worker.pause()
+            worker.start()
+            workers.append(worker)
+        # Calibration changes go to every stream's worker
+        watcher = ProfileWatcher(profiles, lambda p: [w.set_profile(p) for w in workers])
+        watcher.start()
+        get_sync_worker().notify()
+        root = tk.Tk()
+        MultiStreamStation(root, workers, list(engine_kwargs["hsv_ranges"]))
+        root.mainloop()
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        for worker in workers:
+            worker.stop()
+        get_sync_worker().stop()
+        cleanup_lock()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+from session_store import READING_COLUMNS
+
+# =============================================================================
+# Patient History
+# =============================================================================
+# What the therapy screen shows about a patient right after their card is
+# scanned: sessions so far, best and goal readings and the last few sessions.
+# Lookups go to the store's per-patient rollup and card_id index (two small
+# indexed queries); recently seen patients are kept in an LRU cache, and a
+# saved session updates the cached entry in place instead of evicting it.
+# Goals are set from outside the app (python session_store.py goal ...), so a
+# cache hit still re-reads the goal - one primary-key lookup.
+
+PATIENT_CACHE_SIZE = 256
+RECENT_SESSIONS = 5
+
+
+class PatientHistory:
+    __slots__ = ("card_id", "sessions", "best", "goal", "recent")
+
+    def __init__(self, card_id, sessions=0, best=None, goal=None, recent=()):
+        self.card_id = card_id
+        self.sessions = sessions
+        self.best = best or dict.fromkeys(READING_COLUMNS)     # {"blue": value or None, ...}
+        self.goal = goal or dict.fromkeys(READING_COLUMNS)
+        self.recent = list(recent)     # (id, card_id, timestamp, blue, orange, green), newest first
+
+
+class PatientIndex:
+    """LRU-cached PatientHistory lookups by card ID. Safe to share between threads."""
+    def __init__(self, store, capacity=PATIENT_CACHE_SIZE, recent=RECENT_SESSIONS):
+        self.store = store
+        self.capacity = capacity
+        self.recent = recent
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, card_id):
+        card_id = str(card_id)
+        with self._lock:
+            history = self._cache.get(card_id)
+            if history is not None:
+                self._cache.move_to_end(card_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if history is not None:
+            goal = self.store.goal(card_id)
+            if goal is not None:
+                history.goal = goal
+            return history
+        history = self._load(card_id)
+        with self._lock:
+            self._cache[card_id] = history
+            self._cache.move_to_end(card_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        return history
+
+    def _load(self, card_id):
+        rollup = self.store.patient(card_id)
+        if rollup is None:
+            return PatientHistory(card_id)
+        return PatientHistory(card_id, rollup["sessions"], rollup["best"], rollup["goal"],
+                              self.store.recent_sessions(card_id, self.recent))
+
+    def record(self, row_id, data):
+        """A session [card_id, timestamp, blue, orange, green] was saved as `row_id`."""
+        card_id = str(data[0])
+        with self._lock:
+            history = self._cache.get(card_id)
+            if history is None:
+                return
+            history.sessions += 1
+            for column, value in zip(READING_COLUMNS, data[2:]):
+                if value is not None and (history.best[column] is None or value > history.best[column]):
+                    history.best[column] = value
+            history.recent.insert(0, (row_id, card_id) + tuple(data[1:]))
+            del history.recent[self.recent:]
+
+    def invalidate(self, card_id=None):
+        """Drop one card (e.g. after its goal changed) or, with no argument, everything."""
+        with self._lock:
+            if card_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(str(card_id), None)
@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import deque
+
+from telemetry import Telemetry
+
+# =============================================================================
+# Capture / Detection Pipeline
+# =============================================================================
+# The camera is read on a capture thread and frames are handed to a detection
+# worker through a small latest-frame-wins buffer. The Tk thread never touches
+# the camera; it only polls the newest detection result with root.after().
+
+FRAME_BUFFER_SIZE = 2        # frames held between capture and detection
+CAPTURE_RETRY_DELAY = 0.05   # seconds to wait after a failed capture
+
+
+class LatestFrameBuffer:
+    """
+    Bounded ring buffer shared by one producer and one consumer.
+    When the buffer is full the oldest entry is overwritten, and the consumer
+    always takes the newest entry, discarding anything older. Every entry that
+    is thrown away without being consumed is counted in `dropped`.
+    """
+    def __init__(self, capacity=FRAME_BUFFER_SIZE):
+        self.capacity = max(1, capacity)
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.capacity:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get_latest(self, timeout=None):
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.pop()
+            self.dropped += len(self._items)
+            self._items.clear()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class FrameResult:
+    """Output of the detection worker for a single captured frame."""
+    __slots__ = ("frame_id", "captured_at", "detected_at", "data")
+
+    def __init__(self, frame_id, captured_at, detected_at, data):
+        self.frame_id = frame_id
+        self.captured_at = captured_at
+        self.detected_at = detected_at
+        self.data = data
+
+
+class DetectionPipeline:
+    """
+    Producer/consumer pipeline:
+      capture thread  -> LatestFrameBuffer -> detection worker -> latest result
+    `capture` is called repeatedly and should block until a frame is ready
+    (as Picamera2.capture_array does); it may return None on failure.
+    `detect` is called with each frame on the worker thread and its return
+    value is published as FrameResult.data.
+    Counters and stage latencies go to `telemetry` (a Telemetry instance).
+    An optional `scheduler` (scheduler.AdaptiveScheduler) decides which
+    captured frames are detected; the others only pace the capture loop.
+    """
+    def __init__(self, capture, detect, buffer_size=FRAME_BUFFER_SIZE, telemetry=None, scheduler=None):
+        self.capture = capture
+        self.detect = detect
+        self.frames = LatestFrameBuffer(buffer_size)
+        self.stats = telemetry if telemetry is not None else Telemetry()
+        self.scheduler = scheduler
+        self.running = False
+        self._active = threading.Event()
+        self._active.set()
+        self._result = None
+        self._result_lock = threading.Lock()
+        self._results_superseded = 0
+        self._threads = []
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(target=self._detect_loop, name="detect", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        self._active.set()
+        self.frames.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def pause(self):
+        """Stop reading frames (the camera itself keeps streaming)."""
+        self._active.clear()
+
+    def resume(self):
+        """Start reading frames again; results from before the pause are discarded."""
+        with self._result_lock:
+            self._result = None
+        if self.scheduler is not None:
+            self.scheduler.reset()
+        self._active.set()
+
+    @property
+    def paused(self):
+        return not self._active.is_set()
+
+    def _capture_loop(self):
+        frame_id = 0
+        while self.running:
+            if not self._active.wait(0.1):
+                continue
+            start = time.perf_counter()
+            try:
+                frame = self.capture()
+            except Exception as e:
+                print("Error capturing frame:", e)
+                frame = None
+            if frame is None:
+                self.stats.count("capture_errors")
+                time.sleep(CAPTURE_RETRY_DELAY)
+                continue
+            captured_at = time.perf_counter()
+            self.stats.record_latency("capture", captured_at - start)
+            self.stats.count("frames_captured")
+            self.stats.tick("capture")
+            if self.scheduler is not None and not self.scheduler.admit(frame, captured_at):
+                # Idle: nothing moving, so skip detection and slow down
+                self.stats.count("frames_idle")
+                time.sleep(self.scheduler.idle_delay(start))
+                continue
+            frame_id += 1
+            self.frames.put((frame_id, captured_at, frame))
+
+    def _detect_loop(self):
+        while self.running:
+            item = self.frames.get_latest(timeout=0.1)
+            if item is None:
+                continue
+            frame_id, captured_at, frame = item
+            start = time.perf_counter()
+            self.stats.record_latency("queue", start - captured_at)
+            try:
+                data = self.detect(frame)
+            except Exception as e:
+                print("Error in detection worker:", e)
+                continue
+            detected_at = time.perf_counter()
+            self.stats.record_latency("detect", detected_at - start)
+            self.stats.count("frames_detected")
+            self.stats.tick("detect")
+            with self._result_lock:
+                if self._result is not None:
+                    self._results_superseded += 1
+                self._result = FrameResult(frame_id, captured_at, detected_at, data)
+
+    def poll(self):
+        """
+        Return the newest detection result not yet seen by the caller, or None.
+        Meant to be called from the Tk thread; never blocks on the camera.
+        """
+        with self._result_lock:
+            result, self._result = self._result, None
+        if result is not None:
+            self.stats.record_latency("display", time.perf_counter() - result.detected_at)
+            self.stats.record_latency("end_to_end", time.perf_counter() - result.captured_at)
+            self.stats.count("frames_displayed")
+            self.stats.tick("display")
+        return result
+
+    @property
+    def dropped_frames(self):
+        """Frames captured but never shown: dropped before detection or before display."""
+        return self.frames.dropped + self._results_superseded
+
+    def snapshot(self):
+        return self.stats.snapshot(self.dropped_frames)
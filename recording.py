@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# =============================================================================
+# Session Recordings
+# =============================================================================
+# Raw detection-window frames are recorded into a .npy file that is written
+# and read through a memory map, so recording costs one copy per frame and
+# replay never decodes anything. The file grows RECORD_CHUNK_FRAMES at a time
+# and is cut to the recorded frames on close, so a short session takes only
+# the space it needs on the SD card. A JSON sidecar (<path>.json) holds
+# the frame count, capture timestamps, orientation and, when known, the
+# ground-truth ball Y per color and frame (null where no ball is visible).
+#
+#   python recording.py synthetic out.npy --frames 600   (labeled test data)
+#   python recording.py camera out.npy --seconds 30      (real session)
+#
+# Recordings are replayed headless by replay.py, or in the app with
+# RT_FRAME_SOURCE=recording:<path>.
+
+RECORD_MAX_FRAMES = 1800     # 60 s at 30 fps
+RECORD_CHUNK_FRAMES = 150    # 5 s at 30 fps (about 50 MB at 314x352) added at a time
+RECORD_HEADER_BYTES = 128    # fixed-size .npy header, rewritten with the frame count on close
+
+
+def sidecar_path(path):
+    return path + ".json"
+
+
+def write_npy_header(f, shape, dtype=np.uint8):
+    """.npy (version 1.0) header for a C-ordered array, padded to RECORD_HEADER_BYTES."""
+    prefix = np.lib.format.magic(1, 0)
+    length = RECORD_HEADER_BYTES - len(prefix) - 2
+    header = str({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                  "shape": tuple(shape)})
+    if len(header) >= length:
+        raise ValueError(f"Array shape {shape} does not fit in a {RECORD_HEADER_BYTES}-byte header")
+    f.seek(0)
+    f.write(prefix + struct.pack("<H", length) + (header.ljust(length - 1) + "\n").encode("latin1"))
+
+
+class FrameRecorder:
+    """
+    Appends frames of one fixed shape to a memory-mapped .npy file, grown
+    RECORD_CHUNK_FRAMES at a time. Safe to call write() from a worker thread
+    while another thread close()s. Frames beyond max_frames are ignored
+    (counted in `overflow`).
+    """
+    def __init__(self, path, frame_shape, max_frames=RECORD_MAX_FRAMES, mirrored=False, fps=None):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.mirrored = mirrored
+        self.fps = fps
+        self.count = 0
+        self.overflow = 0
+        self.timestamps = []
+        self.ground_truth = {}
+        self.max_frames = max_frames
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self._lock = threading.Lock()
+        self._file = open(path, "w+b")
+        write_npy_header(self._file, (0,) + self.frame_shape)
+        self._frames = None
+        self._grow()
+
+    def _grow(self):
+        capacity = min((0 if self._frames is None else len(self._frames)) + RECORD_CHUNK_FRAMES, self.max_frames)
+        self._frames = None     # unmap before resizing the file
+        self._file.truncate(RECORD_HEADER_BYTES + capacity * self.frame_bytes)
+        if capacity:
+            self._frames = np.memmap(self._file, np.uint8, "r+", RECORD_HEADER_BYTES,
+                                     (capacity,) + self.frame_shape)
+
+    def write(self, frame, timestamp=None, truth=None):
+        """
+        Record one frame. `truth` optionally maps color -> ball Y (or None)
+        for this frame; colors missing from it are recorded as unknown.
+        """
+        with self._lock:
+            if self._file is None:
+                return False
+            if self.count >= self.max_frames:
+                self.overflow += 1
+                return False
+            if self.count >= len(self._frames):
+                self._frames.flush()
+                self._grow()
+            self._frames[self.count] = frame
+            self.timestamps.append(time.perf_counter() if timestamp is None else timestamp)
+            if truth is not None:
+                for label, y in truth.items():
+                    column = self.ground_truth.setdefault(label, [None] * self.count)
+                    column.append(None if y is None else int(y))
+            self.count += 1
+            for column in self.ground_truth.values():
+                column.extend([None] * (self.count - len(column)))
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._frames is not None:
+                self._frames.flush()
+                self._frames = None
+            # Cut the unused part of the last chunk and record the real frame count
+            self._file.truncate(RECORD_HEADER_BYTES + self.count * self.frame_bytes)
+            write_npy_header(self._file, (self.count,) + self.frame_shape)
+            self._file.close()
+            self._file = None
+            start = self.timestamps[0] if self.timestamps else 0.0
+            meta = {
+                "frame_count": self.count,
+                "frame_shape": list(self.frame_shape),
+                "mirrored": self.mirrored,
+                "fps": self.fps,
+                "timestamps": [round(t - start, 6) for t in self.timestamps],
+            }
+            if self.ground_truth:
+                meta["ground_truth"] = self.ground_truth
+            with open(sidecar_path(self.path), "w") as f:
+                json.dump(meta, f)
+        if self.overflow:
+            print(f"Recording {self.path} full: {self.overflow} frames not recorded")
+
+
+class Recording:
+    """A recording opened for reading: `frames` is a read-only memory map."""
+    def __init__(self, path):
+        self.path = path
+        with open(sidecar_path(path)) as f:
+            self.meta = json.load(f)
+        self.count = self.meta["frame_count"]
+        self.frames = np.load(path, mmap_mode="r")[:self.count]
+        self.mirrored = self.meta.get("mirrored", False)
+        self.fps = self.meta.get("fps")
+        self.timestamps = self.meta.get("timestamps") or [i / (self.fps or 30) for i in range(self.count)]
+        self.ground_truth = self.meta.get("ground_truth")
+
+    def __len__(self):
+        return self.count
+
+    def truth(self, index):
+        """{color: ball Y or None} for frame `index`, or None if the recording is unlabeled."""
+        if not self.ground_truth:
+            return None
+        return {label: column[index] for label, column in self.ground_truth.items()}
+
+
+def record_source(source, path, count, truth=None):
+    """Record up to `count` frames of `source`; `truth(index)` may supply ground truth."""
+    recorder = None
+    try:
+        for index in range(count):
+            frame = source.read()
+            if frame is None:
+                break
+            if recorder is None:
+                recorder = FrameRecorder(path, frame.shape, count, source.mirrored,
+                                         1.0 / source.interval if getattr(source, "interval", 0) else None)
+            recorder.write(frame, truth=truth(index) if truth else None)
+    finally:
+        source.close()
+        if recorder is not None:
+            recorder.close()
+    return recorder.count if recorder else 0
+
+
+def main():
+    from camera import SyntheticSource, open_frame_source
+
+    parser = argparse.ArgumentParser(description="Record detection-window frames for replay.py.")
+    parser.add_argument("source", help='"synthetic" (labeled), "camera" or any RT_FRAME_SOURCE spec')
+    parser.add_argument("path", help="output .npy file (a .json sidecar is written next to it)")
+    parser.add_argument("--frames", type=int, help="number of frames to record")
+    parser.add_argument("--seconds", type=float, default=10, help="recording length at 30 fps")
+    args = parser.parse_args()
+    count = args.frames or int(args.seconds * 30)
+
+    if os.path.dirname(args.path):
+        os.makedirs(os.path.dirname(args.path), exist_ok=True)
+    if args.source == "synthetic":
+        source = SyntheticSource(count=count)
+        truth = lambda index: {label: y for label, (_, y) in source.ball_positions(index).items()}
+    else:
+        source = open_frame_source(args.source)
+        truth = None
+    recorded = record_source(source, args.path, count, truth)
+    print(f"Recorded {recorded} frames to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+from collections import deque
+
+# =============================================================================
+# Canvas Rendering
+# =============================================================================
+# Every Tk canvas call is a round trip into Tcl, and the therapy screen used
+# to move three ovals and rewrite three labels (and their fill colors) for
+# every detection result, changed or not. The renderer sits between the app
+# and the canvas: set() only records the state an item should have; flush()
+# compares it with what was last drawn and issues just the coords/itemconfig
+# calls for what actually changed. Redraws are capped at REFRESH_RATE, so
+# results arriving faster than the display refreshes are coalesced into one
+# redraw. Calls that were requested but not needed are counted as saved.
+
+REFRESH_RATE = 60             # redraws per second at most (the display's refresh rate)
+RENDER_RATE_WINDOW = 5.0      # seconds over which saved calls per second are measured
+
+
+class CanvasRenderer:
+    """Diffing, rate-capped updates for items on one tk.Canvas."""
+    def __init__(self, canvas, refresh_rate=REFRESH_RATE):
+        self.canvas = canvas
+        self.interval = 1.0 / refresh_rate if refresh_rate else 0.0
+        self.requested = 0     # coords/itemconfig calls the caller asked for
+        self.calls = 0         # calls actually sent to Tk
+        self.redraws = 0
+        self._drawn = {}       # item -> {"coords": (...), option: value} as last sent to Tk
+        self._pending = {}     # item -> state to draw at the next flush
+        self._last_draw = None
+        self._history = deque()
+
+    @property
+    def saved(self):
+        return self.requested - self.calls
+
+    def known(self, item, coords=None, **options):
+        """Record the state an item was created with, so identical updates are skipped."""
+        state = self._drawn.setdefault(item, {})
+        if coords is not None:
+            state["coords"] = tuple(int(round(c)) for c in coords)
+        state.update(options)
+
+    def set(self, item, coords=None, **options):
+        """Ask for `item` to be drawn at `coords` and/or with `options` (e.g. fill, text)."""
+        state = self._pending.setdefault(item, {})
+        if coords is not None:
+            state["coords"] = tuple(int(round(c)) for c in coords)
+            self.requested += 1
+        if options:
+            state.update(options)
+            self.requested += 1
+
+    def flush(self, now=None):
+        """Draw what changed, unless the last redraw was less than 1/refresh_rate ago. True if drawn."""
+        if not self._pending:
+            return False
+        now = time.perf_counter() if now is None else now
+        if self._last_draw is not None and now - self._last_draw < self.interval:
+            return False
+        pending, self._pending = self._pending, {}
+        for item, state in pending.items():
+            drawn = self._drawn.setdefault(item, {})
+            coords = state.pop("coords", None)
+            if coords is not None and drawn.get("coords") != coords:
+                self.canvas.coords(item, *coords)
+                drawn["coords"] = coords
+                self.calls += 1
+            changed = {key: value for key, value in state.items() if drawn.get(key) != value}
+            if changed:
+                self.canvas.itemconfig(item, **changed)
+                drawn.update(changed)
+                self.calls += 1
+        self._last_draw = now
+        self.redraws += 1
+        self._history.append((now, self.saved))
+        while now - self._history[0][0] > RENDER_RATE_WINDOW:
+            self._history.popleft()
+        return True
+
+    def reset(self):
+        """Forget the drawn state (e.g. after the canvas was cleared)."""
+        self._drawn.clear()
+        self._pending.clear()
+
+    @property
+    def saved_per_second(self):
+        if len(self._history) < 2:
+            return 0.0
+        (t0, saved0), (t1, saved1) = self._history[0], self._history[-1]
+        return (saved1 - saved0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def status(self):
+        return {"requested": self.requested, "calls": self.calls, "saved": self.saved,
+                "saved_per_second": self.saved_per_second, "redraws": self.redraws}
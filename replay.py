@@ -0,0 +1,180 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from camera import SYNTHETIC_TUBE_HALF_WIDTH, SYNTHETIC_TUBES
+from detection import HSV_FILE, load_hsv_ranges, load_roi_strips
+from engine import DETECTION_MODES, DetectionEngine
+from mapping import ValueMapper
+from recording import Recording
+from telemetry import Telemetry
+
+# =============================================================================
+# Headless replay
+# =============================================================================
+# Pushes a recording (recording.py) through detection, tracking and the value
+# mapping as fast as possible, without a camera or display, and reports
+# throughput, per-stage latency and - for labeled recordings - agreement with
+# the ground-truth ball heights and the readings they map to.
+#
+#   python recording.py synthetic /tmp/synthetic.npy --frames 600
+#   python replay.py /tmp/synthetic.npy --synthetic-strips
+#   python replay.py /tmp/session.npy --mode pyramid --compare roi
+#
+# With --compare the exit status is 1 if any mode's ball Y strays more than
+# COMPARE_Y_TOLERANCE from the reference mode's, or finds a ball it does not.
+
+Y_TOLERANCE = 3    # pixels; a detection within this of the ground truth counts as correct
+COMPARE_Y_TOLERANCE = 2.0    # pixels; largest ball Y difference --compare accepts between modes
+
+
+class ReplayResult:
+    def __init__(self, mode, frames, seconds, positions, values, telemetry):
+        self.mode = mode
+        self.frames = frames
+        self.seconds = seconds
+        self.positions = positions     # per frame: {label: (x, y) or None}
+        self.values = values           # per frame: {label: reading}
+        self.telemetry = telemetry
+
+
+def replay(recording, hsv_ranges, roi_strips, mode="roi", tracking=False):
+    """Run every frame of `recording` through a DetectionEngine; returns a ReplayResult."""
+    telemetry = Telemetry()
+    engine = DetectionEngine(hsv_ranges, roi_strips, mode, recording.mirrored, tracking)
+    all_positions = []
+    all_values = []
+
+    start = time.perf_counter()
+    for index in range(len(recording)):
+        result = engine.process(recording.frames[index], recording.timestamps[index], telemetry)
+        all_positions.append(result["positions"])
+        all_values.append(result["values"])
+    seconds = time.perf_counter() - start
+    return ReplayResult(mode, len(recording), seconds, all_positions, all_values, telemetry)
+
+
+def agreement(recording, result, mapper=None):
+    """
+    Per color: frames with ground truth, hits within Y_TOLERANCE, misses,
+    false detections, mean |dy| and the worst reading error.
+    """
+    mapper = mapper or ValueMapper()
+    report = {}
+    for label in result.positions[0] if result.positions else []:
+        truth_y = []
+        found_y = []
+        for index, positions in enumerate(result.positions):
+            truth = recording.truth(index)
+            if truth is None or label not in truth:
+                continue
+            truth_y.append(np.nan if truth[label] is None else truth[label])
+            pos = positions.get(label)
+            found_y.append(np.nan if pos is None else pos[1])
+        truth_y = np.array(truth_y, float)
+        found_y = np.array(found_y, float)
+        if not truth_y.size:
+            continue
+        both = ~np.isnan(truth_y) & ~np.isnan(found_y)
+        dy = np.abs(found_y[both] - truth_y[both])
+        truth_values = mapper.values(label, truth_y[both])
+        found_values = mapper.values(label, found_y[both])
+        report[label] = {
+            "frames": int(truth_y.size),
+            "within_tolerance": int((dy <= Y_TOLERANCE).sum()),
+            "missed": int((~np.isnan(truth_y) & np.isnan(found_y)).sum()),
+            "false_detections": int((np.isnan(truth_y) & ~np.isnan(found_y)).sum()),
+            "mean_dy": float(dy.mean()) if dy.size else 0.0,
+            "worst_value_error": int(np.abs(found_values - truth_values).max()) if dy.size else 0,
+        }
+    return report
+
+
+def compare_values(reference, result):
+    """
+    Per color: frames where `result` and `reference` (replays of the same
+    recording) show different readings and the largest difference, frames
+    where only one of them found the ball, and the largest ball Y difference.
+    Needs no ground truth, so any recording can check one detection mode
+    against another.
+    """
+    report = {}
+    for label in reference.values[0] if reference.values else []:
+        ref = np.array([values[label] for values in reference.values])
+        other = np.array([values[label] for values in result.values])
+        diff = np.abs(other - ref)
+        ref_y = np.array([np.nan if p.get(label) is None else p[label][1] for p in reference.positions], float)
+        other_y = np.array([np.nan if p.get(label) is None else p[label][1] for p in result.positions], float)
+        both = ~np.isnan(ref_y) & ~np.isnan(other_y)
+        dy = np.abs(other_y[both] - ref_y[both])
+        report[label] = {"differing": int((diff > 0).sum()), "worst": int(diff.max()) if diff.size else 0,
+                         "unmatched": int((np.isnan(ref_y) != np.isnan(other_y)).sum()),
+                         "worst_dy": float(dy.max()) if dy.size else 0.0}
+    return report
+
+
+def print_report(recording, result):
+    print(f"{result.mode}: {result.frames} frames in {result.seconds:.2f} s "
+          f"({result.frames / result.seconds:.1f} frames/sec)")
+    stats = result.telemetry.snapshot()
+    for stage, v in stats["latency_ms"].items():
+        print(f"  {stage:>14}: p50 {v['p50']:.2f}  p90 {v['p90']:.2f}  p99 {v['p99']:.2f}  max {v['max']:.2f} ms")
+    print("  hit rate: " + ", ".join(f"{label} {rate:.1%}" for label, rate in stats["hit_rate"].items()))
+    if recording.ground_truth:
+        for label, r in agreement(recording, result).items():
+            print(f"  {label:>7}: {r['within_tolerance']}/{r['frames']} within {Y_TOLERANCE} px, "
+                  f"{r['missed']} missed, {r['false_detections']} false, mean |dy| {r['mean_dy']:.2f} px, "
+                  f"worst reading error {r['worst_value_error']}")
+    else:
+        print("  (recording has no ground truth)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recording through detection headlessly.")
+    parser.add_argument("recording", help=".npy recording written by recording.py")
+    parser.add_argument("--mode", choices=list(DETECTION_MODES) + ["all"], default="all")
+    parser.add_argument("--compare", choices=DETECTION_MODES,
+                        help="also compare every other mode's readings with this mode's (exit 1 if out of tolerance)")
+    parser.add_argument("--tolerance", type=float, default=COMPARE_Y_TOLERANCE,
+                        help=f"largest ball Y difference in pixels --compare accepts (default {COMPARE_Y_TOLERANCE})")
+    parser.add_argument("--tracking", action="store_true", help="smooth with the ball tracker (as in the app)")
+    parser.add_argument("--hsv", default=HSV_FILE, help="HSV calibration file (defaults if missing)")
+    parser.add_argument("--synthetic-strips", action="store_true",
+                        help="use tube strips matching the synthetic source instead of ROI.data")
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    hsv_ranges = load_hsv_ranges(args.hsv)
+    if args.synthetic_strips:
+        roi_strips = {label: (x - SYNTHETIC_TUBE_HALF_WIDTH - 3, x + SYNTHETIC_TUBE_HALF_WIDTH + 3)
+                      for label, (x, _) in SYNTHETIC_TUBES.items()}
+    else:
+        roi_strips = load_roi_strips()
+    modes = ["per_color", "fused", "roi", "pyramid"] if args.mode == "all" else [args.mode]
+    if args.compare and args.compare not in modes:
+        modes.insert(0, args.compare)
+    results = {}
+    for mode in modes:
+        results[mode] = replay(recording, hsv_ranges, roi_strips, mode, args.tracking)
+        print_report(recording, results[mode])
+    if args.compare:
+        failed = []
+        for mode, result in results.items():
+            if mode == args.compare:
+                continue
+            differences = compare_values(results[args.compare], result)
+            print(f"{mode} vs {args.compare}: " + ", ".join(
+                f"{label} {r['differing']}/{result.frames} frames differ (worst by {r['worst']}), "
+                f"worst |dy| {r['worst_dy']:.2f} px, {r['unmatched']} unmatched"
+                for label, r in differences.items()))
+            failed += [f"{mode} {label}" for label, r in differences.items()
+                       if r["worst_dy"] > args.tolerance or r["unmatched"]]
+        if failed:
+            print(f"Out of tolerance ({args.tolerance:g} px) against {args.compare}: {', '.join(failed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
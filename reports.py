@@ -0,0 +1,142 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from session_store import EXCEL_HEADERS, SESSION_DB_PATH, SessionStore
+
+# =============================================================================
+# Excel Reports
+# =============================================================================
+# Sessions are exported as one workbook per partition - per month by default,
+# or per patient - so no single file grows without bound. Workbooks are
+# streamed in openpyxl's write-only mode and the chart covers exactly the rows
+# written. A manifest next to the reports records each partition's row count
+# and last session id; an export only rebuilds partitions whose numbers have
+# changed (or whose file is missing), so adding a session rewrites one file.
+#
+#   python reports.py /home/pi/googledrive --by month
+
+PARTITIONS = ("month", "patient")
+REPORT_PREFIX = "data"
+MANIFEST_NAME = "reports.json"
+
+
+def report_name(key, prefix=REPORT_PREFIX):
+    # Card IDs come from a reader, but keep file names safe anyway. A key that had
+    # to be cleaned (or differs from another only in case, on a case-insensitive
+    # mount) gets a short hash of the raw key, so two keys never share a workbook.
+    key = str(key)
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+    if name.lower() != key:
+        name += "-" + hashlib.sha1(key.encode()).hexdigest()[:8]
+    return f"{prefix}_{name}.xlsx"
+
+
+def build_workbook(rows):
+    """
+    Write-only workbook with (id, card_id, timestamp, blue, orange, green) rows
+    on Sheet1 plus a chart over them, and an empty Sheet2 for manual notes.
+    """
+    from openpyxl import Workbook
+    from openpyxl.chart import BarChart, Reference
+
+    book = Workbook(write_only=True)
+    sheet1 = book.create_sheet('Sheet1')
+    sheet1.append(EXCEL_HEADERS)
+    for row in rows:
+        sheet1.append(list(row[1:]))
+    last_row = len(rows) + 1
+
+    # Sheet2 for manual modifications
+    book.create_sheet('Sheet2')
+
+    if rows:
+        chart = BarChart()
+        chart.type = "col"
+        chart.style = 10
+        chart.title = "Values Over Time"
+        chart.x_axis.title = "Timestamp"
+        chart.y_axis.title = "Values"
+        # Categories: Timestamp column; series: Blue, Orange and Green (header row = titles)
+        cats = Reference(sheet1, min_col=2, min_row=2, max_row=last_row)
+        values = Reference(sheet1, min_col=3, max_col=5, min_row=1, max_row=last_row)
+        chart.add_data(values, titles_from_data=True)
+        chart.set_categories(cats)
+        sheet1.add_chart(chart, "G2")
+    return book
+
+
+def save_workbook(rows, path, temp_dir=None):
+    """Build locally and copy over in one go, so a slow mount never sees half a file."""
+    fd, temp_path = tempfile.mkstemp(suffix=".xlsx", dir=temp_dir)
+    os.close(fd)
+    try:
+        build_workbook(rows).save(temp_path)
+        shutil.copy2(temp_path, path)
+    finally:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable report manifest {path}: {e}")
+        return {}
+
+
+def export_reports(store, out_dir, by="month", prefix=REPORT_PREFIX, temp_dir=None):
+    """
+    Bring the partitioned reports in `out_dir` up to date with the store.
+    Returns (last exported session id, names of the rebuilt files).
+    """
+    if by not in PARTITIONS:
+        raise ValueError(f"Unknown report partition: {by}")
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    partitions = manifest.setdefault(f"{prefix}/{by}", {})
+
+    rebuilt = []
+    last_id = 0
+    for key, (count, max_id) in store.partitions(by).items():
+        last_id = max(last_id, max_id)
+        name = report_name(key, prefix)
+        entry = partitions.get(str(key))
+        if (entry and entry["rows"] == count and entry["last_id"] == max_id
+                and os.path.exists(os.path.join(out_dir, name))):
+            continue
+        save_workbook(store.partition_rows(by, key), os.path.join(out_dir, name), temp_dir)
+        partitions[str(key)] = {"file": name, "rows": count, "last_id": max_id}
+        rebuilt.append(name)
+
+    if rebuilt:
+        fd, temp_path = tempfile.mkstemp(suffix=".json", dir=temp_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        try:
+            shutil.copy2(temp_path, manifest_path)
+        finally:
+            os.remove(temp_path)
+    return last_id, rebuilt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export sessions as partitioned Excel reports.")
+    parser.add_argument("out_dir", help="directory for the reports (e.g. the Drive mount)")
+    parser.add_argument("--by", choices=PARTITIONS, default="month")
+    parser.add_argument("--db", default=SESSION_DB_PATH)
+    args = parser.parse_args()
+    store = SessionStore(args.db)
+    last_id, rebuilt = export_reports(store, args.out_dir, args.by)
+    print(f"Sessions up to id {last_id}: rebuilt {len(rebuilt)} report(s) {', '.join(rebuilt)}")
+    store.close()
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+# =============================================================================
+# Adaptive Frame Rate
+# =============================================================================
+# Most of the time the patient is not breathing into the device and all three
+# balls sit still, yet every frame went through full detection. The scheduler
+# looks at each captured frame with a cheap motion check - a 1/8-scale gray
+# image differenced against a reference frame at most 1/IDLE_FPS old (so slow
+# movement at full rate is not missed), counted per tube strip - and:
+#   active: every frame goes to detection (full camera rate)
+#   idle:   frames are read at IDLE_FPS and only motion-checked, not detected
+# Motion in any tube switches to active at once; IDLE_AFTER seconds without
+# motion switch back to idle. The capture thread (pipeline.py) asks admit()
+# whether a frame should be detected and sleeps idle_delay() when it is not.
+
+IDLE_FPS = 5
+IDLE_AFTER = 2.0             # seconds without motion before going idle
+MOTION_SCALE = 8             # downscale factor for the motion check
+MOTION_PIXEL_DELTA = 15      # gray-level change that counts as a changed pixel
+MOTION_MIN_PIXELS = 3        # changed (downscaled) pixels in a strip that count as motion
+
+
+class AdaptiveScheduler:
+    """
+    Decides per captured frame whether to run detection. `strips` are the tube
+    column ranges {label: (x0, x1)} in frame coordinates; motion is looked for
+    in each of them (the whole frame when None).
+    """
+    def __init__(self, strips=None, idle_fps=IDLE_FPS, idle_after=IDLE_AFTER):
+        self.strips = strips
+        self.idle_interval = 1.0 / idle_fps
+        self.idle_after = idle_after
+        self.state = "active"
+        self.transitions = 0
+        self._lock = threading.Lock()
+        self._reference = None
+        self._reference_time = None
+        self._last_motion = None
+        self._admitted = deque(maxlen=60)
+
+    def reset(self):
+        """Start active (e.g. a new session): detect at full rate until things settle."""
+        with self._lock:
+            self._reference = None
+            self._last_motion = None
+            self._set_state("active")
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.transitions += 1
+
+    def motion(self, frame, timestamp):
+        """True when any strip changed since the reference frame."""
+        height, width = frame.shape[:2]
+        small = cv2.resize(frame, (width // MOTION_SCALE, height // MOTION_SCALE), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+        reference = self._reference
+        if reference is None or reference.shape != gray.shape or \
+                timestamp - self._reference_time >= self.idle_interval:
+            self._reference, self._reference_time = gray, timestamp
+        if reference is None or reference.shape != gray.shape:
+            return True
+        changed = cv2.absdiff(gray, reference) > MOTION_PIXEL_DELTA
+        if not self.strips:
+            return np.count_nonzero(changed) >= MOTION_MIN_PIXELS
+        for x0, x1 in self.strips.values():
+            if np.count_nonzero(changed[:, x0 // MOTION_SCALE:-(-x1 // MOTION_SCALE)]) >= MOTION_MIN_PIXELS:
+                return True
+        return False
+
+    def admit(self, frame, timestamp):
+        """Should `frame` (captured at `timestamp`, seconds) go to detection?"""
+        with self._lock:
+            if self.motion(frame, timestamp) or self._last_motion is None:
+                self._last_motion = timestamp
+                self._set_state("active")
+            elif timestamp - self._last_motion > self.idle_after:
+                self._set_state("idle")
+            if self.state == "active":
+                self._admitted.append(timestamp)
+                return True
+            return False
+
+    def idle_delay(self, started):
+        """Seconds to wait before the next capture when the frame read at `started` was not admitted."""
+        return max(0.0, started + self.idle_interval - time.perf_counter())
+
+    @property
+    def effective_fps(self):
+        """Frames sent to detection per second, over the last 60 of them."""
+        with self._lock:
+            stamps = list(self._admitted)
+        if len(stamps) < 2:
+            return 0.0
+        # Measured up to now, so the rate decays once frames stop being admitted
+        return (len(stamps) - 1) / max(time.perf_counter() - stamps[0], stamps[-1] - stamps[0], 1e-6)
+
+    def status(self):
+        return {"state": self.state, "effective_fps": self.effective_fps, "transitions": self.transitions}
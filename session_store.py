@@ -0,0 +1,264 @@
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+
+# =============================================================================
+# Session Store
+# =============================================================================
+# Completed sessions are appended to a local SQLite database in WAL mode, so
+# saving a session costs one small insert no matter how long the history is.
+# The Excel workbook is no longer edited in place: the sync worker
+# (sync_queue.py) keeps per-month reports on the Drive mount up to date
+# (reports.py), and export_excel writes everything into a single workbook
+# when asked (python session_store.py export).
+# Sessions are indexed by card ID, and a per-patient rollup (session count,
+# best readings, goal) is updated with every insert, so looking a patient up
+# costs the same with ten sessions on file or a hundred thousand.
+
+SESSION_DB_PATH = "/home/pi/respiratory_sessions.db"
+EXCEL_PATH = "/home/pi/googledrive/data.xlsx"
+EXCEL_TEMP_PATH = "/home/pi/temp_data.xlsx"
+
+EXCEL_HEADERS = ['Card ID', 'Timestamp', 'Blue Value', 'Orange Value', 'Green Value']
+SESSION_COLUMNS = ("card_id", "timestamp", "blue", "orange", "green")
+READING_COLUMNS = ("blue", "orange", "green")
+
+# How sessions are grouped into report partitions (see reports.py)
+PARTITION_EXPRESSIONS = {
+    "month": "COALESCE(substr(timestamp, 1, 7), 'undated')",
+    "patient": "card_id",
+}
+
+
+class SessionStore:
+    """Append-only session history. Safe to share between threads."""
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id TEXT NOT NULL,
+                timestamp TEXT,
+                blue INTEGER,
+                orange INTEGER,
+                green INTEGER
+            )""")
+        # Highest session id already delivered to each sync target
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                target TEXT PRIMARY KEY,
+                synced_id INTEGER NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_card_id ON sessions (card_id, id)")
+        new_rollup = not self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients'").fetchone()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS patients (
+                card_id TEXT PRIMARY KEY,
+                sessions INTEGER NOT NULL DEFAULT 0,
+                last_id INTEGER,
+                best_blue INTEGER,
+                best_orange INTEGER,
+                best_green INTEGER,
+                goal_blue INTEGER,
+                goal_orange INTEGER,
+                goal_green INTEGER
+            )""")
+        if new_rollup:
+            self._rebuild_patients()
+        self.conn.commit()
+
+    def _rebuild_patients(self):
+        # Recompute every rollup from the session rows (goals are kept).
+        self.conn.execute("""
+            INSERT INTO patients (card_id, sessions, last_id, best_blue, best_orange, best_green)
+            SELECT card_id, COUNT(*), MAX(id), MAX(blue), MAX(orange), MAX(green)
+            FROM sessions WHERE true GROUP BY card_id
+            ON CONFLICT (card_id) DO UPDATE SET
+                sessions = excluded.sessions, last_id = excluded.last_id, best_blue = excluded.best_blue,
+                best_orange = excluded.best_orange, best_green = excluded.best_green""")
+
+    def append(self, data):
+        """
+        Append one row: [card_id] or [card_id, timestamp, blue, orange, green].
+        Returns the new row id.
+        """
+        row = list(data) + [None] * (len(SESSION_COLUMNS) - len(data))
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT INTO sessions (card_id, timestamp, blue, orange, green) VALUES (?, ?, ?, ?, ?)",
+                [str(row[0])] + row[1:len(SESSION_COLUMNS)])
+            # MAX() of anything and NULL is NULL, hence the COALESCEs
+            self.conn.execute("""
+                INSERT INTO patients (card_id, sessions, last_id, best_blue, best_orange, best_green)
+                VALUES (?, 1, ?, ?, ?, ?)
+                ON CONFLICT (card_id) DO UPDATE SET
+                    sessions = sessions + 1,
+                    last_id = excluded.last_id,
+                    best_blue = MAX(COALESCE(best_blue, excluded.best_blue), COALESCE(excluded.best_blue, best_blue)),
+                    best_orange = MAX(COALESCE(best_orange, excluded.best_orange),
+                                      COALESCE(excluded.best_orange, best_orange)),
+                    best_green = MAX(COALESCE(best_green, excluded.best_green), COALESCE(excluded.best_green, best_green))
+                """, [str(row[0]), cursor.lastrowid] + row[2:len(SESSION_COLUMNS)])
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def rows(self, after_id=0, limit=None):
+        """(id, card_id, timestamp, blue, orange, green) rows with id > after_id, at most `limit`."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, card_id, timestamp, blue, orange, green FROM sessions "
+                "WHERE id > ? ORDER BY id LIMIT ?", (after_id, -1 if limit is None else limit)).fetchall()
+
+    def patient(self, card_id):
+        """Rollup for one card: {"sessions", "last_id", "best", "goal"}, or None if unknown."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT sessions, last_id, best_blue, best_orange, best_green, goal_blue, goal_orange, goal_green "
+                "FROM patients WHERE card_id = ?", (str(card_id),)).fetchone()
+        if row is None:
+            return None
+        return {"sessions": row[0], "last_id": row[1],
+                "best": dict(zip(READING_COLUMNS, row[2:5])), "goal": dict(zip(READING_COLUMNS, row[5:8]))}
+
+    def goal(self, card_id):
+        """{"blue": value or None, ...} goal of one card, or None if unknown."""
+        with self._lock:
+            row = self.conn.execute("SELECT goal_blue, goal_orange, goal_green FROM patients WHERE card_id = ?",
+                                    (str(card_id),)).fetchone()
+        return dict(zip(READING_COLUMNS, row)) if row is not None else None
+
+    def recent_sessions(self, card_id, count):
+        """The card's last `count` (id, card_id, timestamp, blue, orange, green) rows, newest first."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, card_id, timestamp, blue, orange, green FROM sessions "
+                "WHERE card_id = ? ORDER BY id DESC LIMIT ?", (str(card_id), count)).fetchall()
+
+    def set_goal(self, card_id, blue, orange, green):
+        with self._lock:
+            self.conn.execute("""
+                INSERT INTO patients (card_id, goal_blue, goal_orange, goal_green) VALUES (?, ?, ?, ?)
+                ON CONFLICT (card_id) DO UPDATE SET
+                    goal_blue = excluded.goal_blue, goal_orange = excluded.goal_orange,
+                    goal_green = excluded.goal_green""", (str(card_id), blue, orange, green))
+            self.conn.commit()
+
+    def partitions(self, by):
+        """{partition key: (session count, last session id)}, grouped by `by` ("month" or "patient")."""
+        expression = PARTITION_EXPRESSIONS[by]
+        with self._lock:
+            return {key: (count, max_id) for key, count, max_id in self.conn.execute(
+                f"SELECT {expression}, COUNT(*), MAX(id) FROM sessions GROUP BY 1")}
+
+    def partition_rows(self, by, key):
+        expression = PARTITION_EXPRESSIONS[by]
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, card_id, timestamp, blue, orange, green FROM sessions "
+                f"WHERE {expression} = ? ORDER BY id", (key,)).fetchall()
+
+    def last_id(self):
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM sessions").fetchone()[0]
+
+    def synced_id(self, target):
+        with self._lock:
+            row = self.conn.execute("SELECT synced_id FROM sync_state WHERE target = ?", (target,)).fetchone()
+            return row[0] if row else 0
+
+    def mark_synced(self, target, synced_id):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_state (target, synced_id) VALUES (?, ?)",
+                              (target, synced_id))
+            self.conn.commit()
+
+    def pending_count(self, target):
+        """Sessions not yet delivered to `target`."""
+        synced = self.synced_id(target)
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sessions WHERE id > ?", (synced,)).fetchone()[0]
+
+    def import_excel(self, path=EXCEL_PATH):
+        """
+        One-time migration: if the store is empty, load the rows of an existing
+        data.xlsx so the first export does not lose earlier sessions.
+        Returns the number of imported rows.
+        """
+        if self.last_id() or not os.path.exists(path):
+            return 0
+        from openpyxl import load_workbook
+
+        book = load_workbook(path, read_only=True)
+        try:
+            rows = []
+            for values in book['Sheet1'].iter_rows(min_row=2, values_only=True):
+                if values and values[0] is not None:
+                    values = list(values[:len(SESSION_COLUMNS)])
+                    values += [None] * (len(SESSION_COLUMNS) - len(values))
+                    # Timestamps typed into the sheet by hand may come back as datetimes
+                    rows.append([str(values[0])] + [v.strftime("%Y-%m-%d %H:%M:%S") if hasattr(v, "strftime") else v
+                                                    for v in values[1:]])
+        finally:
+            book.close()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT INTO sessions (card_id, timestamp, blue, orange, green) VALUES (?, ?, ?, ?, ?)", rows)
+            self._rebuild_patients()
+            self.conn.commit()
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# =============================================================================
+# Excel export
+# =============================================================================
+def export_excel(store, path=EXCEL_PATH, temp_path=EXCEL_TEMP_PATH):
+    """
+    Regenerate the workbook at `path` from every row in the store.
+    It is built locally first and copied over in one go, so a slow or
+    interrupted mount never sees a half-written file.
+    Returns the id of the last exported row.
+    """
+    from reports import build_workbook
+
+    rows = store.rows()
+    try:
+        build_workbook(rows).save(temp_path)
+        shutil.copy2(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+    return rows[-1][0] if rows else 0
+
+
+if __name__ == "__main__":
+    # python session_store.py export [xlsx path] [db path]
+    # python session_store.py goal <card id> <blue> <orange> <green> [db path]
+    if len(sys.argv) >= 6 and sys.argv[1] == "goal":
+        store = SessionStore(sys.argv[6] if len(sys.argv) > 6 else SESSION_DB_PATH)
+        store.set_goal(sys.argv[2], *(int(v) for v in sys.argv[3:6]))
+        print(f"Goal for card {sys.argv[2]}: {store.patient(sys.argv[2])['goal']}")
+        store.close()
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print("Usage: python session_store.py export [xlsx path] [db path]\n"
+              "       python session_store.py goal <card id> <blue> <orange> <green> [db path]")
+        sys.exit(1)
+    xlsx_path = sys.argv[2] if len(sys.argv) > 2 else EXCEL_PATH
+    store = SessionStore(sys.argv[3] if len(sys.argv) > 3 else SESSION_DB_PATH)
+    last_id = export_excel(store, xlsx_path, xlsx_path + ".tmp.xlsx")
+    print(f"Exported sessions up to id {last_id} to {xlsx_path}")
+    store.close()
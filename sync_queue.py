@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from reports import REPORT_PREFIX, export_reports
+
+# =============================================================================
+# Background Sync Queue
+# =============================================================================
+# Sessions are committed to the local store first; the store itself is the
+# outbox. A background worker delivers everything newer than the target's
+# synced id, retrying with exponential backoff while the target is slow or
+# unavailable. Nothing is lost if a sync fails: the rows stay pending in the
+# store, including across restarts.
+#
+# A target has a `key` (its row in the store's sync_state table), `ready()`
+# and `deliver(store, synced_id)`, which returns the last delivered id.
+# ReportTarget updates the partitioned reports (reports.py) on the sync
+# directory (the Google Drive mount) - only the month that received new
+# sessions is rewritten; fleet_client.FleetTarget uploads to a fleet server.
+
+SYNC_DIR = os.environ.get("RT_SYNC_DIR", "/home/pi/googledrive")
+SYNC_PARTITION = "month"     # one report per month ("patient": one per card)
+SYNC_BATCH_DELAY = 2.0       # seconds to wait for more sessions before writing
+SYNC_RETRY_INTERVAL = 60.0   # seconds between checks when idle (retries old rows)
+SYNC_BACKOFF_MIN = 5.0
+SYNC_BACKOFF_MAX = 300.0
+
+
+class ReportTarget:
+    """Partitioned Excel reports in `sync_dir`."""
+    def __init__(self, sync_dir=SYNC_DIR, partition_by=SYNC_PARTITION, temp_dir=None):
+        self.sync_dir = sync_dir
+        self.partition_by = partition_by
+        self.key = os.path.join(sync_dir, f"{REPORT_PREFIX}_by_{partition_by}")
+        # Workbooks are built on local storage (e.g. next to the database), then copied over.
+        self.temp_dir = temp_dir
+        self.last_rebuilt = []
+
+    def __str__(self):
+        return self.sync_dir
+
+    def ready(self):
+        if not os.path.isdir(self.sync_dir):
+            raise IOError(f"Sync directory {self.sync_dir} is not available")
+
+    def deliver(self, store, synced_id):
+        temp_dir = self.temp_dir or os.path.dirname(os.path.abspath(store.path))
+        exported, self.last_rebuilt = export_reports(store, self.sync_dir, self.partition_by,
+                                                     temp_dir=temp_dir)
+        return exported
+
+
+class SyncWorker:
+    """
+    Delivers pending sessions from a SessionStore to `target` (by default the
+    reports in `sync_dir`). submit() commits a session on a background writer
+    thread and returns a Future; call notify() instead after appending to the
+    store directly. The worker coalesces everything pending into one delivery.
+    """
+    def __init__(self, store, sync_dir=SYNC_DIR, partition_by=SYNC_PARTITION, temp_dir=None,
+                 target=None, name="sync"):
+        self.store = store
+        self.target = target or ReportTarget(sync_dir, partition_by, temp_dir)
+        # Key of this target in the store's sync_state table
+        self.target_path = self.target.key
+        self.last_sync_latency = None    # seconds from first pending session to its delivery
+        self.last_sync_duration = None   # seconds the last delivery took
+        self.last_sync_time = None       # time.time() of the last successful sync
+        self.last_error = None
+        self.failures = 0
+        self._pending_since = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-writer")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._writer.shutdown(wait=True)
+        self._stop.set()
+        self._wake.set()
+        if timeout is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        """A session was committed locally; schedule a sync."""
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._wake.set()
+
+    def submit(self, data):
+        """
+        Commit a session row locally without blocking the caller.
+        The returned Future resolves to the new row id once the row is on disk
+        (the Drive sync follows in the background), or raises the write error.
+        """
+        return self._writer.submit(self._commit, data)
+
+    def _commit(self, data):
+        row_id = self.store.append(data)
+        self.notify()
+        return row_id
+
+    @property
+    def queue_depth(self):
+        """Sessions committed locally but not yet delivered to the sync target."""
+        return self.store.pending_count(self.target_path)
+
+    def status(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "last_sync_latency": self.last_sync_latency,
+            "last_sync_duration": self.last_sync_duration,
+            "last_sync_time": self.last_sync_time,
+            "failures": self.failures,
+            "last_rebuilt": getattr(self.target, "last_rebuilt", None),
+            "last_error": self.last_error,
+        }
+
+    def sync_once(self):
+        """
+        Deliver everything pending in one go. Returns True when the target is
+        up to date; raises on failure so the caller can back off.
+        """
+        synced = self.store.synced_id(self.target_path)
+        latest = self.store.last_id()
+        if latest <= synced:
+            self._pending_since = None
+            return True
+        self.target.ready()
+        start = time.monotonic()
+        exported = self.target.deliver(self.store, synced)
+        self.store.mark_synced(self.target_path, exported)
+        now = time.monotonic()
+        self.last_sync_duration = now - start
+        if self._pending_since is not None:
+            self.last_sync_latency = now - self._pending_since
+        self._pending_since = None if exported >= self.store.last_id() else now
+        self.last_sync_time = time.time()
+        return True
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stop.is_set():
+            if backoff:
+                # Failed last time: wait out the backoff, ignoring new notifications.
+                if self._stop.wait(backoff):
+                    break
+            else:
+                self._wake.wait(SYNC_RETRY_INTERVAL)
+                if self._stop.is_set():
+                    break
+                if self._wake.is_set():
+                    # Give sessions finishing close together a chance to share one write.
+                    self._stop.wait(SYNC_BATCH_DELAY)
+            self._wake.clear()
+            try:
+                self.sync_once()
+                self.failures = 0
+                self.last_error = None
+                backoff = 0.0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                backoff = min(SYNC_BACKOFF_MIN * 2 ** (self.failures - 1), SYNC_BACKOFF_MAX)
+                print(f"Sync to {self.target} failed ({e}); retrying in {backoff:.0f} s")
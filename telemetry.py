@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =============================================================================
+# Telemetry
+# =============================================================================
+# Hot-path instrumentation for the capture/detection loop: per-stage timers
+# with rolling percentiles, achieved FPS, dropped frames and per-color
+# detection hit rate. Recording is a deque append under a lock; percentiles
+# are only computed when a snapshot is taken. Snapshots can be served from a
+# local HTTP endpoint (MetricsServer) or appended to a JSON-lines log
+# (MetricsLogger).
+
+TELEMETRY_WINDOW = 300        # samples kept per stage for percentiles / FPS
+PERCENTILES = (50, 90, 99)
+METRICS_LOG_INTERVAL = 10     # seconds between JSON log lines
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Stopwatch:
+    """
+    Times consecutive stages of one frame: each lap(name) adds the time since
+    the previous lap to `name`. Stages that repeat within a frame (one inRange
+    per color, say) are summed. Passed as `stopwatch` to detection functions.
+    """
+    __slots__ = ("stages", "_last")
+
+    def __init__(self):
+        self.stages = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.stages[name] = self.stages.get(name, 0.0) + now - self._last
+        self._last = now
+
+
+class Telemetry:
+    """Thread-safe counters, rolling stage latencies (seconds) and rates."""
+    def __init__(self, window=TELEMETRY_WINDOW, detailed=True):
+        self.window = window
+        self.detailed = detailed   # per-stage detection timers (see stopwatch())
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._latency = {}
+        self._totals = {}
+        self._events = {}
+        self._hits = {}
+        self._sources = {}
+
+    # --- recording (hot path) ---
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def record_latency(self, stage, seconds):
+        with self._lock:
+            samples = self._latency.get(stage)
+            if samples is None:
+                samples = self._latency[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            total, worst, n = self._totals.get(stage, (0.0, 0.0, 0))
+            self._totals[stage] = (total + seconds, max(worst, seconds), n + 1)
+
+    def tick(self, name):
+        """Mark one occurrence of a periodic event (e.g. a detected frame) for its rate."""
+        now = time.monotonic()
+        with self._lock:
+            stamps = self._events.get(name)
+            if stamps is None:
+                stamps = self._events[name] = deque(maxlen=self.window)
+            stamps.append(now)
+
+    def stopwatch(self):
+        return Stopwatch() if self.detailed else None
+
+    def record_stopwatch(self, stopwatch):
+        if stopwatch is not None:
+            for stage, seconds in stopwatch.stages.items():
+                self.record_latency(stage, seconds)
+
+    def record_detections(self, positions):
+        with self._lock:
+            for label, pos in positions.items():
+                hits, frames = self._hits.get(label, (0, 0))
+                self._hits[label] = (hits + (pos is not None), frames + 1)
+
+    def add_source(self, name, callback):
+        """Include callback() (a JSON-serializable dict) in every snapshot under `name`."""
+        self._sources[name] = callback
+
+    # --- reporting ---
+    def rate(self, name):
+        with self._lock:
+            stamps = self._events.get(name)
+            if not stamps or len(stamps) < 2 or stamps[-1] == stamps[0]:
+                return 0.0
+            return (len(stamps) - 1) / (stamps[-1] - stamps[0])
+
+    def snapshot(self, dropped_frames=None):
+        with self._lock:
+            counters = dict(self._counters)
+            latency = {stage: (sorted(samples), samples[-1], self._totals[stage])
+                       for stage, samples in self._latency.items()}
+            hits = dict(self._hits)
+            events = list(self._events)
+        snapshot = dict(counters)
+        if dropped_frames is not None:
+            snapshot["dropped_frames"] = dropped_frames
+        snapshot["uptime"] = time.monotonic() - self.started
+        snapshot["fps"] = {name: self.rate(name) for name in events}
+        snapshot["hit_rate"] = {label: h / n if n else 0.0 for label, (h, n) in hits.items()}
+        snapshot["latency_ms"] = {}
+        for stage, (ordered, last, (total, worst, n)) in latency.items():
+            stats = {"last": last * 1000, "avg": total / n * 1000, "max": worst * 1000}
+            for pct in PERCENTILES:
+                stats[f"p{pct}"] = percentile(ordered, pct) * 1000
+            snapshot["latency_ms"][stage] = stats
+        for name, callback in list(self._sources.items()):
+            try:
+                snapshot[name] = callback()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        return snapshot
+
+
+# =============================================================================
+# Exporters
+# =============================================================================
+class MetricsServer:
+    """Serves snapshot() as JSON at http://<host>:<port>/metrics from a daemon thread."""
+    def __init__(self, snapshot, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            wbufsize = -1    # headers and body in one send (see fleet_server.py)
+
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = json.dumps(snapshot(), default=str).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsLogger:
+    """Appends one JSON snapshot per line to `path` every `interval` seconds."""
+    def __init__(self, snapshot, path, interval=METRICS_LOG_INTERVAL):
+        self.snapshot = snapshot
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-log", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                record = {"time": time.time(), **self.snapshot()}
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except Exception as e:
+                print("Error writing metrics log:", e)
@@ -0,0 +1,115 @@
+import numpy as np
+
+from mapping import VALUE_RANGES
+
+# =============================================================================
+# Session Time Series
+# =============================================================================
+# Every detection result shown during a session is kept, not just the three
+# readings at the moment a column peaks. Samples go into preallocated NumPy
+# columns used as a ring buffer: appending writes a few scalars in place and
+# never allocates, and memory stays fixed however long the session runs (the
+# oldest samples are overwritten after SERIES_CAPACITY). At the end of the
+# session the columns are written in one go to an .npz file, and the summary
+# (peak, effort duration, inspiratory flow) is computed on whole arrays.
+
+SERIES_CAPACITY = 30 * 60 * 10      # 10 minutes at 30 fps, about 470 KB
+EFFORT_THRESHOLD = 0.05             # fraction of a column's range counted as effort
+
+
+class SessionSeries:
+    """Ring buffer of (time, raw ball Y, reading) per color."""
+    def __init__(self, labels, capacity=SERIES_CAPACITY):
+        self.labels = list(labels)
+        self.capacity = capacity
+        self.t = np.zeros(capacity, np.float64)
+        self.y = np.zeros((capacity, len(self.labels)), np.float32)         # NaN = no ball
+        self.values = np.zeros((capacity, len(self.labels)), np.int16)
+        self.count = 0        # samples appended, including overwritten ones
+        self._columns = list(enumerate(self.labels))
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        """Start a new session, reusing the buffers."""
+        self.count = 0
+
+    @property
+    def overwritten(self):
+        return max(0, self.count - self.capacity)
+
+    def append(self, timestamp, positions, values):
+        """Record one detection result: {label: (x, y) or None} and {label: reading}."""
+        i = self.count % self.capacity
+        self.t[i] = timestamp
+        for j, label in self._columns:
+            pos = positions[label]
+            self.y[i, j] = pos[1] if pos else np.nan
+            self.values[i, j] = values[label]
+        self.count += 1
+
+    def arrays(self):
+        """(t, y, values) in time order, oldest first (copies)."""
+        n = len(self)
+        if self.count <= self.capacity:
+            return self.t[:n].copy(), self.y[:n].copy(), self.values[:n].copy()
+        i = self.count % self.capacity
+        order = np.r_[i:self.capacity, 0:i]
+        return self.t[order], self.y[order], self.values[order]
+
+    def summary(self):
+        """
+        Per color: peak reading and when it occurred (seconds from the first
+        sample), effort duration (time spent above EFFORT_THRESHOLD of the
+        column's range) and inspiratory flow (rise of the reading per second:
+        peak and mean over rising samples). Missing balls are ignored.
+        """
+        t, y, values = self.arrays()
+        result = {}
+        if not len(t):
+            return result
+        t = t - t[0]
+        dt = np.diff(t, prepend=t[0])
+        for j, label in self._columns:
+            detected = ~np.isnan(y[:, j])
+            v = values[:, j].astype(np.float64)
+            low, high = VALUE_RANGES.get(label, (0, 0))
+            effort = detected & (v > low + EFFORT_THRESHOLD * (high - low))
+            stats = {"samples": int(detected.sum()), "peak": 0, "peak_time": None,
+                     "effort_duration": float(dt[effort].sum()), "peak_flow": 0.0, "mean_flow": 0.0}
+            if stats["samples"]:
+                masked = np.where(detected, v, -np.inf)
+                peak_index = int(np.argmax(masked))
+                stats["peak"] = int(v[peak_index])
+                stats["peak_time"] = float(t[peak_index])
+                # Flow between consecutive detected samples
+                tv, vv = t[detected], v[detected]
+                if len(tv) > 1:
+                    span = np.diff(tv)
+                    flow = np.divide(np.diff(vv), span, out=np.zeros_like(span), where=span > 0)
+                    rising = flow > 0
+                    stats["peak_flow"] = float(flow.max(initial=0.0))
+                    stats["mean_flow"] = float(flow[rising].mean()) if rising.any() else 0.0
+            result[label] = stats
+        return result
+
+    def flush(self, path, **meta):
+        """Write the whole series to `path` as one .npz (one array per column)."""
+        t, y, values = self.arrays()
+        columns = {"t": t, "labels": np.array(self.labels), "overwritten": np.array(self.overwritten)}
+        for j, label in self._columns:
+            key = label.lower()
+            columns[f"{key}_y"] = y[:, j]
+            columns[f"{key}_value"] = values[:, j]
+        for key, value in meta.items():
+            columns[f"meta_{key}"] = np.array(value)
+        # Write through a file object so numpy keeps the exact file name.
+        with open(path, "wb") as f:
+            np.savez(f, **columns)
+
+
+def load_series(path):
+    """{column: array} of a flushed series, e.g. data['blue_value']."""
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
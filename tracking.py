@@ -0,0 +1,114 @@
+# =============================================================================
+# Temporal Ball Tracking
+# =============================================================================
+# Each ball only moves up and down its tube, so its Y is tracked with a
+# constant-velocity alpha-beta filter. The prediction narrows the rows that
+# need to be searched in the next frame. A short run of missed detections is
+# bridged by holding the last measured Y (no flicker to the bottom, and no
+# invented motion); bridged positions are flagged so they are never taken as
+# a reading's maximum. After MAX_MISSES misses in a row the track is dropped
+# and the full strip searched.
+
+TRACK_ALPHA = 0.85          # weight of the measured position
+TRACK_BETA = 0.3            # weight of the measured velocity change
+SEARCH_HALF_HEIGHT = 40     # rows searched above and below the predicted Y
+MAX_MISSES = 5
+MAX_FRAME_GAP = 0.5         # seconds; longer gaps restart the filter
+
+
+class BallTrack:
+    __slots__ = ("x", "y", "velocity", "misses", "active")
+
+    def __init__(self):
+        self.x = 0
+        self.y = 0.0
+        self.velocity = 0.0     # pixels per second, positive = moving down
+        self.misses = 0
+        self.active = False
+
+    def predict(self, dt):
+        return self.y + self.velocity * dt
+
+    def search_window(self, dt, height):
+        """Rows (y0, y1) to search in the next frame, or None for a full search."""
+        if not self.active:
+            return None
+        # Widen the window with every miss so a fast ball is picked up again.
+        half = SEARCH_HALF_HEIGHT * (1 + self.misses) + abs(self.velocity * dt)
+        center = self.predict(dt)
+        y0 = max(int(center - half), 0)
+        y1 = min(int(center + half) + 1, height)
+        if y1 - y0 >= height or y1 <= y0:
+            return None
+        return (y0, y1)
+
+    def update(self, position, dt):
+        if position is None:
+            if not self.active:
+                return
+            self.misses += 1
+            if self.misses > MAX_MISSES:
+                self.active = False
+            return
+        x, y = position
+        if not self.active or dt <= 0 or dt > MAX_FRAME_GAP:
+            self.x, self.y, self.velocity = x, float(y), 0.0
+        else:
+            predicted = self.predict(dt)
+            residual = y - predicted
+            self.x = x
+            self.y = predicted + TRACK_ALPHA * residual
+            self.velocity += TRACK_BETA * residual / dt
+        self.misses = 0
+        self.active = True
+
+    @property
+    def bridged(self):
+        """True while the position is held over missed detections rather than measured."""
+        return self.active and self.misses > 0
+
+    @property
+    def position(self):
+        # Y stays a float: pyramid mode measures it to a fraction of a pixel, and the
+        # canvas rounds it only when the ball is drawn (render.CanvasRenderer)
+        return (self.x, self.y) if self.active else None
+
+
+class BallTracker:
+    """One BallTrack per color, advanced once per detected frame."""
+    def __init__(self, labels, frame_height):
+        self.frame_height = frame_height
+        self.tracks = {label: BallTrack() for label in labels}
+        self.last_time = None
+
+    def _dt(self, timestamp):
+        return 0.0 if self.last_time is None else timestamp - self.last_time
+
+    def search_windows(self, timestamp):
+        """{label: (y0, y1) or None} for the frame taken at `timestamp`."""
+        dt = self._dt(timestamp)
+        return {label: track.search_window(dt, self.frame_height)
+                for label, track in self.tracks.items()}
+
+    def update(self, positions, timestamp):
+        """Feed one frame's detections; returns the smoothed positions."""
+        dt = self._dt(timestamp)
+        self.last_time = timestamp
+        for label, track in self.tracks.items():
+            track.update(positions.get(label), dt)
+        return self.positions
+
+    @property
+    def positions(self):
+        return {label: track.position for label, track in self.tracks.items()}
+
+    @property
+    def bridged(self):
+        """{label: True when the position is held over missed detections}."""
+        return {label: track.bridged for label, track in self.tracks.items()}
+
+    @property
+    def velocities(self):
+        """Vertical speed per color in pixels per second (None when not tracked)."""
+        return {label: track.velocity if track.active else None
+                for label, track in self.tracks.items()}